@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Benchmark bulk inserts into DBWrapper.
+
+Writes rows shaped like the matches table one statement at a time and through
+insert_many, and reports rows/second for each.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+parser = argparse.ArgumentParser(description='Benchmark DBWrapper inserts.')
+parser.add_argument('-n', '--rows', dest='rows', type=int, default=10000,
+                    help='number of rows to write')
+parser.add_argument('-p', '--profile', dest='profile', default='durable',
+                    help='storage profile to use')
+parser.add_argument('-b', '--backend', dest='backend', default='sqlite',
+                    choices=['memory', 'sqlite'],
+                    help='storage backend to use, memory leaves out disk I/O')
+parser.add_argument('--single', dest='single', action='store_true',
+                    help='also time one insert_values call per row (slow)')
+args = parser.parse_args()
+
+# Configure the database before anything opens it
+directory = tempfile.mkdtemp()
+os.environ['BB_DB_PATH'] = directory
+os.environ['BB_DB_PROFILE'] = args.profile
+os.environ['BB_DB_BACKEND'] = args.backend
+
+from brawlbracket import db_wrapper
+
+def makeRow():
+    """
+    Make a row that looks like a match.
+    """
+    return (uuid.uuid1(),
+            uuid.uuid1(),
+            0,
+            1,
+            1,
+            json.dumps([str(uuid.uuid1()), str(uuid.uuid1())]),
+            uuid.uuid1(),
+            json.dumps([0, 0]),
+            json.dumps([str(uuid.uuid1()), str(uuid.uuid1())]),
+            json.dumps([]),
+            None,
+            None,
+            None,
+            'esl',
+            None,
+            3,
+            json.dumps({'name': 'waitingForPlayers'}))
+
+def makeDB(directory, name):
+    """
+    Make a database with a matches-like table.
+    """
+    db = db_wrapper.DBWrapper(name, filepath=directory, profile=args.profile,
+                              backend=args.backend)
+    db.create_table('rows',
+                    ['c{}'.format(i) for i in range(17)],
+                    ['UUID', 'UUID', 'INTEGER', 'INTEGER', 'INTEGER',
+                     'UUIDLIST', 'UUID', 'TEXT', 'UUIDLIST', 'TEXT', 'TEXT',
+                     'INTEGER', 'TEXT', 'TEXT', 'UUID', 'INTEGER', 'TEXT'],
+                    'c0')
+    return db
+
+def report(name, seconds):
+    print('{:<12} {:>8} rows {:>8.3f}s {:>10.0f} rows/s'
+        .format(name, args.rows, seconds, args.rows / seconds))
+
+try:
+    rows = [makeRow() for i in range(args.rows)]
+    
+    db = makeDB(directory, 'bulk')
+    start = time.perf_counter()
+    db.insert_many('rows', rows)
+    report('insert_many', time.perf_counter() - start)
+    db.exit()
+    
+    if args.single:
+        db = makeDB(directory, 'single')
+        start = time.perf_counter()
+        for row in rows:
+            db.insert_values('rows', [row])
+        report('single', time.perf_counter() - start)
+        db.exit()
+finally:
+    shutil.rmtree(directory)
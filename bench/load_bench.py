@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmark loading tournaments from the database.
+
+Makes single elimination tournaments of increasing size, then loads each one
+back the way getTournamentById does after a restart, and reports the time
+taken and the peak memory allocated while loading.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+parser = argparse.ArgumentParser(description='Benchmark tournament loading.')
+parser.add_argument('-t', '--teams', dest='teams', type=int, nargs='+',
+                    default=[64, 256, 1024, 4096],
+                    help='tournament sizes (in teams) to load')
+parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                    help='number of times to load each tournament, the best '
+                         'time is reported')
+parser.add_argument('-p', '--profile', dest='profile', default='durable',
+                    help='storage profile to use')
+parser.add_argument('-b', '--backend', dest='backend', default='sqlite',
+                    help='storage backend to use, memory leaves out disk I/O')
+args = parser.parse_args()
+
+# Configure the database before anything opens it
+directory = tempfile.mkdtemp()
+os.environ['BB_DB_PATH'] = directory
+os.environ['BB_DB_PROFILE'] = args.profile
+os.environ['BB_DB_BACKEND'] = args.backend
+
+from brawlbracket import usermanager as um
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import chatmanager as cm
+from brawlbracket.user import User
+
+def makeTournament(teamCount):
+    """
+    Make a tournament with teamCount one player teams and its matches.
+    """
+    with tm.transaction():
+        tournament = tm.createTournament('bench{}'.format(teamCount))
+        for seed in range(1, teamCount + 1):
+            user = User(seed, 'Player {}'.format(seed), '')
+            um._writeUserToDB(user)
+            um._users[user.id] = user
+            
+            team = tournament.createTeam(seed, name = user.username)
+            team.addPlayer(tournament.createPlayer(user))
+        
+        tournament.generateMatches()
+    
+    return tournament
+
+def load(tournament):
+    """
+    Load a tournament from the database, as if it was never loaded.
+    
+    Returns the seconds taken.
+    """
+    tm._unregisterTournament(tournament.id)
+    um._users.clear()
+    cm._chats.clear()
+    
+    # Matches, teams and players are only loaded once they're used
+    start = time.perf_counter()
+    loaded = tm.getTournamentById(tournament.id)
+    matches = loaded.matches
+    seconds = time.perf_counter() - start
+    
+    assert len(matches) == len(tournament.matches)
+    return seconds
+
+def loadPeak(tournament):
+    """
+    Load a tournament like load, but return the peak bytes allocated instead.
+    Tracing allocations slows loading down so it isn't timed.
+    """
+    tracemalloc.start()
+    load(tournament)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return peak
+
+try:
+    print('{:>6} {:>8} {:>10} {:>12} {:>10}'
+        .format('teams', 'matches', 'load (s)', 'us/object', 'peak MiB'))
+    for teamCount in args.teams:
+        with contextlib.redirect_stdout(io.StringIO()):
+            tournament = makeTournament(teamCount)
+        
+        objects = len(tournament.matches) + len(tournament.teams) + \
+            len(tournament.players)
+        
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = min(load(tournament) for i in range(args.repeat))
+            peak = loadPeak(tournament)
+        print('{:>6} {:>8} {:>10.3f} {:>12.1f} {:>10.1f}'
+            .format(teamCount, len(tournament.matches), seconds,
+                    seconds / objects * 1e6, peak / 2 ** 20))
+finally:
+    shutil.rmtree(directory)
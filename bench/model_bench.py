@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Benchmark the memory used by tournament models and the cost of setting their
+attributes.
+
+Makes a single elimination tournament, loads it back from the database and
+reports the memory allocated per match (with its share of the teams and
+players), then times setting match and player attributes with a database
+callback that only marks them dirty, the way they're set while handling a
+request.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+parser = argparse.ArgumentParser(description='Benchmark tournament models.')
+parser.add_argument('-t', '--teams', dest='teams', type=int, default=4096,
+                    help='tournament size (in teams)')
+parser.add_argument('-n', '--number', dest='number', type=int,
+                    default=1000000,
+                    help='number of attribute sets to time')
+args = parser.parse_args()
+
+# Configure the database before anything opens it
+directory = tempfile.mkdtemp()
+os.environ['BB_DB_PATH'] = directory
+os.environ['BB_DB_BACKEND'] = 'memory'
+
+from brawlbracket import usermanager as um
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import chatmanager as cm
+from brawlbracket import writebatch
+from brawlbracket.user import User
+
+def makeTournament(teamCount):
+    """
+    Make a tournament with teamCount one player teams and its matches.
+    """
+    with tm.transaction():
+        tournament = tm.createTournament('bench{}'.format(teamCount))
+        for seed in range(1, teamCount + 1):
+            user = User(seed, 'Player {}'.format(seed), '')
+            um._writeUserToDB(user)
+            um._users[user.id] = user
+            
+            team = tournament.createTeam(seed, name = user.username)
+            team.addPlayer(tournament.createPlayer(user))
+        
+        tournament.generateMatches()
+    
+    return tournament
+
+def loadBytes(tournament):
+    """
+    Load a tournament from the database, as if it was never loaded.
+    
+    Returns the loaded tournament and the bytes still allocated once it's
+    loaded.
+    """
+    tm._unregisterTournament(tournament.id)
+    um._users.clear()
+    cm._chats.clear()
+    
+    tracemalloc.start()
+    loaded = tm.getTournamentById(tournament.id)
+    loaded.load()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    return loaded, size
+
+@writebatch.coalesced
+def markDirty(obj, fields):
+    """
+    Database callback that writes nothing.
+    """
+    pass
+
+def objectBytes(obj):
+    """
+    Get the size of an object and its attribute dict if it has one, leaving
+    out the attribute values.
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    
+    return size
+
+def timeSet(statement, obj):
+    """
+    Time a statement setting an attribute of obj inside a batch.
+    
+    Returns the nanoseconds taken per set.
+    """
+    obj._dbCallback = markDirty
+    with writebatch.batch():
+        seconds = min(timeit.repeat(statement, globals = {'obj': obj},
+                                    number = args.number, repeat = 3))
+    
+    return seconds / args.number * 1e9
+
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        tournament = makeTournament(args.teams)
+        loaded, size = loadBytes(tournament)
+    
+    matchCount = len(loaded.matches)
+    print('{} teams, {} matches'.format(args.teams, matchCount))
+    print('{:>34} {:>10.0f}'.format('bytes/match', size / matchCount))
+    
+    match = next(iter(loaded.matches))
+    player = next(iter(loaded.players))
+    team = next(iter(loaded.teams))
+    for name, obj in [('match', match), ('team', team), ('player', player),
+                      ('user', player.user), ('chat', match.chat)]:
+        print('{:>34} {:>10}'.format(name + ' object bytes', objectBytes(obj)))
+    
+    print('{:>34} {:>10.1f}'.format('match.roomNumber = x (ns)',
+                                    timeSet('obj.roomNumber = 1', match)))
+    print('{:>34} {:>10.1f}'.format('match.oldScore = x (ns)',
+                                    timeSet('obj.oldScore = None', match)))
+    print('{:>34} {:>10.1f}'.format('player.online += 1 (ns)',
+                                    timeSet('obj.online += 1', player)))
+    print('{:>34} {:>10.1f}'.format('match.roomNumber (ns)',
+                                    timeSet('obj.roomNumber', match)))
+finally:
+    shutil.rmtree(directory)
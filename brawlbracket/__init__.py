@@ -1 +0,0 @@
-from brawlbracket.app import runWebServer
\ No newline at end of file
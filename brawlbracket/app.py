@@ -13,6 +13,11 @@ from flask.ext.openid import OpenID
 
 from brawlbracket import usermanager as um
 from brawlbracket import tournamentmanager as tm
+from brawlbracket import db_wrapper
+from brawlbracket import writebatch
+from brawlbracket import backup
+from brawlbracket import snapshot
+from brawlbracket import util
 
 __version__ = '0.1.0'
 
@@ -79,6 +84,27 @@ def default_template_data():
     return dict(versionNumber = __version__,
                 user = g.user)
                 
+@app.before_request
+def begin_write_batch():
+    """
+    Batch model writes made while handling the request.
+    """
+    writebatch.begin()
+
+@app.teardown_request
+def end_write_batch(exception):
+    """
+    Write out everything changed while handling the request in one
+    transaction. Nothing is written if the request failed.
+    """
+    # Most requests don't change anything, don't take the write lock for them
+    if exception is not None or not writebatch.isDirty():
+        writebatch.end(write = False)
+        return
+    
+    with db_wrapper.app_db().transaction():
+        writebatch.end()
+                
 @app.before_request
 def get_user_data():
     """
@@ -97,10 +123,27 @@ def pull_tourney(endpoint, values):
     g.tourneyName = values.pop('tourneyName', None)
     g.tournament = None
     if g.tourneyName:
+        # Cheap check first so bad links never load anything
+        if not tm.tournamentNameExists(g.tourneyName):
+            abort(404)
+        
         g.tournament = tm.getTournamentByName(g.tourneyName)
         
         if g.tournament is None:
             abort(404)
+        
+        # Keep it loaded until the request is done, see release_tourney
+        g.pinnedTournament = g.tournament
+        g.tournament.connections += 1
+
+@app.teardown_request
+def release_tourney(exception):
+    """
+    Let the tournament pinned by pull_tourney be unloaded again.
+    """
+    tournament = g.pop('pinnedTournament', None)
+    if tournament is not None:
+        tournament.connections -= 1
                 
 @app.template_filter('datetime')
 def filter_datetime(date):
@@ -136,4 +179,31 @@ def runWebServer(debug=False):
     Run the web server.
     """
     app.debug = debug
-    socketio.run(app, host='0.0.0.0')
+    
+    # Load live tournaments before accepting connections so reconnecting
+    # players don't all wait on them at once. The snapshot written on
+    # shutdown is quickest, anything it doesn't have comes from the database.
+    if util.snapshotEnabled:
+        # A snapshot the current code can't read is no reason not to start
+        try:
+            snapshot.loadSnapshot()
+        except Exception as e:
+            print('Snapshot couldn\'t be loaded: {}'.format(e))
+        
+        snapshot.startSchedule()
+    
+    if util.warmUpWorkers > 0:
+        tm.warmUp(util.warmUpWorkers)
+    
+    backup.startSchedule()
+    try:
+        socketio.run(app, host='0.0.0.0')
+    finally:
+        if util.snapshotEnabled:
+            try:
+                snapshot.writeSnapshot()
+            except Exception as e:
+                print('Snapshot failed: {}'.format(e))
+        
+        # Close pooled database connections
+        db_wrapper.app_db().exit()
@@ -0,0 +1,149 @@
+import os
+import datetime
+import threading
+import time
+
+from brawlbracket import db_wrapper
+from brawlbracket import util
+
+# Online backups of the application database, see DBWrapper.backup. Backups
+# are named <dbName>-<time>.db and kept in util.dbBackupPath, only the newest
+# util.dbBackupKeep are kept.
+
+# Held while a backup runs, only one runs at a time
+_lock = threading.Lock()
+
+# Scheduled backup thread, see startSchedule
+_thread = None
+
+# Result of the last backup, see backupDB
+_lastBackup = None
+
+def backupDB():
+    """
+    Back up the database now, then remove old backups.
+    
+    Returns a dict with the backup's file name, pages copied and seconds
+    taken, or None if a backup was already running.
+    """
+    global _lastBackup
+    
+    if not _lock.acquire(blocking = False):
+        return None
+    
+    try:
+        os.makedirs(util.dbBackupPath, exist_ok = True)
+        
+        fileName = '{}-{}.db'.format(
+            util.dbName,
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        path = os.path.join(util.dbBackupPath, fileName)
+        
+        # Copy to a temporary file so a half finished backup is never mistaken
+        # for a good one
+        partPath = path + '.part'
+        try:
+            pages, seconds = db_wrapper.app_db().backup(
+                partPath,
+                pages = util.dbBackupPages,
+                pause = util.dbBackupPauseMs / 1000)
+            os.replace(partPath, path)
+        except:
+            if os.path.exists(partPath):
+                os.remove(partPath)
+            raise
+        
+        _removeOldBackups()
+        
+        _lastBackup = {
+            'file': fileName,
+            'pages': pages,
+            'seconds': round(seconds, 3),
+            'time': datetime.datetime.now().isoformat()
+        }
+        print('Backed up database to {} ({} pages in {:.2f} s)'
+                .format(path, pages, seconds))
+        
+        return _lastBackup
+    finally:
+        _lock.release()
+
+def startBackupDB():
+    """
+    Start a backup in the background.
+    
+    Returns False if one is already running.
+    """
+    if _lock.locked():
+        return False
+    
+    threading.Thread(target = _backupQuietly, name = 'db-backup',
+                     daemon = True).start()
+    return True
+
+def getBackups():
+    """
+    Get the file names of the backups that are kept, oldest first.
+    """
+    if not os.path.isdir(util.dbBackupPath):
+        return []
+    
+    prefix = util.dbName + '-'
+    return sorted(f for f in os.listdir(util.dbBackupPath)
+                  if f.startswith(prefix) and f.endswith('.db'))
+
+def getStatus():
+    """
+    Returns a JSON friendly dict with whether a backup is running, the last
+    backup and every backup that is kept.
+    """
+    return {
+        'running': _lock.locked(),
+        'everyMinutes': util.dbBackupEvery,
+        'keep': util.dbBackupKeep,
+        'last': _lastBackup,
+        'backups': getBackups()
+    }
+
+def startSchedule(every = None):
+    """
+    Back up the database every few minutes from a background thread, every
+    util.dbBackupEvery minutes by default. Does nothing if every is 0 or
+    the schedule is already running.
+    """
+    global _thread
+    
+    if every is None:
+        every = util.dbBackupEvery
+    
+    if not every or _thread is not None:
+        return
+    
+    _thread = threading.Thread(target = _runSchedule, args = (every * 60,),
+                               name = 'db-backup-schedule', daemon = True)
+    _thread.start()
+
+def _runSchedule(interval):
+    """
+    Backup thread loop.
+    """
+    while True:
+        time.sleep(interval)
+        _backupQuietly()
+
+def _backupQuietly():
+    """
+    Back up the database, printing errors instead of raising them.
+    """
+    try:
+        backupDB()
+    except Exception as e:
+        print('Database backup failed: {}'.format(e))
+
+def _removeOldBackups():
+    """
+    Remove all but the newest util.dbBackupKeep backups.
+    """
+    backups = getBackups()
+    for fileName in backups[:max(len(backups) - util.dbBackupKeep, 0)]:
+        os.remove(os.path.join(util.dbBackupPath, fileName))
@@ -2,7 +2,9 @@ import uuid
 import datetime
 from brawlbracket import chatmanager
 from brawlbracket import banrule
+from brawlbracket import fields
 
+@fields.tracked
 class Match():
     """
     A match between two Teams in the tournament. The Tournament class will create these for you as necessary.
@@ -10,6 +12,16 @@ class Match():
     
     # When printing a match tree, this is the maximum length (in chars) of a seed.
     printSeedLen = 2
+    
+    # Written to the database when set, see fields. prereqMatches calls back
+    # itself.
+    _trackedFields = ('id', 'tournamentId', 'nextMatch', 'nextMatchSide',
+                      'round', 'number', 'teams', 'chat', 'score', 'bestOf',
+                      'winner', 'state', '_realmBans', 'startTime',
+                      'roomNumber', 'currentRealm', 'banRule')
+    
+    __slots__ = fields.slotNames(_trackedFields) + \
+        ('_prereqMatches', 'oldScore', '_dbCallback')
 
     def __init__(self, prereqMatches = None, teams = None, **kwargs):
         """
@@ -31,6 +43,7 @@ class Match():
             state: The state of the match
             
         Tournament data:
+            tournamentId: Id of the tournament this match is in (uuid)
             winner: The winning team of this match, None if no winner yet (Team)
             round: Round in the tournament (int)
             number: The number of the match in the tournament. Roughly the order they'll be played in. (int)
@@ -40,7 +53,11 @@ class Match():
             lobbyData: Returns dict of lobby data
             lobbyStatus: Returns tuple of lobby status. (string, string, int)
         """
-        self.id = kwargs.get('uuid', uuid.uuid1())
+        self._dbCallback = None
+        
+        id = kwargs.get('uuid')
+        self.id = id if id is not None else uuid.uuid1()
+        self.tournamentId = kwargs.get('tournamentId')
         
         self.nextMatch = None
         self.nextMatchSide = None
@@ -82,21 +99,6 @@ class Match():
         self.currentRealm = None
         self.banRule = 'esl' # XXX Change me
     
-    def __setattr__(self, name, value):
-        """
-        Override default setting value functionality to let us send things to
-        the database on updates.
-        """
-        super().__setattr__(name, value)
-        
-        # Could be picky about names of vars changing where we don't want to 
-        # write out to the database
-        if name in ['_dbCallback', 'oldScore']:
-            return
-        
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
-    
     @property
     def prereqMatches(self):
         """
@@ -122,8 +124,8 @@ class Match():
             match.nextMatch = self
             match.nextMatchSide = side
         
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'prereqMatches')
     
     def addRealmBan(self, realm):
         """
@@ -133,8 +135,8 @@ class Match():
             return
         
         self._realmBans.append(realm)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, '_realmBans')
     
     def getRealmBans(self):
         """
@@ -147,8 +149,8 @@ class Match():
         Clears the realm bans.
         """
         self._realmBans.clear()
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, '_realmBans')
     
     def incrementScore(self, teamIndex, amount = 1):
         """
@@ -157,16 +159,16 @@ class Match():
         amount is the amount to change by. By default this is 1.
         """
         self.score[teamIndex] += amount
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'score')
     
     def setTeam(self, team, index):
         """
         Set one of the teams in this match.
         """
         self.teams[index] = team
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'teams')
         
     def _getTreeDepth(self):
         """
@@ -434,5 +436,5 @@ class Match():
         rules = banrule.rulesets[self.banRule] 
         rules.advanceState(self)
         
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'state')
@@ -1,9 +1,18 @@
 import uuid
 
+from brawlbracket import fields
+
+@fields.tracked
 class Team:
     """
     A seeded entry in the tournament. Create these through the Tournament class.
     """
+    # Written to the database when set, see fields
+    _trackedFields = ('id', 'tournamentId', 'seed', 'name', 'players',
+                      'eliminated', 'checkedIn')
+    
+    __slots__ = fields.slotNames(_trackedFields) + ('_dbCallback',)
+    
     def __init__(self, seed, players = None, **kwargs):
         """
         Team data:
@@ -13,10 +22,15 @@ class Team:
          players: Players on this team (list of Player)
         
         Tournament data:
+         tournamentId: Id of the tournament this team is in (uuid)
          eliminated: Has this team been eliminated (boolean)
          checkedIn: Has this team checked in (boolean)
         """
-        self.id = kwargs.get('uuid', uuid.uuid1())
+        self._dbCallback = None
+        
+        id = kwargs.get('uuid')
+        self.id = id if id is not None else uuid.uuid1()
+        self.tournamentId = kwargs.get('tournamentId')
         
         self.seed = seed
         self.name = kwargs.get('name', '')
@@ -29,21 +43,6 @@ class Team:
         
         self.eliminated = False
         self.checkedIn = False
-
-    def __setattr__(self, name, value):
-        """
-        Override default setting value functionality to let us send things to
-        the database on updates.
-        """
-        super().__setattr__(name, value)
-        
-        # Could be picky about names of vars changing where we don't want to 
-        # write out to the database
-        if name in ['_dbCallback']:
-            return
-        
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
         
     def __repr__(self):
         return '{} ({})'.format(self.name, self.seed)
@@ -56,8 +55,8 @@ class Team:
             return
         
         self.players.append(player)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'players')
     
     def removePlayer(self, player):
         """
@@ -67,6 +66,6 @@ class Team:
             return
         
         self.players.remove(player)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+        if self._dbCallback is not None:
+            self._dbCallback(self, 'players')
         
\ No newline at end of file
@@ -1,5 +1,6 @@
 import math
 import uuid
+import threading
 from collections import deque
 
 from brawlbracket import chatmanager
@@ -43,7 +44,8 @@ class Tournament():
         
         # These four sets should only be iterated over and not changed
         # Changing them directly requires extra calls to sync database
-        # and state
+        # and state. Matches, teams and players know their tournament through
+        # their tournamentId so adding one doesn't rewrite the tournament.
         self.matches = set()
         self.teams = set()
         self.players = set()
@@ -60,6 +62,60 @@ class Tournament():
         # These are (Match, Team, Player)
         self._callbacks = kwargs.get('callbacks', (None, None, None))
         self._fullCallback = kwargs.get('fullCallback', None)
+        
+        # Sockets and requests using this tournament, it isn't unloaded while
+        # there are any. Not written to the database.
+        self.connections = 0
+    
+    # Attributes a loader sets the first time they're used, see setLoader
+    _lazyFields = ('matches', 'teams', 'players', '_root')
+    
+    def __getattr__(self, name):
+        """
+        Only called for attributes that aren't set. Runs the loader of a
+        tournament that was loaded without its matches, teams and players
+        the first time any of them are used.
+        """
+        loader = self.__dict__.get('_loader')
+        if loader is None or name not in self._lazyFields:
+            raise AttributeError('\'{}\' object has no attribute \'{}\''
+                                 .format(type(self).__name__, name))
+        
+        with self._loadLock:
+            # Already loaded by another thread while we waited
+            if self.__dict__.get('_loader') is loader:
+                # Set directly so the database isn't told about it
+                self.__dict__.update(loader(self))
+                del self.__dict__['_loader']
+        
+        return getattr(self, name)
+    
+    def setLoader(self, loader):
+        """
+        Forget matches, teams and players until they're used.
+        
+        loader: Called as loader(tournament) the first time one is used, must
+                return a dict of every attribute in _lazyFields (function)
+        """
+        for name in self._lazyFields:
+            self.__dict__.pop(name, None)
+        
+        self.__dict__['_loadLock'] = threading.RLock()
+        self.__dict__['_loader'] = loader
+    
+    def load(self):
+        """
+        Load matches, teams and players now instead of when they're first
+        used.
+        """
+        getattr(self, 'matches')
+    
+    @property
+    def loaded(self):
+        """
+        Whether or not matches, teams and players are loaded.
+        """
+        return '_loader' not in self.__dict__
     
     def __setattr__(self, name, value):
         """
@@ -70,24 +126,24 @@ class Tournament():
         
         # Could be picky about names of vars changing where we don't want to 
         # write out to the database
-        if name in ['_dbCallback', '_callbacks', '_fullCallback']:
+        if name in ['_dbCallback', '_callbacks', '_fullCallback',
+                    'connections']:
             return
         
         if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+            self._dbCallback(self, name)
     
     def createTeam(self, *args, **kwargs):
         """
         Create a team and add it to the tournament.
         """
+        kwargs['tournamentId'] = self.id
         team = Team(*args, **kwargs)
         team._dbCallback = self._callbacks[1]
         if self._callbacks[1] is not None:
             self._callbacks[1](team)
         
         self.teams.add(team)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
         
         return team
         
@@ -107,14 +163,13 @@ class Tournament():
                 if team not in self.teams:
                     raise ValueError('Team not in tournament')
         
+        kwargs['tournamentId'] = self.id
         match = Match(*args, **kwargs)
         match._dbCallback = self._callbacks[0]
         if self._callbacks[0] is not None:
             self._callbacks[0](match)
         
         self.matches.add(match)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
         
         return match
         
@@ -122,6 +177,7 @@ class Tournament():
         """
         Create a player and add it to the tournament.
         """
+        kwargs['tournamentId'] = self.id
         player = Player(*args, **kwargs)
         player.adminChat = chatmanager.createChat()
     
@@ -130,8 +186,6 @@ class Tournament():
             self._callbacks[2](player)
         
         self.players.add(player)
-        if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
         
         return player
     
@@ -141,7 +195,7 @@ class Tournament():
         """
         self.admins.update(admins)
         if '_dbCallback' in self.__dict__ and self._dbCallback is not None:
-            self._dbCallback(self)
+            self._dbCallback(self, 'admins')
     
     def isAdmin(self, admin):
         """
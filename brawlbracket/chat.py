@@ -8,12 +8,14 @@ class Chat:
         id: Unique id.
         log: Messages in JSON format.
     """
+    __slots__ = ('id', 'log')
     
     def __init__(self, **kwargs):
         """
         Create the chat with a unique id.
         """
-        self.id = kwargs.get('uuid', uuid.uuid1())
+        id = kwargs.get('uuid')
+        self.id = id if id is not None else uuid.uuid1()
         self.log = []
         
     def getRoom(self):
@@ -2,9 +2,9 @@ import json
 
 from brawlbracket import chat
 from brawlbracket import db_wrapper
-from brawlbracket import util
 
-_chats = []
+# Loaded chats, {id: Chat}
+_chats = {}
 
 _db = None
 
@@ -18,7 +18,7 @@ def createChat():
     
     _writeChatToDB(newChat)
     
-    _chats.append(newChat)
+    _chats[newChat.id] = newChat
     
     return newChat
     
@@ -29,17 +29,56 @@ def getChat(id):
     Returns the Chat if it exists.
     Returns None otherwise.
     """
-    for c in _chats:
-        if c.id == id:
-            return c
+    c = _chats.get(id, None)
+    if c is not None:
+        return c
             
     c = _getChatFromDB(id)
     if c is not None:
-        _chats.append(c)
+        _chats[c.id] = c
         return c
     
     return None
 
+def getChats(ids):
+    """
+    Get many chats by uuid at once. Chats that aren't loaded yet are read
+    from the database together instead of one at a time.
+    
+    Returns a dict of {id: Chat} of the chats found, ids that aren't
+    associated with a chat are left out.
+    """
+    chats = {}
+    missing = set()
+    for id in ids:
+        if id is None:
+            continue
+        
+        c = _chats.get(id, None)
+        if c is not None:
+            chats[id] = c
+        else:
+            missing.add(id)
+    
+    if missing:
+        if _db is None:
+            _initDB()
+        
+        chats.update(_cacheChats(
+            _db.select_in('chats', _chatColumns, 'id', missing)))
+    
+    return chats
+
+def _forgetChats(ids):
+    """
+    Drop chats from the cache, they're loaded from the database again the
+    next time they're needed.
+    
+    ids: The chats' ids (set of UUIDs)
+    """
+    for id in ids:
+        _chats.pop(id, None)
+
 def _getChatFromDB(id):
     """
     Gets a chat from the database by steamId.
@@ -50,24 +89,47 @@ def _getChatFromDB(id):
     if _db is None:
         _initDB()
     
-    # Quick function that returns a string surrounded by quotes
-    q = lambda x: '\'{}\''.format(x)
-    
-    rows = _db.select_values('chats', ['*'], ['id = {}'.format(q(id))])
+    rows = _db.select_values('chats', _chatColumns, ['id = ?'],
+                             params = [id])
     
     if rows:
-        chatData = rows[0]
-        #print('Making chat from: ', chatData)
-        id = chatData[0]
-        log = json.loads(chatData[1])
-        
-        newChat = chat.Chat(uuid = id)
-        newChat.log = log
-        
-        return newChat
+        return _buildChat(rows[0])
     else:
         return None
 
+# Columns of the chats table read by _buildChat
+_chatColumns = ['id', 'log']
+
+def _cacheChats(rows):
+    """
+    Builds chats from database chat data and adds them to the cache. Chats
+    that are already loaded are kept as they are.
+    
+    Returns a dict of {id: Chat} for every row.
+    """
+    chats = {}
+    for chatData in rows:
+        c = _chats.get(chatData[0], None)
+        if c is None:
+            c = _buildChat(chatData)
+            _chats[c.id] = c
+        chats[c.id] = c
+    
+    return chats
+
+def _buildChat(chatData):
+    """
+    Builds a chat from database chat data.
+    """
+    #print('Making chat from: ', chatData)
+    id = chatData[0]
+    log = json.loads(chatData[1])
+    
+    newChat = chat.Chat(uuid = id)
+    newChat.log = log
+    
+    return newChat
+
 def _writeChatToDB(c):
     """
     Serializes a chat and then inserts it into the chat table of the database.
@@ -80,13 +142,13 @@ def _writeChatToDB(c):
         json.dumps(c.log)
         )
     #print('Writing chat with: ', chatData)
-    _db.insert_values('chats', [chatData])
+    _db.insert_deferred('chats', [chatData])
         
 def _initDB():
     print('----INIT CHAT DATABASE----')
     # Need to global because _db is not local to this context
     global _db
-    _db = db_wrapper.DBWrapper(util.dbName, filepath=util.dbPath)
+    _db = db_wrapper.app_db()
     
     # Make chats table
     if not _db.table_exists('chats'):
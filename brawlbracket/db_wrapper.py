@@ -1,10 +1,499 @@
 from brawlbracket.util import KeySingleton
+from brawlbracket import util
 #import logger
 
 import sqlite3
 import os
 import uuid
 import json
+import time
+import queue
+import threading
+import itertools
+import struct
+from contextlib import contextmanager
+from functools import lru_cache
+
+# Number of compiled statements kept, both by the statement compilers and by
+# each connection's prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# Number of rows sent to executemany at a time by bulk inserts
+CHUNK_SIZE = 500
+
+# Number of rows fetched at a time by iter_values
+FETCH_SIZE = 256
+
+# Number of values looked up at a time by select_in. Kept under SQLite's
+# oldest limit on bound parameters (999).
+IN_CHUNK_SIZE = 500
+
+# Named storage profiles. Each one maps a PRAGMA to the value that is applied
+# to every new connection. journal_mode must come first because some of the
+# other settings depend on it.
+profiles = {
+    # Safe against power loss, readers don't block the writer
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -8000, # In KiB when negative
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000 # ms
+    },
+    # Safe against crashes but a power loss can roll back the last commits,
+    # much lower write latency for live events
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -32000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000
+    },
+    # No durability at all, only for tests and benchmarks
+    'ephemeral-test': {
+        'journal_mode': 'MEMORY',
+        'synchronous': 'OFF',
+        'cache_size': -32000,
+        'mmap_size': 0,
+        'temp_store': 'MEMORY',
+        # Write behind flushes wait for transactions to commit
+        'busy_timeout': 5000
+    }
+}
+
+class ConnectionPool:
+    """
+    A pool of SQLite connections.
+    
+    Each thread (or green thread) checks out its own connection and keeps it
+    for as long as it's using the database. Nested uses from the same thread
+    get the same connection back. Once a thread is done the connection is
+    kept idle so the next caller doesn't pay for connection setup and page
+    cache warmup again.
+    
+    size is the maximum number of idle connections kept around.
+    check_after is how long (in seconds) a connection can sit idle before it
+    is health checked on checkout.
+    """
+    
+    def __init__(self, factory, size=8, check_after=30.0):
+        self.factory = factory
+        self.size = size
+        self.check_after = check_after
+        self.closed = False
+        
+        # Idle connections as (connection, time last used). LIFO so the most
+        # recently used (warmest) connection is handed out first.
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+    
+    @contextmanager
+    def connection(self):
+        """
+        Check out this thread's connection for the duration of a with block.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        
+        # Thread already has a connection, share it
+        if conn is not None:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        
+        conn = self._acquire()
+        local.conn = conn
+        local.depth = 1
+        try:
+            yield conn
+        finally:
+            local.conn = None
+            local.depth = 0
+            self._release(conn)
+    
+    def close(self):
+        """
+        Close every idle connection. Connections that are checked out are
+        closed as soon as they are given back.
+        """
+        self.closed = True
+        
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+    
+    def _acquire(self):
+        """
+        Get a healthy connection, either from the idle pool or a new one.
+        """
+        if self.closed:
+            raise sqlite3.ProgrammingError('Connection pool is closed.')
+        
+        while True:
+            try:
+                conn, lastUsed = self._idle.get_nowait()
+            except queue.Empty:
+                return self.factory()
+            
+            # Connection was used recently, trust it
+            if time.monotonic() - lastUsed < self.check_after:
+                return conn
+            
+            if self._healthy(conn):
+                return conn
+            
+            conn.close()
+    
+    def _release(self, conn):
+        """
+        Give a connection back to the pool.
+        """
+        if self.closed or self._idle.qsize() >= self.size:
+            conn.close()
+            return
+        
+        # Never hand out a connection with a half finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        
+        self._idle.put((conn, time.monotonic()))
+    
+    @staticmethod
+    def _healthy(conn):
+        """
+        Returns whether or not a connection is still usable.
+        """
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+class WriteBehindQueue:
+    """
+    Queues rows to be written by a background thread (a green thread when
+    running under eventlet) so callers don't wait on the disk.
+    
+    Rows are coalesced by (table, primary key), only the last row queued for
+    a key is written. Column updates (see DBWrapper.update_deferred) are
+    merged into whatever is already queued for their row. The queue is
+    written out in one transaction (a group commit) every interval seconds,
+    or as soon as batch_rows rows are waiting.
+    
+    Once max_pending rows are waiting whoever queues more rows writes the
+    queue out themselves, which slows producers down to the speed of the
+    disk instead of letting the queue grow forever.
+    
+    If writing the queue fails max_retries times in a row, the next write
+    gives each row a savepoint of its own. Rows that still fail are logged
+    and moved to dead_rows so one bad row can't hold up the rest.
+    
+    close() writes out everything still queued.
+    """
+    
+    def __init__(self, db, interval=0.05, batch_rows=200, max_pending=5000,
+                 max_retries=3):
+        self.db = db
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.closed = False
+        
+        # Rows waiting to be written, (table, key) -> row
+        self._pending = {}
+        
+        # Rows that couldn't be written on their own, (table, key) -> row
+        self.dead_rows = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        
+        # Held while a batch is being written so batches land in order
+        self.flush_lock = threading.Lock()
+        
+        # Metrics, see stats()
+        self.max_depth = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.flushes = 0
+        self.forced_flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_time = 0.0
+    
+    @property
+    def depth(self):
+        """
+        Number of rows waiting to be written.
+        """
+        return len(self._pending)
+    
+    def stats(self):
+        """
+        Returns a dict of queue metrics.
+        """
+        with self._cond:
+            return {
+                'depth': len(self._pending),
+                'max_depth': self.max_depth,
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'written': self.written,
+                'flushes': self.flushes,
+                'forced_flushes': self.forced_flushes,
+                'failed_flushes': self.failed_flushes,
+                'dead_rows': len(self.dead_rows),
+                'last_flush_ms': self.last_flush_time * 1000
+            }
+    
+    def put_many(self, entries):
+        """
+        Queues rows. Entries is an iterable of ((table, key), row), where a
+        row is a full row or a column update.
+        """
+        merge = self.db._merge_deferred
+        with self._cond:
+            pending = self._pending
+            for key, row in entries:
+                if key in pending:
+                    self.coalesced += 1
+                    row = merge(key[0], pending[key], row)
+                pending[key] = row
+                self.queued += 1
+            
+            depth = len(pending)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            
+            if self._thread is None and not self.closed:
+                self._thread = threading.Thread(target=self._run,
+                                                name='write-behind',
+                                                daemon=True)
+                self._thread.start()
+            
+            self._cond.notify()
+            
+            # Queue is full (or nobody is left to write it), write it
+            # ourselves
+            force = depth >= self.max_pending or self.closed
+            if force:
+                self.forced_flushes += 1
+        
+        if force:
+            self.flush()
+    
+    def take(self):
+        """
+        Removes and returns every queued row.
+        """
+        with self._cond:
+            rows = self._pending
+            self._pending = {}
+        return rows
+    
+    def requeue(self, rows):
+        """
+        Puts back rows that were taken but never written. Rows queued again
+        since they were taken are newer and win.
+        """
+        merge = self.db._merge_deferred
+        with self._cond:
+            pending = self._pending
+            for key, row in rows.items():
+                pending[key] = merge(key[0], row, pending.get(key))
+    
+    def flush(self, isolate=False):
+        """
+        Writes out every queued row in one transaction. Returns the number of
+        rows written.
+        
+        Rows are put back in the queue if the write fails. If isolate is set
+        each row is written in a savepoint of its own instead, and rows that
+        fail are moved to dead_rows.
+        """
+        with self.flush_lock:
+            if not self._pending:
+                return 0
+            
+            start = time.perf_counter()
+            rows = {}
+            try:
+                with self.db.transaction():
+                    # Only take rows once the write lock is held (see
+                    # DBWrapper.transaction), so a transaction that took
+                    # newer ones has committed and they're not written over
+                    rows = self.take()
+                    if isolate:
+                        rows = self._write_each(rows)
+                    else:
+                        self.db._write_rows(rows)
+            except:
+                self.requeue(rows)
+                self.failed_flushes += 1
+                raise
+            
+            if not rows:
+                return 0
+            
+            self.last_flush_time = time.perf_counter() - start
+            self.written += len(rows)
+            self.flushes += 1
+        
+        return len(rows)
+    
+    def _write_each(self, rows):
+        """
+        Writes rows one at a time inside the flush's transaction. Returns the
+        rows that were written.
+        """
+        written = {}
+        for key, row in rows.items():
+            try:
+                with self.db.transaction():
+                    self.db._write_rows({key: row})
+            except Exception as e:
+                print('Write behind couldn\'t write a {} row, moved it to '
+                      'dead_rows: {}'.format(key[0], e))
+                with self._cond:
+                    self.dead_rows[key] = row
+            else:
+                written[key] = row
+        
+        return written
+    
+    def close(self):
+        """
+        Stops the writer and writes out everything still queued.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+            thread = self._thread
+        
+        if thread is not None:
+            thread.join()
+        
+        self.flush()
+    
+    def _run(self):
+        """
+        Writer loop.
+        """
+        cond = self._cond
+        failures = 0
+        while True:
+            with cond:
+                cond.wait_for(lambda: self._pending or self.closed)
+                if self.closed:
+                    return
+                
+                # Give rows a chance to pile up so they're written together
+                cond.wait_for(lambda: len(self._pending) >= self.batch_rows
+                                      or self.closed,
+                              self.interval)
+            
+            # Write rows one at a time once retrying the batch isn't helping
+            try:
+                self.flush(isolate=failures >= self.max_retries)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print('Write behind flush failed ({} in a row), retrying: {}'
+                        .format(failures, e))
+                time.sleep(self.interval)
+
+class QueryStats:
+    """
+    Counts and times statements by table and operation.
+    
+    Statements slower than slow_ms are printed with their SQL (which only
+    has placeholders, never values) and number of bound parameters.
+    """
+    
+    # Upper bounds (in ms) of the latency histogram buckets, anything slower
+    # than the last one goes in a final overflow bucket
+    buckets = (1, 5, 10, 50, 100, 500, 1000)
+    
+    def __init__(self, slow_ms=100.0):
+        self.slow_ms = slow_ms
+        self.slow = 0
+        
+        # (table, operation) -> [count, total ms, max ms, histogram]
+        self._stats = {}
+        self._lock = threading.Lock()
+    
+    def record(self, table, op, stmt, num_params, elapsed):
+        """
+        Records a statement that took elapsed seconds.
+        """
+        ms = elapsed * 1000
+        
+        # Find the histogram bucket
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                bucket = i
+                break
+        
+        with self._lock:
+            stat = self._stats.get((table, op))
+            if stat is None:
+                stat = [0, 0.0, 0.0, [0] * (len(self.buckets) + 1)]
+                self._stats[(table, op)] = stat
+            
+            stat[0] += 1
+            stat[1] += ms
+            stat[2] = max(stat[2], ms)
+            stat[3][bucket] += 1
+            
+            if ms >= self.slow_ms:
+                self.slow += 1
+        
+        if ms >= self.slow_ms:
+            print('Slow query ({:.1f} ms, {} params): {}'
+                    .format(ms, num_params, stmt))
+    
+    def snapshot(self):
+        """
+        Returns the stats as a JSON friendly dict of
+        {table: {operation: stats}}.
+        """
+        labels = ['<={}ms'.format(b) for b in self.buckets]
+        labels.append('>{}ms'.format(self.buckets[-1]))
+        
+        tables = {}
+        with self._lock:
+            for (table, op), (count, total, most, hist) \
+                    in self._stats.items():
+                tables.setdefault(table, {})[op] = {
+                    'count': count,
+                    'total_ms': round(total, 3),
+                    'mean_ms': round(total / count, 3),
+                    'max_ms': round(most, 3),
+                    'histogram': dict(zip(labels, hist))
+                }
+            
+            return {
+                'slow_ms': self.slow_ms,
+                'slow': self.slow,
+                'tables': tables
+            }
+    
+    def reset(self):
+        """
+        Clears every stat.
+        """
+        with self._lock:
+            self._stats.clear()
+            self.slow = 0
 
 class DBWrapper(metaclass=KeySingleton):
     """
@@ -14,57 +503,438 @@ class DBWrapper(metaclass=KeySingleton):
     database. Ways to use these methods must be defined elsewhere.
 
     name should be the database name excluding '.db'
+    
+    backend is where the database is kept, see backends. 'sqlite' (default)
+    keeps it in a file under filepath, 'memory' keeps it in memory until
+    exit() is called.
+    
+    Connections are pooled, see ConnectionPool. The pool can be configured
+    with the pool_size and pool_check_after arguments.
+    
+    Every method commits on its own unless it's called inside transaction(),
+    in which case everything is committed once at the end of the outermost
+    transaction.
+    
+    profile is the name of the storage profile (see profiles) applied to
+    every connection. Defaults to 'durable'.
+    
+    uuid_format is how UUIDs are stored, 'text' (default) or 'blob'. See
+    convert_uuid_format to migrate an existing database.
+    
+    write_behind turns on the write behind queue used by insert_deferred, see
+    WriteBehindQueue. It's configured with write_behind_interval (seconds),
+    write_behind_rows, write_behind_max and write_behind_retries. It can't
+    be used with the 'memory' backend.
+    
+    Every statement is timed in query_stats, see QueryStats. Statements
+    slower than slow_query_ms (100 by default) are logged.
+    
+    track_changes keeps a counter in the db_changes table that goes up with
+    every commit that changed something, see changes().
     """
     
     def __init__(self, name, **args):
+        backend = args.get('backend', 'sqlite')
+        if backend not in backends:
+            raise ValueError('Unknown storage backend: {}'.format(backend))
+        self.backend = backend
+        
+        # The write behind thread would fail whenever it ran into another
+        # connection's table lock, see _connect_memory
+        if backend == 'memory' and args.get('write_behind', False):
+            raise ValueError('Write behind can\'t be used with the memory '
+                             'backend.')
+        
         # Create db filepath
         self.filepath = args.get('filepath', 'file') + os.path.sep
-        if not os.path.exists(self.filepath):
+        if backend == 'sqlite' and not os.path.exists(self.filepath):
             os.makedirs(self.filepath)
 
         self.name = name
-        self.conn = \
-            lambda: sqlite3.connect(self.filepath + os.path.sep + name + '.db',
-                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        
+        profile = args.get('profile', 'durable')
+        if profile not in profiles:
+            raise ValueError('Unknown storage profile: {}'.format(profile))
+        self.profile = profile
+        
+        self.pool = ConnectionPool(self._connect,
+                                   size=args.get('pool_size', 8),
+                                   check_after=args.get('pool_check_after',
+                                                        30.0))
+        
+        # Per thread transaction state
+        self._local = threading.local()
+        
+        # In memory databases disappear with their last connection, hold one
+        # open until exit()
+        self._keeper = self._connect() if backend == 'memory' else None
+        
+        # Statement timings
+        self.query_stats = QueryStats(args.get('slow_query_ms', 100.0))
+        
+        # Table -> {column name: position}, see _merge_deferred
+        self._column_positions = {}
+        
+        self.track_changes = args.get('track_changes', False)
+        if self.track_changes:
+            with self.pool.connection() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS db_changes '
+                             '(id INTEGER PRIMARY KEY, counter INTEGER)')
+                conn.execute('INSERT OR IGNORE INTO db_changes '
+                             'VALUES (0, 0)')
+                conn.commit()
+        
+        # Rows written by insert_deferred and update_deferred
+        self.write_queue = None
+        if args.get('write_behind', False):
+            self.write_queue = WriteBehindQueue(
+                self,
+                interval=args.get('write_behind_interval', 0.05),
+                batch_rows=args.get('write_behind_rows', 200),
+                max_pending=args.get('write_behind_max', 5000),
+                max_retries=args.get('write_behind_retries', 3))
 
         # Add converter for bool
         sqlite3.register_adapter(bool, int)
         sqlite3.register_converter('BOOLEAN', lambda v: bool(int(v)))
         
-        # Add converter for UUID
-        sqlite3.register_adapter(uuid.UUID, str)
-        sqlite3.register_converter(
-            'UUID', 
-            lambda v: uuid.UUID(str(v, 'utf-8')) if v != b'None' else None
-            )
+        # Add adapter and converter for UUID
+        # Adapters are global to sqlite3 so the format is shared by every
+        # DBWrapper in the process. Converters read both formats.
+        uuid_format = args.get('uuid_format', 'text')
+        if uuid_format not in uuid_adapters:
+            raise ValueError('Unknown UUID format: {}'.format(uuid_format))
+        self.uuid_format = uuid_format
+        sqlite3.register_adapter(uuid.UUID, uuid_adapters[uuid_format])
+        sqlite3.register_converter('UUID', _convert_uuid)
         
         # Add converter for list of UUIDs
         # No adapter because it's impossible to tell sqlite3 we only want to
-        # handle lists of UUIDs
-        def _uuid_list_convert(l):
-            l = json.loads(str(l, 'utf-8'))
-            rv = []
-            for x in l:
-                if x is None:
-                    rv.append(None)
-                else:
-                    rv.append(uuid.UUID(x))
-            return rv
-        sqlite3.register_converter('UUIDLIST', _uuid_list_convert)
+        # handle lists of UUIDs, use dump_uuid_list to store them
+        sqlite3.register_converter('UUIDLIST', _convert_uuid_list)
 
         # Logger
         #self.log = logger.Logger()
     
+    def _connect(self):
+        """
+        Opens a new connection to the database.
+        
+        Connections are shared between threads by the pool, but a connection
+        is only ever used by one thread at a time.
+        """
+        conn = backends[self.backend](self)
+        
+        # Apply storage profile
+        for pragma, value in profiles[self.profile].items():
+            conn.execute('PRAGMA {} = {}'.format(pragma, value))
+        
+        return conn
+    
+    def dump_uuid_list(self, ids):
+        """
+        Dumps a list of UUIDs (or Nones) in the format stored in UUIDLIST
+        columns.
+        """
+        if self.uuid_format == 'blob':
+            return pack_uuids(ids)
+        else:
+            return json.dumps([str(id) if id is not None else None
+                               for id in ids])
+    
+    def convert_uuid_format(self, uuid_format):
+        """
+        Rewrites every UUID and UUIDLIST column of every table in uuid_format
+        and switches this DBWrapper over to it. Safe to run more than once,
+        values already in the right format are left as they are.
+        
+        Columns are found by their declared type so any table made through
+        create_table is converted.
+        """
+        if uuid_format not in uuid_adapters:
+            raise ValueError('Unknown UUID format: {}'.format(uuid_format))
+        
+        # Values reach SQL functions raw, without converters
+        if uuid_format == 'blob':
+            dump_uuid = lambda v: v.bytes
+            dump_list = pack_uuids
+        else:
+            dump_uuid = str
+            dump_list = lambda l: json.dumps([str(id) if id is not None
+                                              else None for id in l])
+        
+        def convert_uuid(v):
+            if v is None:
+                return None
+            u = _convert_uuid(v if isinstance(v, bytes) else v.encode())
+            return dump_uuid(u) if u is not None else None
+        
+        def convert_list(v):
+            if v is None:
+                return None
+            return dump_list(_convert_uuid_list(
+                v if isinstance(v, bytes) else v.encode()))
+        
+        with self.transaction():
+            with self.pool.connection() as conn:
+                conn.create_function('bb_uuid', 1, convert_uuid)
+                conn.create_function('bb_uuid_list', 1, convert_list)
+                
+                tables = conn.execute('SELECT name '
+                                      'FROM sqlite_master '
+                                      'WHERE type=\'table\'').fetchall()
+                for (table,) in tables:
+                    sets = []
+                    for col in conn.execute(
+                            'PRAGMA table_info({})'.format(table)):
+                        if col[2] == 'UUID':
+                            sets.append('{0} = bb_uuid({0})'.format(col[1]))
+                        elif col[2] == 'UUIDLIST':
+                            sets.append('{0} = bb_uuid_list({0})'
+                                            .format(col[1]))
+                    
+                    if sets:
+                        conn.execute('UPDATE {} SET {}'
+                                        .format(table, ', '.join(sets)))
+        
+        self.uuid_format = uuid_format
+        sqlite3.register_adapter(uuid.UUID, uuid_adapters[uuid_format])
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Groups every call made in a with block into one transaction.
+        
+        Transactions can be nested; nested transactions are savepoints that
+        are rolled back on their own if an exception escapes them. Only the
+        outermost transaction commits. If an exception escapes the outermost
+        transaction nothing in it is written.
+        
+        Keep transactions short and don't wait on anything inside them, other
+        writers are blocked until they end.
+        
+        Rows deferred with insert_deferred are only queued once the outermost
+        transaction commits. With write behind on, the outermost transaction
+        takes the write lock as soon as it starts, so queued rows can be
+        taken from the queue (see flush) without a flush writing older ones
+        over them.
+        """
+        local = self._local
+        deferring = self.write_queue is not None
+        
+        with self.pool.connection() as conn:
+            depth = getattr(local, 'depth', 0)
+            savepoint = 'sp{}'.format(depth)
+            
+            if depth == 0:
+                conn.execute('BEGIN IMMEDIATE' if deferring else 'BEGIN')
+                local.total_changes = conn.total_changes
+                if deferring:
+                    # Rows deferred by this transaction
+                    local.buffer = {}
+                    # Rows taken from the queue and written by this
+                    # transaction, as (depth, rows)
+                    local.taken = []
+                    # Deferred rows as they were when each savepoint started
+                    local.saved = []
+            else:
+                conn.execute('SAVEPOINT {}'.format(savepoint))
+                if deferring:
+                    local.saved.append(dict(local.buffer))
+            
+            local.depth = depth + 1
+            try:
+                yield self
+                
+                if depth == 0:
+                    if conn.total_changes != local.total_changes:
+                        self._count_change(conn)
+                    self._timed_commit(conn)
+                else:
+                    conn.execute('RELEASE {}'.format(savepoint))
+            except:
+                if depth == 0:
+                    conn.rollback()
+                else:
+                    conn.execute('ROLLBACK TO {}'.format(savepoint))
+                    conn.execute('RELEASE {}'.format(savepoint))
+                
+                if deferring:
+                    self._undo_deferred(depth)
+                raise
+            finally:
+                local.depth = depth
+        
+        if not deferring:
+            return
+        
+        if depth == 0:
+            # Committed, hand deferred rows over to the queue
+            rows = local.buffer
+            local.buffer = {}
+            local.taken = []
+            if rows:
+                self.write_queue.put_many(rows.items())
+        else:
+            local.saved.pop()
+    
+    def _undo_deferred(self, depth):
+        """
+        Forgets rows deferred by a transaction that rolled back and puts back
+        any queued rows it had written.
+        """
+        local = self._local
+        
+        if depth == 0:
+            local.buffer = {}
+        else:
+            local.buffer = local.saved.pop()
+        
+        while local.taken and local.taken[-1][0] > depth:
+            self.write_queue.requeue(local.taken.pop()[1])
+    
+    def in_transaction(self):
+        """
+        Returns whether or not this thread is inside transaction().
+        """
+        return getattr(self._local, 'depth', 0) > 0
+    
+    def _commit(self, conn):
+        """
+        Commits unless this thread is inside transaction().
+        """
+        if not self.in_transaction():
+            # Only open if something was written
+            if conn.in_transaction:
+                self._count_change(conn)
+            self._timed_commit(conn)
+    
+    def _count_change(self, conn):
+        """
+        Bumps the change counter as part of the commit about to be made.
+        """
+        if self.track_changes:
+            conn.execute('UPDATE db_changes SET counter = counter + 1')
+    
+    def changes(self):
+        """
+        Returns the change counter, which goes up with every commit that
+        changes something. Only kept if track_changes was set.
+        
+        Read it inside transaction() to get the counter for exactly the data
+        read in the same transaction.
+        """
+        if not self.track_changes:
+            raise ValueError('Changes aren\'t tracked.')
+        
+        self.flush()
+        
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT counter FROM db_changes').fetchone()[0]
+    
+    def _timed_commit(self, conn):
+        """
+        Commits, recording how long it took.
+        """
+        start = time.perf_counter()
+        conn.commit()
+        self.query_stats.record('*', 'commit', 'COMMIT', 0,
+                                time.perf_counter() - start)
+    
+    def _rollback(self, conn):
+        """
+        Rolls back unless this thread is inside transaction(), in which case
+        the transaction is left to roll itself back.
+        """
+        if not self.in_transaction():
+            conn.rollback()
+    
     def exit(self):
         """
         Prepares for exit.
         """
         #self.log.log('Closing {} db.'.format(self.name))
-
-        # Used to have a single instance of connection, now threads generate
-        # their own connections
-        #self.conn.close()
-        pass
+        if self.write_queue is not None:
+            self.write_queue.close()
+        self.pool.close()
+        if self._keeper is not None:
+            self._keeper.close()
+    
+    def flush(self):
+        """
+        Writes out every row deferred with insert_deferred. Inside
+        transaction() they're written as part of the transaction.
+        
+        Every other read and write method calls this first so they always see
+        deferred rows and never get overwritten by older ones.
+        """
+        queue = self.write_queue
+        if queue is None:
+            return
+        
+        if not self.in_transaction():
+            queue.flush()
+            return
+        
+        local = self._local
+        if not local.buffer and not queue.depth:
+            return
+        
+        # Queued rows are older than this transaction's. This transaction
+        # holds the write lock so no flush can be writing any of them; waiting
+        # on flush_lock here could deadlock with a flush waiting on the lock.
+        taken = queue.take()
+        if taken:
+            local.taken.append((local.depth, taken))
+            self._write_rows(taken)
+        
+        self._write_rows(local.buffer)
+        local.buffer = {}
+    
+    def _write_rows(self, rows):
+        """
+        Writes rows from the write behind queue, a dict of
+        (table, key) -> row or column update.
+        """
+        inserts = {}
+        updates = {}
+        for (table, _), row in rows.items():
+            if isinstance(row, _Update):
+                updates.setdefault(table, []).append((row.key, row.values))
+            else:
+                inserts.setdefault(table, []).append(row)
+        
+        for table, tableRows in inserts.items():
+            self._insert_many(table, tableRows)
+        
+        for table, tableUpdates in updates.items():
+            self._update_many(table, tableUpdates)
+    
+    def _merge_deferred(self, table, old, new):
+        """
+        Merges a deferred row or column update into the one deferred before it
+        for the same row. Either can be None.
+        """
+        if new is None:
+            return old
+        if old is None or not isinstance(new, _Update):
+            return new
+        
+        if isinstance(old, _Update):
+            values = dict(old.values)
+            values.update(new.values)
+            return _Update(old.key, values)
+        
+        # Apply the update to the full row
+        positions = self._column_positions.get(table)
+        if positions is None:
+            positions = {c: i for i, c in enumerate(self.table_columns(table))}
+            self._column_positions[table] = positions
+        
+        row = list(old)
+        for col, value in new.values.items():
+            row[positions[col]] = value
+        return tuple(row)
         
     def table_exists(self, table_name):
         """
@@ -76,15 +946,12 @@ class DBWrapper(metaclass=KeySingleton):
                 'WHERE type=\'table\' AND name=?;')
         symbols = (table_name,)
         
-        # Get DB cursor
-        conn = self.conn()
-        curs = conn.cursor()
-        
-        # Get results
-        curs.execute(stmt, symbols)
-        one = curs.fetchone()
-        curs.close()
-        conn.close()
+        # Get DB cursor and results
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            curs.execute(stmt, symbols)
+            one = curs.fetchone()
+            curs.close()
         
         if one is not None:
             return True
@@ -95,32 +962,34 @@ class DBWrapper(metaclass=KeySingleton):
         """
         Returns whether or not a column exists in a table.
         """
-        # Prep statement and symbols
-        stmt = ('SELECT ? '
-                'FROM ? ')
-        symbols = (table_name, row_name)
-        
-        # Get DB cursor
-        conn = self.conn()
-        curs = conn.cursor()
+        return row_name in self.table_columns(table_name)
+    
+    def table_columns(self, table_name):
+        """
+        Returns the list of column names of a table, in order.
+        """
+        # Table names can't be parameterized, PRAGMA arguments neither
+        stmt = 'PRAGMA table_info({})'.format(table_name)
         
-        # Get results
-        curs.execute(stmt, symbols)
-        one = curs.fetchone()
-        curs.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            curs.execute(stmt)
+            rows = curs.fetchall()
+            curs.close()
         
-        if one is not None:
-            return True
-        else:
-            return False
+        # Rows are (cid, name, type, notnull, default, pk)
+        return [r[1] for r in rows]
 
-    def create_table(self, name, field_names, field_types, primary_name):
+    def create_table(self, name, field_names, field_types, primary_name,
+                     indexes = None):
         """
         Creates a table.
         
         Doesn't do fancy injection prevention because table names can't
         be paramaterized.
+        
+        Indexes is a list of secondary indexes to create with the table, see
+        create_indexes.
         """
         # Ensure that all fields are typed
         if len(field_types) != len(field_names):
@@ -151,16 +1020,53 @@ class DBWrapper(metaclass=KeySingleton):
 
         #self.log.log('Create statement: {}'.format(stmt))
         
-        conn = self.conn()
-        curs = conn.cursor()
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            curs.execute(stmt)
+            self._commit(conn)
+            curs.close()
+        
+        if indexes:
+            self.create_indexes(name, indexes)
+    
+    def create_indexes(self, table, indexes):
+        """
+        Creates secondary indexes on a table if they don't exist yet. Safe to
+        call on every startup so existing databases pick up new indexes.
+        
+        Indexes is a list of strings of comma separated column names, in the
+        same format as create_table's primary_name (e.g. "steamId" or
+        "tournamentId, number").
+        """
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            for index in indexes:
+                cols = [c.strip() for c in index.split(',')]
+                stmt = ('CREATE INDEX IF NOT EXISTS {}_{}_idx '
+                        'ON {} ({})').format(table, '_'.join(cols), table,
+                                             ', '.join(cols))
+                
+                #self.log.log('Index statement: {}'.format(stmt))
+                curs.execute(stmt)
+            self._commit(conn)
+            curs.close()
+    
+    def drop_table(self, name):
+        """
+        Drops a table, along with its indexes.
+        """
+        stmt = 'DROP TABLE {}'.format(name)
         
-        curs.execute(stmt)
+        #self.log.log('Drop statement: {}'.format(stmt))
         
-        conn.commit()
-        curs.close()
-        conn.close()
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            curs.execute(stmt)
+            self._commit(conn)
+            curs.close()
     
-    def select_values(self, table, col_names, conditions, unsafe = None):
+    def select_values(self, table, col_names, conditions, unsafe = None,
+                      params = None, distinct = False):
         """
         Selects values from a table.
         Col_names is a list of strings that name a column in the table (these
@@ -169,39 +1075,159 @@ class DBWrapper(metaclass=KeySingleton):
         SQL condition (e.g. "col_name = 100"). These should be sql-safe (i.e.
         generated by you and known to not contain sql injects).
         Unsafe are unsafe conditions that need to be checked for safety.
+        Params are values bound to '?' placeholders in conditions (e.g.
+        "col_name = ?"). Prefer these to formatting values into conditions,
+        the statement can then be reused for any value.
+        Distinct leaves out duplicate rows.
         """
-        col_str = ', '.join(['{}'] * len(col_names)).format(*col_names)
-        if conditions or unsafe:
-            num_conds = 0
-            if conditions:
-                num_conds += len(conditions)
-            if unsafe:
-                num_conds += len(unsafe)
-            
-            cond_str = ' AND '.join(['{}'] * num_conds)
+        self.flush()
+        
+        stmt, symbol_list = self._select_args(table, col_names, conditions,
+                                              unsafe, params, distinct)
+        
+        # Get cursor and execute the statement
+        with self.pool.connection() as conn:
+            start = time.perf_counter()
+            curs = conn.cursor()
+            curs.execute(stmt, symbol_list)
             
-            # Format column names, table name, and conditions format string
-            stmt = ('SELECT {} '
-                    'FROM {} '
-                    'WHERE {}').format(col_str, table, cond_str)
+            # Return all results
+            rows = curs.fetchall()
+            curs.close()
+            self.query_stats.record(table, 'select', stmt, len(symbol_list),
+                                    time.perf_counter() - start)
+        
+        return rows
+    
+    def iter_values(self, table, col_names, conditions, unsafe = None,
+                    params = None, arraysize = None):
+        """
+        Selects values from a table like select_values, but yields rows as
+        they're read instead of returning them all in a list. Rows are
+        fetched arraysize (FETCH_SIZE by default) at a time so memory use
+        stays flat however many rows match. Only select the columns you need.
+        
+        The connection is held until the generator is exhausted or closed,
+        so iterate over it straight away rather than keeping it around.
+        """
+        self.flush()
+        
+        stmt, symbol_list = self._select_args(table, col_names, conditions,
+                                              unsafe, params)
+        
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            curs.arraysize = arraysize or FETCH_SIZE
             
-            # Generate list of items to format into conditions format string
-            final_conds = []
-            if conditions:
-                final_conds.extend(conditions)
-            if unsafe:
-                final_conds.extend(['?'] * len(unsafe))
+            # Only time spent in the database counts, not time spent by the
+            # caller between rows
+            elapsed = 0.0
+            try:
+                start = time.perf_counter()
+                curs.execute(stmt, symbol_list)
+                elapsed += time.perf_counter() - start
+                while True:
+                    start = time.perf_counter()
+                    rows = curs.fetchmany()
+                    elapsed += time.perf_counter() - start
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                curs.close()
+                self.query_stats.record(table, 'select', stmt,
+                                        len(symbol_list), elapsed)
+    
+    def select_in(self, table, col_names, column, values, chunk_size = None):
+        """
+        Selects the rows of a table where column is any of values, with one
+        statement per chunk_size (IN_CHUNK_SIZE by default) values instead of
+        one per value.
+        
+        Returns a list of rows in no particular order.
+        """
+        values = list(values)
+        chunk_size = chunk_size or IN_CHUNK_SIZE
+        if not values:
+            return []
+        
+        self.flush()
+        
+        rows = []
+        with self.pool.connection() as conn:
+            for i in range(0, len(values), chunk_size):
+                chunk = values[i:i + chunk_size]
+                
+                # Pad short chunks with repeats so there's only ever one
+                # statement per chunk size to compile and cache
+                size = min(chunk_size, len(values))
+                chunk.extend(chunk[-1:] * (size - len(chunk)))
+                
+                stmt = _select_stmt(table, tuple(col_names),
+                                    (_in_condition(column, size),), 0)
+                start = time.perf_counter()
+                rows.extend(conn.execute(stmt, chunk).fetchall())
+                self.query_stats.record(table, 'select', stmt, size,
+                                        time.perf_counter() - start)
+        
+        return rows
+    
+    def iter_in(self, table, col_names, column, values, chunk_size = None,
+                arraysize = None):
+        """
+        Selects the rows of a table where column is any of values like
+        select_in, but yields them as they're read like iter_values.
+        """
+        values = list(values)
+        chunk_size = chunk_size or IN_CHUNK_SIZE
+        
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
             
-            # Format in safe conditions and symbol for unsafe conditions
-            stmt = stmt.format(*final_conds)
+            # Padded like in select_in
+            size = min(chunk_size, len(values))
+            chunk.extend(chunk[-1:] * (size - len(chunk)))
             
-        else:
-            # Format table name and condition format string
-            stmt = ('SELECT {} '
-                    'FROM {}').format(col_str, table)
+            yield from self.iter_values(table, col_names,
+                                        [_in_condition(column, size)],
+                                        params = chunk, arraysize = arraysize)
+    
+    def row_exists(self, table, conditions, params = None):
+        """
+        Returns whether or not any row in table matches conditions. Only reads
+        as far as the first matching row, so use this instead of
+        select_values when the values themselves aren't needed.
+        
+        Conditions and params work the same way as in select_values.
+        """
+        self.flush()
+        
+        stmt = _exists_stmt(table, tuple(conditions) if conditions else ())
+        
+        with self.pool.connection() as conn:
+            start = time.perf_counter()
+            row = conn.execute(stmt, params or []).fetchone()
+            self.query_stats.record(table, 'exists', stmt,
+                                    len(params) if params else 0,
+                                    time.perf_counter() - start)
+        
+        return row is not None
+    
+    def _select_args(self, table, col_names, conditions, unsafe, params,
+                     distinct = False):
+        """
+        Builds the statement and values for a select.
+        """
+        stmt = _select_stmt(table,
+                            tuple(col_names),
+                            tuple(conditions) if conditions else (),
+                            len(unsafe) if unsafe else 0,
+                            distinct)
 
         # Build list that will be used to as values for statement execution
         symbol_list = []
+        if params:
+            symbol_list.extend(params)
         if unsafe:
             symbol_list.extend(unsafe)
         
@@ -209,17 +1235,7 @@ class DBWrapper(metaclass=KeySingleton):
         #print('Select statement: {}, {}'
         #    .format(stmt, stmt.replace('?', '{}').format(*symbol_list)))
         
-        # Get cursor and execute the statement
-        conn = self.conn()
-        curs = conn.cursor()
-        curs.execute(stmt, symbol_list)
-        
-        # Return all results
-        rows = curs.fetchall()
-        curs.close()
-        conn.close()
-        
-        return rows
+        return stmt, symbol_list
     
     def insert_values(self, table, values, ignore=False):
         """
@@ -227,71 +1243,424 @@ class DBWrapper(metaclass=KeySingleton):
         
         Values is a list of tuples of the values for each row.
         """
-        temp_strs = []
-        for val in values:
-            # Create and format the string for each set of values to
-            # insert
-            val_str = '(' + ', '.join('?' * len(val)) + ')'
-            
-            # Append to list of sets of values
-            temp_strs.append(val_str)
+        self.insert_many(table, values, ignore)
+    
+    def insert_many(self, table, values, ignore=False, chunk_size=None):
+        """
+        Inserts many rows into a table in a single transaction.
+        
+        Values is an iterable of tuples of the values for each row. Rows are
+        sent to executemany in chunks of chunk_size (CHUNK_SIZE by default) so
+        any number of rows can be written without building one huge statement
+        or holding a generator's output in memory.
+        """
+        self.flush()
+        self._insert_many(table, values, ignore, chunk_size)
+    
+    def _insert_many(self, table, values, ignore=False, chunk_size=None):
+        """
+        insert_many without flushing deferred rows first.
+        """
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        
+        rows = iter(values)
+        
+        #self.log.log('Insert statement: {}'.format(stmt))
         
-        vals_str = ', '.join(temp_strs) # Drop the last ', '
+        # Execute the statement for every chunk
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            try:
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    
+                    stmt = _insert_stmt(table, len(chunk[0]), ignore)
+                    start = time.perf_counter()
+                    curs.executemany(stmt, chunk)
+                    self.query_stats.record(table, 'insert', stmt,
+                                            len(chunk) * len(chunk[0]),
+                                            time.perf_counter() - start)
+                self._commit(conn)
+            except:
+                self._rollback(conn)
+                raise
+            finally:
+                curs.close()
 
-        if ignore:
-            stmt = ('INSERT OR IGNORE INTO {} '
-                    'VALUES {}').format(table, vals_str)
+    def insert_deferred(self, table, values, key_len=1):
+        """
+        Inserts rows into a table through the write behind queue so the
+        caller doesn't wait for them to be written.
+        
+        Rows are coalesced by their first key_len values (the primary key),
+        only the last row deferred for a key is written. Inside transaction()
+        rows are held back until the outermost transaction commits and are
+        dropped if it rolls back.
+        
+        Without a write behind queue this is just insert_many.
+        """
+        if self.write_queue is None:
+            self.insert_many(table, values)
+            return
+        
+        entries = [((table, tuple(row[:key_len])), row) for row in values]
+        
+        self._defer(entries)
+    
+    def update_columns(self, table, key, values):
+        """
+        Updates some columns of one row.
+        
+        Key is a dict of the primary key columns of the row and their values.
+        Values is a dict of column names and their new values.
+        
+        Returns the number of rows updated, 0 if the row doesn't exist.
+        """
+        self.flush()
+        return self._update_many(table, [(key, values)])
+    
+    def update_deferred(self, table, key, values):
+        """
+        update_columns through the write behind queue, see insert_deferred.
+        Updates are merged into anything already deferred for the row.
+        
+        Without a write behind queue this is just update_columns.
+        """
+        if self.write_queue is None:
+            self.update_columns(table, key, values)
+            return
+        
+        self._defer([((table, tuple(key.values())), _Update(key, values))])
+    
+    def _defer(self, entries):
+        """
+        Hands deferred entries to the queue, or holds them until the current
+        transaction commits.
+        """
+        if self.in_transaction():
+            buffer = self._local.buffer
+            for key, row in entries:
+                buffer[key] = self._merge_deferred(key[0], buffer.get(key),
+                                                   row)
         else:
-            stmt = ('INSERT OR REPLACE INTO {} '
-                    'VALUES {}').format(table, vals_str)
-                    
-        # Build list that will be used to as symbols for statement execution
-        symbol_list = []
-        for v in values:
-            symbol_list.extend(v)
+            self.write_queue.put_many(entries)
+    
+    def _update_many(self, table, updates):
+        """
+        Runs column updates, a list of (key, values) as in update_columns.
+        Updates of the same columns are sent to executemany together.
         
-        #self.log.log('Insert statement: {}'.format(stmt))
-        #print('Insert statement: {}'
-        #    .format(stmt.replace('?', '{}').format(*symbol_list)))
+        Returns the number of rows updated.
+        """
+        groups = {}
+        for key, values in updates:
+            shape = (tuple(values), tuple(key))
+            groups.setdefault(shape, []).append(
+                tuple(values.values()) + tuple(key.values()))
         
-        # Execute the statement
-        conn = self.conn()
-        curs = conn.cursor()
-        curs.execute(stmt, symbol_list)
-        conn.commit()
-        curs.close()
-        conn.close()
+        count = 0
+        with self.pool.connection() as conn:
+            curs = conn.cursor()
+            try:
+                for (cols, keyCols), params in groups.items():
+                    stmt = _update_stmt(table, cols, keyCols)
+                    start = time.perf_counter()
+                    curs.executemany(stmt, params)
+                    self.query_stats.record(table, 'update', stmt,
+                                            len(params) * len(params[0]),
+                                            time.perf_counter() - start)
+                    count += curs.rowcount
+                self._commit(conn)
+            except:
+                self._rollback(conn)
+                raise
+            finally:
+                curs.close()
+        
+        return count
 
-    def delete_values(self, table, conditions):
+    def delete_values(self, table, conditions, params = None):
         """
         Deletes values from table using conditions
         
         This is potentially unsafe. Please consider your conditions and whether
-        or not they could have bad values in them.
+        or not they could have bad values in them. Values can instead be bound
+        to '?' placeholders in conditions with params.
         """
+        self.flush()
         
-        if conditions:
-            cond_str = '{}' + ' AND {}' * (len(conditions) - 1)
-            
-            # Format table name and extra format strings
-            stmt = ('DELETE FROM {} '
-                    'WHERE {}').format(table, cond_str)
-            
-            # Format the conditions into the new format string
-            stmt = stmt.format(*conditions)
-            
-        else:
-            # Format table name format string
-            stmt = 'DELETE FROM {}'.format(table)
+        stmt = _delete_stmt(table, tuple(conditions) if conditions else ())
 
         #self.log.log('Delete statement: {}'.format(stmt))
         
         # Get cursor and execute the statement
-        conn = self.conn()
-        curs = conn.cursor()
-        curs.execute(stmt)
+        with self.pool.connection() as conn:
+            start = time.perf_counter()
+            curs = conn.cursor()
+            curs.execute(stmt, params or [])
+            self.query_stats.record(table, 'delete', stmt,
+                                    len(params) if params else 0,
+                                    time.perf_counter() - start)
+            
+            # Commit
+            self._commit(conn)
+            curs.close()
+    
+    def backup(self, dest, pages=100, pause=0.01, max_restarts=3):
+        """
+        Copies the database to the file dest while it's in use, with SQLite's
+        online backup.
         
-        # Commit
-        conn.commit()
-        curs.close()
-        conn.close()
+        pages are copied at a time, sleeping for pause seconds in between
+        (which lets other green threads run under eventlet) so writers are
+        never locked out for long. Writes made during the backup restart it,
+        so the copy is always consistent. After max_restarts restarts the
+        pauses are dropped so a busy database still gets backed up.
+        
+        Returns (number of pages copied, seconds taken).
+        """
+        # Deferred rows belong in the copy too
+        self.flush()
+        
+        start = time.perf_counter()
+        copied = 0
+        restarts = 0
+        
+        def progress(status, remaining, total):
+            nonlocal copied, restarts
+            if total - remaining < copied:
+                restarts += 1
+            copied = total - remaining
+            if remaining and pause and restarts < max_restarts:
+                time.sleep(pause)
+        
+        # Use a connection of our own so the backup never shares one with a
+        # transaction on this thread
+        src = self._connect()
+        try:
+            target = sqlite3.connect(dest)
+            try:
+                src.backup(target, pages=pages, progress=progress)
+            finally:
+                target.close()
+        finally:
+            src.close()
+        
+        return copied, time.perf_counter() - start
+
+def app_db():
+    """
+    Returns the application database, set up from the configuration in
+    util. Every manager shares it.
+    """
+    return DBWrapper(util.dbName,
+                     filepath=util.dbPath,
+                     backend=util.dbBackend,
+                     profile=util.dbProfile,
+                     uuid_format=util.dbUuidFormat,
+                     write_behind=util.dbWriteBehind,
+                     write_behind_interval=util.dbWriteBehindInterval / 1000,
+                     write_behind_rows=util.dbWriteBehindRows,
+                     slow_query_ms=util.dbSlowQueryMs,
+                     track_changes=True)
+
+def open_db(name, **args):
+    """
+    Opens a database without sharing it through KeySingleton, for tools that
+    work on a database other than the app's (which may have the same name).
+    Takes the same arguments as DBWrapper, call exit() when done.
+    """
+    return type.__call__(DBWrapper, name, **args)
+
+class _Update:
+    """
+    A deferred update of some columns of one row, see update_deferred.
+    """
+    __slots__ = ('key', 'values')
+    
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+# +-------------------+
+# | Storage backends  |
+# +-------------------+
+# Each backend opens a new connection to a DBWrapper's database. Everything
+# above the connection is shared, so any backend can be swapped in without
+# the managers noticing.
+
+def _connect_sqlite(db):
+    """
+    Connects to a database file.
+    """
+    return sqlite3.connect(db.filepath + os.path.sep + db.name + '.db',
+                           detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+
+def _connect_memory(db):
+    """
+    Connects to an in memory database. Every connection in the process with
+    the same name shares it, so pooled connections all see the same data.
+    
+    Shared memory databases lock whole tables, a connection that tries to
+    write while another one is reading fails instead of waiting (busy_timeout
+    doesn't apply). That's why write behind is refused for this backend.
+    Fine for tests and benchmarks, use 'sqlite' for anything else.
+    """
+    return sqlite3.connect('file:{}?mode=memory&cache=shared'.format(db.name),
+                           uri=True,
+                           detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+
+backends = {
+    'sqlite': _connect_sqlite,
+    'memory': _connect_memory
+}
+
+# +-------------------+
+# | UUID storage      |
+# +-------------------+
+# UUIDs are stored either as 36 character text ('text', the default) or as 16
+# byte blobs ('blob'). Lists of UUIDs are JSON lists of strings or a zero
+# byte followed by the packed 16 byte UUIDs, with None stored as the nil UUID.
+# JSON never starts with a zero byte so the two can't be mixed up.
+
+uuid_adapters = {
+    'text': str,
+    'blob': lambda u: u.bytes
+}
+
+_NIL_BYTES = bytes(16)
+_PACKED_HEADER = b'\x00'
+
+def pack_uuids(ids):
+    """
+    Packs a list of UUIDs (or Nones) into one blob.
+    """
+    return _PACKED_HEADER + b''.join([id.bytes if id is not None else _NIL_BYTES
+                                      for id in ids])
+
+def unpack_uuids(data):
+    """
+    Unpacks a blob made by pack_uuids back into a list of UUIDs (or Nones).
+    """
+    # Split into 64 bit halves in one call and join them back up
+    halves = struct.unpack_from('>{}Q'.format((len(data) - 1) // 8), data, 1)
+    UUID = uuid.UUID
+    return [UUID(int=(hi << 64) | lo) if hi or lo else None
+            for hi, lo in zip(halves[::2], halves[1::2])]
+
+def _convert_uuid(v):
+    """
+    Converts a stored UUID in either format.
+    """
+    if len(v) == 16:
+        return uuid.UUID(bytes=v)
+    elif v == b'None':
+        return None
+    else:
+        return uuid.UUID(v.decode())
+
+def _convert_uuid_list(v):
+    """
+    Converts a stored list of UUIDs in either format.
+    """
+    if v[:1] == _PACKED_HEADER:
+        return unpack_uuids(v)
+    else:
+        UUID = uuid.UUID
+        return [UUID(x) if x is not None else None
+                for x in json.loads(v.decode())]
+
+# +---------------------+
+# | Statement compilers |
+# +---------------------+
+# Statements only depend on the shape of a query (table, columns, conditions
+# and number of rows) so each shape is built once and cached. Identical
+# statement strings also let sqlite3 reuse its prepared statements, see
+# STATEMENT_CACHE_SIZE. Arguments must be hashable.
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _select_stmt(table, col_names, conditions, num_unsafe, distinct = False):
+    """
+    Builds a SELECT statement, SELECT DISTINCT if distinct.
+    """
+    select = 'SELECT DISTINCT' if distinct else 'SELECT'
+    col_str = ', '.join(col_names)
+    
+    # Unsafe conditions are bound as whole conditions
+    all_conds = conditions + ('?',) * num_unsafe
+    if all_conds:
+        return ('{} {} '
+                'FROM {} '
+                'WHERE {}').format(select, col_str, table,
+                                   ' AND '.join(all_conds))
+    else:
+        return ('{} {} '
+                'FROM {}').format(select, col_str, table)
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _in_condition(column, num_values):
+    """
+    Builds a condition that column is any of num_values bound values.
+    """
+    return '{} IN ({})'.format(column, ', '.join(['?'] * num_values))
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _exists_stmt(table, conditions):
+    """
+    Builds a SELECT statement that finds at most one row.
+    """
+    if conditions:
+        return ('SELECT 1 '
+                'FROM {} '
+                'WHERE {} '
+                'LIMIT 1').format(table, ' AND '.join(conditions))
+    else:
+        return ('SELECT 1 '
+                'FROM {} '
+                'LIMIT 1').format(table)
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _insert_stmt(table, row_len, ignore):
+    """
+    Builds an INSERT statement for one row of row_len values. Use with
+    executemany to insert many rows.
+    """
+    vals_str = '(' + ', '.join('?' * row_len) + ')'
+    
+    if ignore:
+        return ('INSERT OR IGNORE INTO {} '
+                'VALUES {}').format(table, vals_str)
+    else:
+        return ('INSERT OR REPLACE INTO {} '
+                'VALUES {}').format(table, vals_str)
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _update_stmt(table, col_names, key_names):
+    """
+    Builds an UPDATE statement.
+    """
+    return ('UPDATE {} '
+            'SET {} '
+            'WHERE {}').format(table,
+                               ', '.join(['{} = ?'.format(c)
+                                          for c in col_names]),
+                               ' AND '.join(['{} = ?'.format(k)
+                                             for k in key_names]))
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _delete_stmt(table, conditions):
+    """
+    Builds a DELETE statement.
+    """
+    if conditions:
+        return ('DELETE FROM {} '
+                'WHERE {}').format(table, ' AND '.join(conditions))
+    else:
+        return 'DELETE FROM {}'.format(table)
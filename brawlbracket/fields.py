@@ -0,0 +1,41 @@
+from operator import attrgetter
+
+# Model attributes that are written to the database when they're set.
+#
+# Models list them in _trackedFields and keep their values in slots named by
+# slotNames, then the tracked class decorator puts a property in front of
+# each slot. Setting one stores the value and calls the model's _dbCallback
+# with the attribute's name, if it has one. Reading one goes straight to the
+# slot. Attributes that aren't tracked (e.g. how many connections a player
+# has) are plain slots and never call back.
+
+def slotNames(fields):
+    """
+    Get the names of the slots that hold tracked fields, for __slots__.
+    """
+    return tuple('_slot_' + name for name in fields)
+
+def tracked(cls):
+    """
+    Class decorator that makes the attributes in cls._trackedFields call
+    cls._dbCallback when they're set. The class needs a _dbCallback slot,
+    set to None until it should be called.
+    """
+    for name, slot in zip(cls._trackedFields, slotNames(cls._trackedFields)):
+        setter = _makeSetter(cls.__dict__[slot].__set__, name)
+        setattr(cls, name, property(attrgetter(slot), setter))
+    
+    return cls
+
+def _makeSetter(set, name):
+    """
+    Makes the setter of a tracked attribute, set stores the value in its
+    slot.
+    """
+    def setField(obj, value):
+        set(obj, value)
+        callback = obj._dbCallback
+        if callback is not None:
+            callback(obj, name)
+    
+    return setField
@@ -0,0 +1,112 @@
+import json
+import datetime
+
+from brawlbracket import db_wrapper
+
+# Append only log of lobby actions, kept as an audit trail. Tournaments are
+# still loaded from the match rows, which are written in the same transaction
+# as each event, so the log doesn't store the state of matches again.
+
+# Last event number of each tournament, {tournament id: seq}
+_lastSeqs = {}
+
+_db = None
+
+def logEvent(tournament, match, action, user = None, data = None):
+    """
+    Append an event to the log.
+    tournament: The tournament it happened in (Tournament)
+    match: The match it happened in (Match)
+    action: What happened, e.g. 'pick legend' (string)
+    user: Who did it, None for the server (User)
+    data: What the action was given, must be JSON serializable (dict)
+    
+    Returns the event's number.
+    """
+    if _db is None:
+        _initDB()
+    
+    seq = _getLastSeq(tournament.id) + 1
+    _lastSeqs[tournament.id] = seq
+    
+    eventData = (
+        tournament.id,
+        seq,
+        match.id,
+        user.id if user is not None else None,
+        datetime.datetime.now().isoformat(),
+        action,
+        json.dumps(data if data is not None else {})
+        )
+    _db.insert_deferred('match_events', [eventData], key_len=2)
+    
+    return seq
+
+def getEvents(tournamentId, afterSeq = 0):
+    """
+    Get the events of a tournament after event number afterSeq, in order.
+    
+    Returns a list of dicts with the keys seq, matchId, userId, time, action
+    and data.
+    """
+    if _db is None:
+        _initDB()
+    
+    rows = _db.select_values(
+        'match_events',
+        ['seq', 'matchId', 'userId', 'time', 'action', 'data'],
+        ['tournamentId = ?', 'seq > ?'],
+        params = [tournamentId, afterSeq])
+    rows.sort(key = lambda r: r[0])
+    
+    return [{'seq': seq,
+             'matchId': matchId,
+             'userId': userId,
+             'time': time,
+             'action': action,
+             'data': json.loads(data)}
+            for seq, matchId, userId, time, action, data in rows]
+
+def _getLastSeq(tournamentId):
+    """
+    Get the number of a tournament's last event, 0 if there are none.
+    """
+    if tournamentId not in _lastSeqs:
+        rows = _db.select_values(
+            'match_events',
+            ['MAX(seq)'],
+            ['tournamentId = ?'],
+            params = [tournamentId])
+        _lastSeqs[tournamentId] = rows[0][0] or 0
+    
+    return _lastSeqs[tournamentId]
+
+def _initDB():
+    print('----INIT MATCH LOG DATABASE----')
+    # Need to global because _db is not local to this context
+    global _db
+    _db = db_wrapper.app_db()
+    
+    # Make events table
+    if not _db.table_exists('match_events'):
+        fieldNames = [
+            'tournamentId',
+            'seq',
+            'matchId',
+            'userId',
+            'time',
+            'action',
+            'data'
+            ]
+        fieldTypes = [
+            'UUID',
+            'INTEGER',
+            'UUID',
+            'UUID',
+            'TEXT',
+            'TEXT',
+            'TEXT'
+            ]
+        
+        _db.create_table('match_events', fieldNames, fieldTypes,
+                         'tournamentId, seq')
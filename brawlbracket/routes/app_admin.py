@@ -4,12 +4,14 @@ from flask import session
 from flask import redirect
 from flask import url_for
 from flask import render_template
+from flask import request
 from flask import abort
 from flask import g
 
 from brawlbracket.app import app
 from brawlbracket import usermanager as um
 from brawlbracket import tournamentmanager as tm
+from brawlbracket import backup
 
 from brawlbracket.viewdecorators import *
 
@@ -129,4 +131,20 @@ def data_users():
         'data': condensedData
     }
     
-    return json.dumps(ajaxData)
\ No newline at end of file
+    return json.dumps(ajaxData)
+    
+# Database stats
+@app.route('/app-data/db-stats')
+@app_admin_only
+def data_db_stats():
+    return json.dumps(tm.getDBStats())
+    
+# Database backups, POST to start one
+@app.route('/app-data/db-backups', methods=['GET', 'POST'])
+@app_admin_only
+def data_db_backups():
+    if request.method == 'POST':
+        started = backup.startBackupDB()
+        return json.dumps({'started': started}), 202 if started else 409
+    
+    return json.dumps(backup.getStatus())
@@ -66,13 +66,14 @@ def register():
             break
 
     if not existing:
-        team = g.tournament.createTeam(
-            len(g.tournament.teams) + 1,
-            name = g.user.username)
-        
-        player = g.tournament.createPlayer(g.user)
-        
-        team.addPlayer(player)
+        with tm.transaction():
+            team = g.tournament.createTeam(
+                len(g.tournament.teams) + 1,
+                name = g.user.username)
+            
+            player = g.tournament.createPlayer(g.user)
+            
+            team.addPlayer(player)
         
         print('ADDED TEAM: {}, PLAYERS: {}'.format(team, team.players))
         print('TOURNAMENT NOW HAS {} TEAMS'.format(len(g.tournament.teams)))
@@ -91,7 +92,8 @@ def finalize():
     
     print('FINALIZING TOURNAMENT')
     print('Tournament has {} users!'.format(len(g.tournament.teams)))
-    g.tournament.generateMatches()
+    with tm.transaction():
+        g.tournament.generateMatches()
     print(g.tournament)
     print('Tournament has {} matches!'.format(len(g.tournament.matches)))
     
@@ -11,6 +11,7 @@ from flask_socketio import emit
 from brawlbracket.app import socketio
 from brawlbracket import usermanager as um
 from brawlbracket import tournamentmanager as tm
+from brawlbracket import matchlog
 
 print('Registering tournamentio routes...')
 
@@ -74,8 +75,12 @@ def user_connect():
     # Affect match state
     g.player.online += 1
     
+    # Keep the tournament loaded while connected
+    g.tournament.connections += 1
+    
     # XXX update state, put in listener
-    g.match._updateState()
+    with tm.transaction():
+        g.match._updateState()
     
     # Join new room
     session['matchId'] = g.match.id
@@ -129,10 +134,12 @@ def user_connect():
 def user_disconnect():
     # Affect state
     g.player.online -= 1
+    g.tournament.connections -= 1
     
     if g.match is not None:
         # XXX update state, put in listener
-        g.match._updateState()
+        with tm.transaction():
+            g.match._updateState()
     # Match is none, player was eliminated
     else:
         return
@@ -153,8 +160,11 @@ def user_disconnect():
 @socketio.on('pick legend', namespace='/tournament')
 @require_tourney_data
 def pick_legend(data):
-    g.player.currentLegend = data['legendId']
-    g.match._updateState()
+    with tm.transaction():
+        g.player.currentLegend = data['legendId']
+        g.match._updateState()
+        matchlog.logEvent(g.tournament, g.match, 'pick legend', g.user,
+                          {'legendId': data['legendId']})
     
     lobbyData = g.match.lobbyData
     updatedLobbyData = {}
@@ -170,8 +180,11 @@ def pick_legend(data):
 @socketio.on('ban realm', namespace='/tournament')
 @require_tourney_data
 def ban_realm(data):
-    g.match.addRealmBan(data['realmId'])
-    g.match._updateState()
+    with tm.transaction():
+        g.match.addRealmBan(data['realmId'])
+        g.match._updateState()
+        matchlog.logEvent(g.tournament, g.match, 'ban realm', g.user,
+                          {'realmId': data['realmId']})
     
     lobbyData = g.match.lobbyData
     updatedLobbyData = {}
@@ -187,8 +200,11 @@ def ban_realm(data):
 @socketio.on('pick realm', namespace='/tournament')
 @require_tourney_data
 def pick_realm(data):
-    g.match.currentRealm = data['realmId']
-    g.match._updateState()
+    with tm.transaction():
+        g.match.currentRealm = data['realmId']
+        g.match._updateState()
+        matchlog.logEvent(g.tournament, g.match, 'pick realm', g.user,
+                          {'realmId': data['realmId']})
     
     lobbyData = g.match.lobbyData
     updatedLobbyData = {}
@@ -203,8 +219,11 @@ def pick_realm(data):
 @socketio.on('set room', namespace='/tournament')
 @require_tourney_data
 def select_room(data):
-    g.match.roomNumber = data['roomNumber']
-    g.match._updateState()
+    with tm.transaction():
+        g.match.roomNumber = data['roomNumber']
+        g.match._updateState()
+        matchlog.logEvent(g.tournament, g.match, 'set room', g.user,
+                          {'roomNumber': data['roomNumber']})
     
     lobbyData = g.match.lobbyData
     updatedLobbyData = {}
@@ -220,9 +239,12 @@ def select_room(data):
 @socketio.on('report win', namespace='/tournament')
 @require_tourney_data
 def report_win(data):
-    g.match.incrementScore(data['teamIndex'])
-    
-    g.match._updateState()
+    # One commit for the match, the next match and the eliminated team
+    with tm.transaction():
+        g.match.incrementScore(data['teamIndex'])
+        g.match._updateState()
+        matchlog.logEvent(g.tournament, g.match, 'report win', g.user,
+                          {'teamIndex': data['teamIndex']})
     
     lobbyData = g.match.lobbyData
     updatedLobbyData = {}
@@ -0,0 +1,205 @@
+import os
+import stat
+import mmap
+import marshal
+import struct
+import threading
+import time
+import uuid
+import zlib
+from functools import lru_cache
+
+from brawlbracket import db_wrapper
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import usermanager as um
+from brawlbracket import chatmanager as cm
+from brawlbracket import util
+
+# Snapshots of the loaded tournaments so a restart doesn't have to read them
+# from the database table by table.
+#
+# A snapshot holds the rows tournamentmanager reads to build tournaments (see
+# tm._readTournaments), and loading one builds them the same way warming up
+# does. The database's change counter (see DBWrapper.changes) is read in the
+# same transaction as the rows, and a snapshot is only used if the counter
+# hasn't moved since. It's also only used if the same columns are read, see
+# _schemaVersion.
+#
+# Rows are stored with marshal, which only holds plain values (UUIDs are
+# stored as their 16 bytes) so loading one can't run code. marshal isn't
+# meant for data from anyone else though, so the file is written readable by
+# the server's user only and isn't loaded if anyone else can write to it.
+#
+# File layout, little endian:
+#   magic (8 bytes), schema version (4), change counter (8), payload length
+#   (8), payload CRC32 (4)
+#   payload: marshal of the rows
+
+_MAGIC = b'BBSNAP\x00\x04'
+_HEADER = struct.Struct('<8sIQQI')
+
+# Scheduled snapshot thread, see startSchedule
+_thread = None
+
+# Held while a snapshot is written
+_lock = threading.Lock()
+
+def writeSnapshot():
+    """
+    Write a snapshot of every loaded tournament to util.snapshotPath.
+    
+    Returns the number of tournaments in it.
+    """
+    db = db_wrapper.app_db()
+    
+    with _lock:
+        start = time.perf_counter()
+        
+        # Write out deferred rows first, writing them inside the transaction
+        # would move the counter on past the snapshot
+        db.flush()
+        
+        # Anything changed after the counter is read moves it on, so the
+        # snapshot is never used with changes it might have missed
+        with db.transaction():
+            counter = db.changes()
+            
+            # Tournaments that are only headers aren't worth keeping
+            ids = [t.id for t in list(tm._tournaments.values()) if t.loaded]
+            rows = tm._readTournaments(ids) if ids else None
+        
+        payload = marshal.dumps(_pack(rows))
+        header = _HEADER.pack(_MAGIC, _schemaVersion(), counter,
+                              len(payload), zlib.crc32(payload))
+        
+        # Write to a temporary file first so a half written snapshot never
+        # replaces a good one
+        partPath = util.snapshotPath + '.part'
+        fd = os.open(partPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with open(fd, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(partPath, util.snapshotPath)
+        
+        count = len(rows['tournaments']) if rows is not None else 0
+        print('Wrote snapshot of {} tournaments ({} KiB in {:.2f} s)'
+                .format(count, len(payload) // 1024,
+                        time.perf_counter() - start))
+        
+        return count
+
+def loadSnapshot():
+    """
+    Load the tournaments in the snapshot at util.snapshotPath, if there is
+    one and the database hasn't changed since it was written. Tournaments
+    that are already loaded are left as they are.
+    
+    Returns the number of tournaments loaded, None if the snapshot couldn't
+    be used.
+    """
+    if not os.path.exists(util.snapshotPath) or \
+       os.path.getsize(util.snapshotPath) < _HEADER.size:
+        return None
+    
+    start = time.perf_counter()
+    db = db_wrapper.app_db()
+    
+    with open(util.snapshotPath, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        magic, schema, counter, length, crc = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            print('Snapshot has an unknown format, not using it.')
+            return None
+        
+        if os.fstat(f.fileno()).st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            print('Snapshot can be written by other users, not using it.')
+            return None
+        
+        if schema != _schemaVersion():
+            print('Snapshot was written by a different version, not using '
+                  'it.')
+            return None
+        
+        if counter != db.changes():
+            print('Snapshot is out of date, not using it.')
+            return None
+        
+        with memoryview(data)[_HEADER.size:] as payload:
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                print('Snapshot is corrupt, not using it.')
+                return None
+            
+            rows = _unpack(marshal.loads(payload))
+    
+    count = tm._restoreTournaments(rows) if rows is not None else 0
+    
+    print('Loaded {} tournaments from snapshot ({:.2f} s)'
+            .format(count, time.perf_counter() - start))
+    
+    return count
+
+def startSchedule(every = None):
+    """
+    Write a snapshot every few minutes from a background thread, every
+    util.snapshotEvery minutes by default. Does nothing if every is 0 or
+    the schedule is already running.
+    """
+    global _thread
+    
+    if every is None:
+        every = util.snapshotEvery
+    
+    if not every or _thread is not None:
+        return
+    
+    _thread = threading.Thread(target = _runSchedule, args = (every * 60,),
+                               name = 'snapshot-schedule', daemon = True)
+    _thread.start()
+
+def _runSchedule(interval):
+    """
+    Snapshot thread loop.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            writeSnapshot()
+        except Exception as e:
+            print('Snapshot failed: {}'.format(e))
+
+@lru_cache()
+def _schemaVersion():
+    """
+    Get a checksum of the columns read into a snapshot.
+    """
+    columns = [tm._tournamentHeaderColumns,
+               sorted(tm._graphColumns.items()),
+               um._userColumns,
+               cm._chatColumns]
+    
+    return zlib.crc32(repr(columns).encode())
+
+def _pack(value):
+    """
+    Turns rows into values marshal can store, UUIDs become their bytes.
+    """
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    if isinstance(value, (list, tuple)):
+        return type(value)(_pack(v) for v in value)
+    if isinstance(value, dict):
+        return {_pack(k): _pack(v) for k, v in value.items()}
+    return value
+
+def _unpack(value):
+    """
+    Reverses _pack. Nothing else in the rows is stored as bytes.
+    """
+    if isinstance(value, bytes):
+        return uuid.UUID(bytes = value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unpack(v) for v in value)
+    if isinstance(value, dict):
+        return {_unpack(k): _unpack(v) for k, v in value.items()}
+    return value
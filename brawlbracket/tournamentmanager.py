@@ -1,5 +1,10 @@
 import uuid
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import bidict
 import dateutil.parser
@@ -11,10 +16,24 @@ from brawlbracket.bracket import match as mch
 from brawlbracket import usermanager as um
 from brawlbracket import chatmanager as cm
 from brawlbracket import db_wrapper
+from brawlbracket import writebatch
 from brawlbracket import util
 
+# Loaded tournaments, {id: Tournament} and {shortName: id}. Only change them
+# through _registerTournament and _unregisterTournament. _tournaments is kept
+# in least recently used first order, see _evictTournaments.
+_tournaments = OrderedDict()
 _tournamentsByName = bidict.bidict()
-_tournaments = []
+_registryLock = threading.Lock()
+
+# Short names known not to be in use, {shortName: time they expire}. Oldest
+# first, see _nameMissing.
+_missingNames = OrderedDict()
+
+# Tournament cache metrics, see getDBStats
+_cacheHits = 0
+_cacheMisses = 0
+_evictions = 0
 
 _db = None
 
@@ -26,7 +45,7 @@ def createTournament(shortName, **kwargs):
     Returns the new Tournament.
     Returns None if the shortName wasn't unique.
     """
-    if shortName in _tournamentsByName:
+    if tournamentNameExists(shortName):
         return None
     
     tournament = trn.SingleElimTournament(
@@ -38,10 +57,7 @@ def createTournament(shortName, **kwargs):
     
     _writeTournamentToDB(tournament)
     
-    _tournamentsByName[shortName] = tournament.id
-    _tournaments.append(tournament)
-    
-    return tournament
+    return _registerTournament(tournament)
     
 def getTournamentById(id):
     """
@@ -50,15 +66,19 @@ def getTournamentById(id):
     Returns None if no tournament was found.
     Returns the tournament found.
     """
-    for tournament in _tournaments:
-        if tournament.id == id:
+    global _cacheHits, _cacheMisses
+    
+    with _registryLock:
+        tournament = _tournaments.get(id, None)
+        if tournament is not None:
+            _tournaments.move_to_end(id)
+            _cacheHits += 1
             return tournament
+        _cacheMisses += 1
     
     tournament = _getTournamentFromDBById(id)
     if tournament is not None:
-        _tournaments.append(tournament)
-        _tournamentsByName[tournament.shortName] = tournament.id
-        return tournament
+        return _registerTournament(tournament)
     else:
         return None
 
@@ -73,12 +93,14 @@ def getTournamentByName(shortName):
     if id is not None:
         return getTournamentById(id)
     
+    if _nameMissing(shortName):
+        return None
+    
     tournament = _getTournamentFromDBByName(shortName)
     if tournament is not None:
-        _tournaments.append(tournament)
-        _tournamentsByName[tournament.shortName] = tournament.id
-        return tournament
+        return _registerTournament(tournament)
     else:
+        _rememberMissing(shortName)
         return None
 
 def tournamentNameExists(shortName):
@@ -89,9 +111,331 @@ def tournamentNameExists(shortName):
     
     Returns True if the shortName is in use, False otherwise.
     """
-    # TODO this can be optimized to only check if a tournament exists in the
-    # data base not have to reconstruct the entire thing if we haven't already
-    return getTournamentByName(shortName) is not None
+    if shortName in _tournamentsByName:
+        return True
+    
+    if _nameMissing(shortName):
+        return False
+    
+    if _db is None:
+        _initDB()
+    
+    if _db.row_exists('tournaments', ['shortName = ?'], params = [shortName]):
+        return True
+    
+    _rememberMissing(shortName)
+    return False
+
+def warmUp(workers = 1):
+    """
+    Loads every tournament that still has matches to play, so the first
+    requests after a restart don't have to. Tournaments are read a table at a
+    time for many at once rather than one at a time.
+    
+    workers: Number of threads loading tournaments at once (int)
+    
+    Returns the number of tournaments loaded.
+    """
+    if _db is None:
+        _initDB()
+    
+    start = time.perf_counter()
+    
+    # No more than fit in the cache next to the ones already loaded, or
+    # loading the last ones would unload the first
+    rows = _db.select_values('matches', ['tournamentId'], ['winner IS NULL'],
+                             distinct = True)
+    ids = [row[0] for row in rows if row[0] not in _tournaments]
+    ids = ids[:max(0, util.tournamentCacheSize - len(_tournaments))]
+    
+    print('Warming up {} tournaments...'.format(len(ids)))
+    
+    if not ids:
+        return 0
+    
+    # One batch per worker
+    workers = max(1, min(workers, len(ids)))
+    batches = [ids[i::workers] for i in range(workers)]
+    
+    loaded = 0
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for count in executor.map(_preloadTournaments, batches):
+            loaded += count
+            print('Warmed up {}/{} tournaments ({:.1f} s)'
+                    .format(loaded, len(ids), time.perf_counter() - start))
+    
+    return loaded
+
+@contextmanager
+def transaction():
+    """
+    Returns a context manager that groups all database writes made inside it
+    into one transaction. The database is shared by the tournament, user and
+    chat managers so writes from all of them are grouped.
+    
+    Matches, teams, players and tournaments changed inside it are written
+    once each when it ends, see writebatch. They're written inside the
+    transaction even if a batch is already open.
+    """
+    if _db is None:
+        _initDB()
+    
+    with _db.transaction(), writebatch.batch():
+        yield
+        
+        # Write now even if this is inside another batch (e.g. the request's),
+        # otherwise the changes would only be written after the commit
+        writebatch.flush()
+
+def getDBStats():
+    """
+    Returns a dict of database statistics: statement counts and timings,
+    write behind queue metrics (None if it's off), how many writes were
+    saved by batching and how well the loaded tournaments are cached.
+    """
+    if _db is None:
+        _initDB()
+    
+    queue = _db.write_queue
+    with _registryLock:
+        tournamentCache = {
+            'loaded': len(_tournaments),
+            'objects': sum(_tournamentSize(t) for t in _tournaments.values()),
+            'hits': _cacheHits,
+            'misses': _cacheMisses,
+            'evictions': _evictions
+        }
+    
+    return {
+        'queries': _db.query_stats.snapshot(),
+        'writeQueue': queue.stats() if queue is not None else None,
+        'writeBatch': writebatch.stats(),
+        'tournamentCache': tournamentCache
+    }
+
+def _registerTournament(tournament):
+    """
+    Adds a tournament to the loaded tournaments.
+    
+    If another thread loaded the same tournament first that one is kept so
+    there's only ever one copy of a tournament. Returns the one kept.
+    """
+    with _registryLock:
+        existing = _tournaments.get(tournament.id, None)
+        if existing is not None:
+            return existing
+        
+        _tournaments[tournament.id] = tournament
+        _tournamentsByName[tournament.shortName] = tournament.id
+        _missingNames.pop(tournament.shortName, None)
+    
+    _evictTournaments()
+    return tournament
+
+def _unregisterTournament(id):
+    """
+    Removes a tournament from the loaded tournaments, it's loaded from the
+    database again the next time it's needed.
+    
+    Returns the tournament removed, None if it wasn't loaded.
+    """
+    with _registryLock:
+        tournament = _tournaments.pop(id, None)
+        _tournamentsByName.inverse.pop(id, None)
+        return tournament
+
+def _nameMissing(shortName):
+    """
+    Returns whether or not a short name was recently found not to be in use,
+    so the database doesn't have to be asked again.
+    """
+    with _registryLock:
+        expires = _missingNames.get(shortName, None)
+        if expires is None:
+            return False
+        
+        if time.monotonic() < expires:
+            return True
+        
+        del _missingNames[shortName]
+        return False
+
+def _rememberMissing(shortName):
+    """
+    Remember that a short name isn't in use for util.tournamentMissingTTL
+    seconds. Only the last util.tournamentMissingCacheSize names are kept.
+    """
+    with _registryLock:
+        # Created since it was looked up
+        if shortName in _tournamentsByName:
+            return
+        
+        _missingNames.pop(shortName, None)
+        _missingNames[shortName] = time.monotonic() + util.tournamentMissingTTL
+        
+        while len(_missingNames) > util.tournamentMissingCacheSize:
+            _missingNames.popitem(last = False)
+
+def _evictTournaments():
+    """
+    Unloads the least recently used tournaments until no more than
+    util.tournamentCacheSize tournaments with no more than
+    util.tournamentCacheObjects matches, teams and players between them are
+    loaded.
+    
+    Tournaments that are in use (see _tournamentPinned) are never unloaded,
+    and neither is the most recently used one. Changes to them still waiting
+    in this thread's batch are written out first so unloaded tournaments come
+    back exactly as they were.
+    """
+    global _evictions
+    
+    with _registryLock:
+        count = len(_tournaments)
+        size = sum(_tournamentSize(t) for t in _tournaments.values())
+        
+        evicted = []
+        for tournament in list(_tournaments.values())[:-1]:
+            if count <= util.tournamentCacheSize and \
+               size <= util.tournamentCacheObjects:
+                break
+            
+            if _tournamentPinned(tournament):
+                continue
+            
+            evicted.append(tournament)
+            count -= 1
+            size -= _tournamentSize(tournament)
+    
+    if not evicted:
+        return
+    
+    # Only the evicted tournaments' changes, the rest of the batch belongs to
+    # whoever is running and is written when they're done. Rows queued to be
+    # written behind are written before anything is read, so they're fine.
+    evictedIds = {t.id for t in evicted}
+    writebatch.flushWhere(
+        lambda obj: getattr(obj, 'tournamentId', None) in evictedIds or
+                    (isinstance(obj, trn.Tournament) and obj.id in evictedIds))
+    
+    chatIds = set()
+    for tournament in evicted:
+        # Skip tournaments that were used again while writing
+        if _tournamentPinned(tournament) or \
+           _unregisterTournament(tournament.id) is None:
+            continue
+        
+        if tournament.loaded:
+            chatIds.update(m.chat.id for m in tournament.matches
+                           if m.chat is not None)
+            chatIds.update(p.adminChat.id for p in tournament.players
+                           if p.adminChat is not None)
+        with _registryLock:
+            _evictions += 1
+        print('Unloaded tournament {}'.format(tournament.shortName))
+    
+    cm._forgetChats(chatIds)
+
+def _tournamentSize(tournament):
+    """
+    Size of a loaded tournament in matches, teams and players.
+    """
+    if not tournament.loaded:
+        return 0
+    
+    return len(tournament.matches) + len(tournament.teams) + \
+        len(tournament.players)
+
+def _tournamentPinned(tournament):
+    """
+    Returns whether or not a tournament has to stay loaded, because a socket
+    or request is using it (admins and spectators included) or someone is
+    playing in it.
+    """
+    if tournament.connections > 0:
+        return True
+    
+    if not tournament.loaded:
+        return False
+    
+    return any(p.online > 0 for p in tournament.players)
+
+def _preloadTournaments(ids):
+    """
+    Loads tournaments by id, with their matches, teams and players, using
+    a few queries for all of them. See warmUp.
+    
+    Returns the number of tournaments loaded.
+    """
+    if not ids:
+        return 0
+    
+    return _restoreTournaments(_readTournaments(ids))
+
+def _readTournaments(ids):
+    """
+    Reads every row needed to build tournaments by id, with one query per
+    table for all of them.
+    
+    Returns a dict of rows with the keys 'tournaments' (headers), 'graphs'
+    (see _readTournamentGraphs), 'users' and 'chats'.
+    """
+    if _db is None:
+        _initDB()
+    
+    headers = _db.select_in('tournaments', _tournamentHeaderColumns, 'id', ids)
+    graphs = _readTournamentGraphs([tournamentData[0]
+                                    for tournamentData in headers])
+    
+    # Users and chats of every tournament at once
+    userIds = set()
+    chatIds = set()
+    for tournamentData in headers:
+        userIds.update(tournamentData[3])
+    for graph in graphs.values():
+        for playerData in graph['players']:
+            userIds.add(playerData[1])
+            chatIds.add(playerData[3])
+        for matchData in graph['matches']:
+            chatIds.add(matchData[5])
+    
+    userIds.discard(None)
+    chatIds.discard(None)
+    
+    return {
+        'tournaments': headers,
+        'graphs': graphs,
+        'users': _db.select_in('users', um._userColumns, 'id', userIds),
+        'chats': _db.select_in('chats', cm._chatColumns, 'id', chatIds)
+    }
+
+def _restoreTournaments(rows):
+    """
+    Builds and registers tournaments, with their matches, teams and players,
+    from rows read by _readTournaments. Tournaments that are already loaded
+    are left as they are.
+    
+    Returns the number of tournaments built.
+    """
+    users = um._cacheUsers(rows['users'])
+    chats = cm._cacheChats(rows['chats'])
+    
+    count = 0
+    for tournamentData in rows['tournaments']:
+        if tournamentData[0] in _tournaments:
+            continue
+        
+        tournament = _buildTournament(tournamentData)
+        graph = rows['graphs'][tournament.id]
+        rootId = tournamentData[4]
+        tournament.setLoader(lambda t, graph = graph, rootId = rootId:
+                             _loadTournamentGraph(t, rootId, graph, users,
+                                                  chats))
+        tournament.load()
+        _registerTournament(tournament)
+        count += 1
+    
+    return count
 
 def _getTournamentFromDBById(id):
     """
@@ -106,8 +450,9 @@ def _getTournamentFromDBById(id):
     
     rows = _db.select_values(
         'tournaments',
-        ['*'],
-        ['id = \'{}\''.format(id)])
+        _tournamentHeaderColumns,
+        ['id = ?'],
+        params = [id])
     
     # Die early if no results
     if not rows:
@@ -129,8 +474,9 @@ def _getTournamentFromDBByName(shortName):
     
     rows = _db.select_values(
         'tournaments',
-        ['*'],
-        ['shortName = \'{}\''.format(shortName)])
+        _tournamentHeaderColumns,
+        ['shortName = ?'],
+        params = [shortName])
     
     # Die early if no results
     if not rows:
@@ -139,25 +485,29 @@ def _getTournamentFromDBByName(shortName):
         tournamentData = rows[0]
         return _buildTournament(tournamentData)
 
+# Columns of the tournaments table read by _buildTournament
+_tournamentHeaderColumns = ['id', 'name', 'shortName', 'admins', 'root',
+                            'startTime', 'checkInTime', 'description', 'style']
+
 def _buildTournament(tournamentData):
     """
     Builds a tournament from database tournament data.
+    
+    Only the tournament itself is built, its matches, teams and players are
+    loaded by _loadTournamentGraph the first time they're used.
     """
     #print('Making tournament from: ', tournamentData)
     id = tournamentData[0]
     name = tournamentData[1]
     shortName = tournamentData[2]
-    matchIds = tournamentData[3]
-    teamIds = tournamentData[4]
-    playerIds = tournamentData[5]
-    adminIds = tournamentData[6]
-    rootId = tournamentData[7]
-    startTime = dateutil.parser.parse(tournamentData[8])\
-        if tournamentData[8] is not None else None
-    checkInTime = dateutil.parser.parse(tournamentData[9])\
-        if tournamentData[9] is not None else None
-    description = tournamentData[10]
-    style = tournamentData[11]
+    adminIds = tournamentData[3]
+    rootId = tournamentData[4]
+    startTime = dateutil.parser.parse(tournamentData[5])\
+        if tournamentData[5] is not None else None
+    checkInTime = dateutil.parser.parse(tournamentData[6])\
+        if tournamentData[6] is not None else None
+    description = tournamentData[7]
+    style = tournamentData[8]
     
     tournament = None
     if style == 'Single Elimination':
@@ -172,129 +522,163 @@ def _buildTournament(tournamentData):
     else:
         raise ValueError('Bad tournament style: {}'.format(style))
     
-    # Quick function that returns a string surrounded by quotes
-    q = lambda x: '\'{}\''.format(x)
-    
     # ---- MAKE ADMINS ----
     admins = set()
+    adminUsers = um.getUsersByIds(adminIds)
     for adminId in adminIds:
-        user = um.getUserById(adminId)
+        user = adminUsers.get(adminId, None)
         if user is None:
             raise AssertionError('Admin with bad id. {}'.format(adminId))
         admins.add(user)
     
+    tournament.admins = admins
+    tournament.setLoader(lambda t: _loadTournamentGraph(t, rootId))
+    
+    # Now that we're done setting up tournament we can give it its callbacks
+    tournament._dbCallback = _tournamentDBCallback
+    tournament._callbacks = (_matchDBCallback, _teamDBCallback, _playerDBCallback)
+    tournament._fullCallback = _writeTournamentToDB
+    
+    return tournament
+
+# Columns read from each table by _loadTournamentGraph
+_graphColumns = {
+    'players': ['id', 'user', 'currentLegend', 'adminChat'],
+    'teams': ['id', 'seed', 'name', 'players', 'eliminated', 'checkedIn'],
+    'matches': ['id', 'nextMatch', 'nextMatchSide', 'round', 'number', 'chat',
+                'score', 'realmBans', 'startTime', 'roomNumber',
+                'currentRealm', 'banRule', 'winner', 'bestOf', 'state'],
+    'match_teams': ['matchId', 'side', 'teamId'],
+    'match_prereqs': ['matchId', 'side', 'prereqId']
+}
+
+def _readTournamentGraphs(ids):
+    """
+    Reads the rows _loadTournamentGraph needs for many tournaments at once,
+    with one query per table instead of one per table and tournament. Rows
+    are streamed straight into their tournament's lists.
+    
+    Returns {tournament id: {table: rows}}, see _graphColumns.
+    """
+    if _db is None:
+        _initDB()
+    
+    graphs = {id: {table: [] for table in _graphColumns} for id in ids}
+    for table, columns in _graphColumns.items():
+        for row in _db.iter_in(table, columns + ['tournamentId'],
+                               'tournamentId', list(graphs)):
+            graphs[row[-1]][table].append(row[:-1])
+    
+    return graphs
+
+def _loadTournamentGraph(tournament, rootId, graph = None, users = None,
+                         chats = None):
+    """
+    Builds the matches, teams and players of a tournament built by
+    _buildTournament.
+    
+    graph: The tournament's rows from _readTournamentGraphs, read if not
+           given (dict)
+    users: Users by id, must have every player's user if given (dict)
+    chats: Chats by id, must have every player's and match's chat if given
+           (dict)
+    
+    Returns them as a dict of attributes to set on the tournament, see
+    Tournament.setLoader.
+    """
+    if graph is None:
+        graph = _readTournamentGraphs([tournament.id])[tournament.id]
+    
+    playerRows = graph['players']
+    matchRows = graph['matches']
+    
+    # Load users and chats in bulk
+    if users is None:
+        users = um.getUsersByIds({playerData[1] for playerData in playerRows})
+    if chats is None:
+        chats = cm.getChats({playerData[3] for playerData in playerRows} |
+                            {matchData[5] for matchData in matchRows})
+    
+    # Everything is linked up through these instead of searching, so
+    # loading takes time in proportion to the size of the tournament
+    playersById = {}
+    teamsById = {}
+    matchesById = {}
+    
     # ---- MAKE PLAYERS ----
     players = set()
-    cond = 'id IN ({})'
-    cond = cond.format(','.join(['{}']*len(playerIds))) # Format in format strs
-    cond = cond.format(*[q(id) for id in playerIds]) # Format in ids
-    playerRows = _db.select_values(
-        'players',
-        ['*'],
-        [cond])
-    
-    # We should've written all players, how could this happen?
-    if len(playerRows) !=  len(playerIds):
-        raise AssertionError(
-            'Got less players than ids. '
-            '{}, {}'.format([r[0] for r in playerRows],
-                            [str(id) for id in playerIds]))
-    
     for playerData in playerRows:
         #print('Making player from: ', playerData)
         id = playerData[0]
-        user = um.getUserById(playerData[1])
+        user = users.get(playerData[1], None)
         if user is None:
             raise AssertionError('Player user was none.'
                                  '{}'.format(playerData[1]))
-        player = plr.Player(user, uuid = id)
+        player = plr.Player(user, uuid = id, tournamentId = tournament.id)
         player.currentLegend = playerData[2]
         player.online = 0
-        player.adminChat = cm.getChat(playerData[3])
+        player.adminChat = chats.get(playerData[3], None)
         player._dbCallback = _playerDBCallback # Give db callback
         players.add(player)
+        playersById[id] = player
     
     # ---- MAKE TEAMS ----
     teams = set()
-    cond = 'id IN ({})'
-    cond = cond.format(','.join(['{}']*len(teamIds))) # Format in format strs
-    cond = cond.format(*[q(id) for id in teamIds]) # Format in ids
-    teamRows = _db.select_values(
-        'teams',
-        ['*'],
-        [cond])
-        
-    # We should've written all teams, how could this happen?
-    if len(teamRows) !=  len(teamIds):
-        raise AssertionError(
-            'Got less teams than ids. '
-            '{}, {}'.format([r[0] for r in teamRows],
-                            [str(id) for id in teamIds]))
-    
-    for teamData in teamRows:
+    for teamData in graph['teams']:
         #print('Making team from: ', teamData)
         id = teamData[0]
         seed = teamData[1]
         name = teamData[2]
-        teamPlayers = []
-        for playerId in teamData[3]:
-            for player in players:
-                if player.id == playerId:
-                    teamPlayers.append(player)
-                    break
+        teamPlayers = [playersById[playerId] for playerId in teamData[3]
+                       if playerId in playersById]
         eliminated = teamData[4]
         checkedIn = teamData[5]
-        team = tem.Team(seed, players = teamPlayers, name = name, uuid = id)
+        team = tem.Team(seed, players = teamPlayers, name = name, uuid = id,
+                        tournamentId = tournament.id)
         team.eliminated = eliminated
         team.checkedIn = checkedIn
         team._dbCallback = _teamDBCallback # Give db callback
         teams.add(team)
+        teamsById[id] = team
     
     # ---- MAKE MATCHES ----
     matches = set()
-    cond = 'id IN ({})'
-    cond = cond.format(','.join(['{}']*len(matchIds))) # Format in format strs
-    cond = cond.format(*[q(id) for id in matchIds]) # Format in ids
-    matchRows = _db.select_values(
-        'matches',
-        ['*'],
-        [cond])
+    
+    # Teams in each match as {match id: [team id, team id]}
+    matchTeamIds = {}
+    for matchId, side, teamId in graph['match_teams']:
+        matchTeamIds.setdefault(matchId, [None, None])[side] = teamId
+    
+    # Next match of each match as {match id: next match id}, linked up once
+    # every match exists
+    nextMatchIds = {}
     
     for matchData in matchRows:
         # Trigger warning... trying to assign all of the fields to a useful name
         #print('Making match from: ', matchData)
         id = matchData[0]
+        nextMatchIds[id] = matchData[1]
         nextMatchSide = matchData[2]
         round = matchData[3]
         number = matchData[4]
-        chat = cm.getChat(matchData[6])
-        score = json.loads(matchData[7])
-        matchTeams = []
-        for teamId in matchData[8]:
-            if teamId == None:
-                matchTeams.append(None)
-                continue
-            for team in teams:
-                if team.id == teamId:
-                    matchTeams.append(team)
-                    break
-        realmBans = json.loads(matchData[9])
-        startTime = dateutil.parser.parse(matchData[10])\
-                        if matchData[10] is not None else None
-        roomNumber = matchData[11]
-        currentRealm = matchData[12]
-        banRule = matchData[13] # TODO: ACTUALLY CREATE A BAN RULE HERE
-        winner = None
-        if matchData[14] is not None:
-            for team in teams:
-                if team.id == matchData[14]:
-                    winner = team
-                    break
-        bestOf = matchData[15]
-        state = json.loads(matchData[16])
+        chat = chats.get(matchData[5], None)
+        score = json.loads(matchData[6])
+        matchTeams = [teamsById.get(teamId) if teamId is not None else None
+                      for teamId in matchTeamIds.get(id, [None, None])]
+        realmBans = json.loads(matchData[7])
+        startTime = dateutil.parser.parse(matchData[8])\
+                        if matchData[8] is not None else None
+        roomNumber = matchData[9]
+        currentRealm = matchData[10]
+        banRule = matchData[11] # TODO: ACTUALLY CREATE A BAN RULE HERE
+        winner = teamsById.get(matchData[12]) \
+            if matchData[12] is not None else None
+        bestOf = matchData[13]
+        state = json.loads(matchData[14])
         
         # Create the match
-        match = mch.Match(teams = matchTeams, uuid = id, chat = chat)
+        match = mch.Match(teams = matchTeams, uuid = id, chat = chat,
+                          tournamentId = tournament.id)
         match.nextMatchSide = nextMatchSide
         match.round = round
         match.number = number
@@ -309,54 +693,116 @@ def _buildTournament(tournamentData):
         match.bestOf = bestOf
         match.state = state
         matches.add(match)
+        matchesById[id] = match
     
     # Link tournament structure together in matches
-    for match in matches:
-        if match.id == rootId:
-            tournament._root = match
-        
-        for matchData in matchRows:
-            if matchData[0] != match.id:
-                continue
-            
-            for oMatch in matches:
-                if oMatch.id == matchData[1]:
-                    match.nextMatch = oMatch
-                    continue
-                
-                if oMatch.id == matchData[5][0]:
-                    match.prereqMatches[0] = oMatch
-                elif oMatch.id == matchData[5][1]:
-                    match.prereqMatches[1] = oMatch
-            
-            # The break condition is sort of complicated but essentially boils
-            # down to: if we have something to set and it's set we're done
-            if (matchData[1] is None or match.nextMatch is not None) and\
-               (matchData[5][0] is None or
-                    match.prereqMatches[0] is not None) and\
-               (matchData[5][1] is None or
-                    match.prereqMatches[1] is not None):
-                        break
-        else:
-            raise AssertionError('Couldn\'t set up match hierarchy. ({})'
-                                    .format(matchData[0]))
-                                    
+    for matchId, nextMatchId in nextMatchIds.items():
+        if nextMatchId is not None:
+            matchesById[matchId].nextMatch = matchesById[nextMatchId]
+    
+    for matchId, side, prereqId in graph['match_prereqs']:
+        if prereqId is not None:
+            matchesById[matchId].prereqMatches[side] = matchesById[prereqId]
+    
     # Now that we're done setting up matches we can give them their callback
     for match in matches:
         match._dbCallback = _matchDBCallback
-        
-    tournament.admins = admins
-    tournament.players = players
-    tournament.teams = teams
-    tournament.matches = matches
     
-    # Now that we're done setting up tournament we can give it its callbacks
-    tournament._dbCallback = _tournamentDBCallback
-    tournament._callbacks = (_matchDBCallback, _teamDBCallback, _playerDBCallback)
-    tournament._fullCallback = _writeTournamentToDB
+    return {
+        'players': players,
+        'teams': teams,
+        'matches': matches,
+        '_root': matchesById[rootId] if rootId is not None else None
+    }
     
-    return tournament
+# Attributes that are stored in columns of their own, so changing them only
+# has to write those columns. Each is attribute -> (column, serializer).
+# Changing any other attribute rewrites the whole row.
+_tournamentColumns = {
+    'name': ('name', lambda t: t.name),
+    'shortName': ('shortName', lambda t: t.shortName),
+    'admins': ('admins',
+               lambda t: _db.dump_uuid_list([a.id for a in t.admins])),
+    '_root': ('root', lambda t: _idOrNone(t._root)),
+    'root': ('root', lambda t: _idOrNone(t._root)),
+    'startTime': ('startTime', lambda t: _isoOrNone(t.startTime)),
+    'checkInTime': ('checkInTime', lambda t: _isoOrNone(t.checkInTime)),
+    'description': ('description', lambda t: t.description),
+    'style': ('style', lambda t: t.style)
+}
+
+_matchColumns = {
+    'tournamentId': ('tournamentId', lambda m: m.tournamentId),
+    'nextMatch': ('nextMatch', lambda m: _idOrNone(m.nextMatch)),
+    'nextMatchSide': ('nextMatchSide', lambda m: m.nextMatchSide),
+    'round': ('round', lambda m: m.round),
+    'number': ('number', lambda m: m.number),
+    'chat': ('chat', lambda m: m.chat.id),
+    'score': ('score', lambda m: json.dumps(m.score)),
+    '_realmBans': ('realmBans', lambda m: json.dumps(m._realmBans)),
+    'startTime': ('startTime', lambda m: _isoOrNone(m.startTime)),
+    'roomNumber': ('roomNumber',
+                   lambda m: m.roomNumber if m.bestOf is not None else None),
+    'currentRealm': ('currentRealm', lambda m: m.currentRealm),
+    'banRule': ('banRule', lambda m: m.banRule),
+    'winner': ('winner', lambda m: _idOrNone(m.winner)),
+    'bestOf': ('bestOf', lambda m: m.bestOf),
+    'state': ('state', lambda m: json.dumps(m.state))
+}
+
+# Match attributes stored in the match_teams and match_prereqs tables
+_matchLinkFields = {'teams', 'prereqMatches', '_prereqMatches'}
+
+_teamColumns = {
+    'tournamentId': ('tournamentId', lambda t: t.tournamentId),
+    'seed': ('seed', lambda t: t.seed),
+    'name': ('name', lambda t: t.name),
+    'players': ('players',
+                lambda t: _db.dump_uuid_list([p.id for p in t.players])),
+    'eliminated': ('eliminated', lambda t: t.eliminated),
+    'checkedIn': ('checkedIn', lambda t: t.checkedIn)
+}
+
+_playerColumns = {
+    'tournamentId': ('tournamentId', lambda p: p.tournamentId),
+    'user': ('user', lambda p: p.user.id),
+    'currentLegend': ('currentLegend', lambda p: p.currentLegend),
+    'adminChat': ('adminChat', lambda p: _idOrNone(p.adminChat))
+}
+
+def _idOrNone(obj):
+    """
+    Returns obj.id, or None if obj is None.
+    """
+    return obj.id if obj is not None else None
+
+def _isoOrNone(date):
+    """
+    Returns date in ISO format, or None if date is None.
+    """
+    return date.isoformat() if date is not None else None
+
+def _changedColumnsForDB(obj, fields, columns, ignore = ()):
+    """
+    Serializes the columns that changed attributes are stored in, as a dict
+    of column -> value. Fields in ignore are skipped.
+    
+    Returns None if the whole row needs to be written instead, either
+    because fields is None or because a field has no column of its own.
+    """
+    if fields is None:
+        return None
+    
+    values = {}
+    for field in fields:
+        if field in columns:
+            column, serialize = columns[field]
+            values[column] = serialize(obj)
+        elif field not in ignore:
+            return None
     
+    return values
+
 def _constructTournamentDataForDB(tournament):
     """
     Builds a tuple of data from a tournament in the format expected for the
@@ -366,10 +812,7 @@ def _constructTournamentDataForDB(tournament):
         tournament.id,
         tournament.name,
         tournament.shortName,
-        json.dumps([str(m.id) for m in tournament.matches]),
-        json.dumps([str(t.id) for t in tournament.teams]),
-        json.dumps([str(p.id) for p in tournament.players]),
-        json.dumps([str(a.id) for a in tournament.admins]),
+        _db.dump_uuid_list([a.id for a in tournament.admins]),
         tournament._root.id if tournament._root is not None else None,
         tournament.startTime.isoformat()\
             if tournament.startTime is not None else None,
@@ -386,6 +829,7 @@ def _constructMatchDataForDB(match):
     """
     matchData = (
         match.id,
+        match.tournamentId,
         # nextMatch could be None
         match.nextMatch.id\
             if match.nextMatch is not None else None,
@@ -393,14 +837,8 @@ def _constructMatchDataForDB(match):
             if match.nextMatchSide is not None else None,
         match.round,
         match.number,
-        # m could be None
-        json.dumps([str(m.id) if m is not None else None
-                      for m in match.prereqMatches]),
         match.chat.id,
         json.dumps(match.score),
-        # t could be None
-        json.dumps([str(t.id) if t is not None else None
-                      for t in match.teams]),
         json.dumps(match._realmBans),
         match.startTime.isoformat()\
             if match.startTime is not None else None,
@@ -413,6 +851,25 @@ def _constructMatchDataForDB(match):
         json.dumps(match.state)
     )
     return matchData
+
+def _constructMatchTeamsForDB(match):
+    """
+    Builds a list of match_teams rows linking a match to its teams.
+    """
+    # t could be None
+    return [(match.id, side, match.tournamentId,
+             t.id if t is not None else None)
+            for side, t in enumerate(match.teams)]
+
+def _constructMatchPrereqsForDB(match):
+    """
+    Builds a list of match_prereqs rows linking a match to its prerequisite
+    matches.
+    """
+    # m could be None
+    return [(match.id, side, match.tournamentId,
+             m.id if m is not None else None)
+            for side, m in enumerate(match.prereqMatches)]
     
 def _constructTeamDataForDB(team):
     """
@@ -420,9 +877,10 @@ def _constructTeamDataForDB(team):
     """
     teamData = (
         team.id,
+        team.tournamentId,
         team.seed,
         team.name,
-        json.dumps([str(p.id) for p in team.players]),
+        _db.dump_uuid_list([p.id for p in team.players]),
         team.eliminated,
         team.checkedIn
     )
@@ -434,114 +892,175 @@ def _constructPlayerDataForDB(player):
     """
     playerData = (
         player.id,
+        player.tournamentId,
         player.user.id,
         player.currentLegend,
         player.adminChat.id if player.adminChat else None
     )
     return playerData
 
-def _tournamentDBCallback(tournament):
+@writebatch.coalesced
+def _tournamentDBCallback(tournament, fields = None):
     """
     Write a single tournament to the database.
     Intended as a call back for when a tournament changes internally and needs to 
     write out.
+    Only the columns of the attributes in fields are written, everything is
+    written if fields is None.
     """
     if _db is None:
         _initDB()
     
-    tournamentData = _constructTournamentDataForDB(tournament)
-    _db.insert_values('tournaments', [tournamentData])
+    columns = _changedColumnsForDB(tournament, fields, _tournamentColumns)
+    if columns is None:
+        tournamentData = _constructTournamentDataForDB(tournament)
+        _db.insert_deferred('tournaments', [tournamentData])
+    elif columns:
+        _db.update_deferred('tournaments', {'id': tournament.id}, columns)
 
-def _matchDBCallback(match):
+@writebatch.coalesced
+def _matchDBCallback(match, fields = None):
     """
     Write a single match to the database.
     Intended as a call back for when a match changes internally and needs to 
     write out.
+    Only the columns of the attributes in fields are written, everything is
+    written if fields is None.
     """
     if _db is None:
         _initDB()
     
-    matchData = _constructMatchDataForDB(match)
-    _db.insert_values('matches', [matchData])
+    columns = _changedColumnsForDB(match, fields, _matchColumns,
+                                   _matchLinkFields)
+    with _db.transaction():
+        if columns is None:
+            matchData = _constructMatchDataForDB(match)
+            _db.insert_deferred('matches', [matchData])
+        elif columns:
+            _db.update_deferred('matches', {'id': match.id}, columns)
+        
+        if fields is None or 'teams' in fields:
+            _db.insert_deferred('match_teams',
+                                _constructMatchTeamsForDB(match), key_len=2)
+        if fields is None or not fields.isdisjoint({'prereqMatches',
+                                                    '_prereqMatches'}):
+            _db.insert_deferred('match_prereqs',
+                                _constructMatchPrereqsForDB(match), key_len=2)
     
-def _teamDBCallback(team):
+@writebatch.coalesced
+def _teamDBCallback(team, fields = None):
     """
     Write a single team to the database.
     Intended as a call back for when a team changes internally and needs to 
     write out.
+    Only the columns of the attributes in fields are written, everything is
+    written if fields is None.
     """
     if _db is None:
         _initDB()
     
-    teamData = _constructTeamDataForDB(team)
-    _db.insert_values('teams', [teamData])
+    columns = _changedColumnsForDB(team, fields, _teamColumns)
+    if columns is None:
+        teamData = _constructTeamDataForDB(team)
+        _db.insert_deferred('teams', [teamData])
+    elif columns:
+        _db.update_deferred('teams', {'id': team.id}, columns)
 
-def _playerDBCallback(player):
+@writebatch.coalesced
+def _playerDBCallback(player, fields = None):
     """
     Write a single player to the database.
     Intended as a call back for when a player changes internally and needs to 
     write out.
+    Only the columns of the attributes in fields are written, everything is
+    written if fields is None.
     """
     if _db is None:
         _initDB()
     
-    playerData = _constructPlayerDataForDB(player)
-    _db.insert_values('players', [playerData])
+    columns = _changedColumnsForDB(player, fields, _playerColumns)
+    if columns is None:
+        playerData = _constructPlayerDataForDB(player)
+        _db.insert_deferred('players', [playerData])
+    elif columns:
+        _db.update_deferred('players', {'id': player.id}, columns)
 
 def _writeTournamentToDB(tournament):
     """
     Serializes a tournament, its matches, teams, and players and then inserts 
     them into their own tables in the database.
+    
+    Anything in the database that no longer belongs to the tournament (e.g.
+    matches removed while generating the bracket) is deleted.
     """
     if _db is None:
         _initDB()
+    
+    # Anything still dirty has to be written before stale rows are cleared
+    writebatch.flush()
+    
+    # All or nothing, a partially written tournament can't be rebuilt
+    with _db.transaction():
+        tournamentData = _constructTournamentDataForDB(tournament)
+        print('Writing tournament with: ', tournamentData)
+        _db.insert_values('tournaments', [tournamentData])
         
-    tournamentData = _constructTournamentDataForDB(tournament)
-    print('Writing tournament with: ', tournamentData)
-    _db.insert_values('tournaments', [tournamentData])
-    
-    matchDatas = []
-    for match in tournament.matches:
-        matchData = _constructMatchDataForDB(match)
-        print('Writing match with: ', matchData)
-        matchDatas.append(matchData)
-    # Only write if there's something to write
-    if matchDatas:
-        _db.insert_values('matches', matchDatas)
-    
-    teamDatas = []
-    for team in tournament.teams:
-        teamData = _constructTeamDataForDB(team)
-        print('Writing team with: ', teamData)
-        teamDatas.append(teamData)
-    # Only write if there's something to write
-    if teamDatas:
-        _db.insert_values('teams', teamDatas)
-    
-    playerDatas = []
-    for player in tournament.players:
-        playerData = _constructPlayerDataForDB(player)
-        print('Writing player with: ', playerData)
-        playerDatas.append(playerData)
-    # Only write if there's something to write
-    if playerDatas:
-        _db.insert_values('players', playerDatas)
+        # Clear out old children, everything is rewritten below
+        for table in ['matches', 'teams', 'players', 'match_teams',
+                      'match_prereqs']:
+            _db.delete_values(table, ['tournamentId = ?'],
+                              params = [tournament.id])
+        
+        matchDatas = []
+        matchTeamDatas = []
+        matchPrereqDatas = []
+        for match in tournament.matches:
+            matchData = _constructMatchDataForDB(match)
+            print('Writing match with: ', matchData)
+            matchDatas.append(matchData)
+            matchTeamDatas.extend(_constructMatchTeamsForDB(match))
+            matchPrereqDatas.extend(_constructMatchPrereqsForDB(match))
+        _db.insert_many('matches', matchDatas)
+        _db.insert_many('match_teams', matchTeamDatas)
+        _db.insert_many('match_prereqs', matchPrereqDatas)
+        
+        teamDatas = []
+        for team in tournament.teams:
+            teamData = _constructTeamDataForDB(team)
+            print('Writing team with: ', teamData)
+            teamDatas.append(teamData)
+        _db.insert_many('teams', teamDatas)
+        
+        playerDatas = []
+        for player in tournament.players:
+            playerData = _constructPlayerDataForDB(player)
+            print('Writing player with: ', playerData)
+            playerDatas.append(playerData)
+        _db.insert_many('players', playerDatas)
     
 def _initDB():
     print('----INIT TOURNAMENT DATABASE----')
     # Need to global because _db is not local to this context
     global _db
-    _db = db_wrapper.DBWrapper(util.dbName, filepath=util.dbPath)
+    _db = db_wrapper.app_db()
     
+    # Databases made before membership had its own columns need migrating
+    if _db.table_exists('tournaments') and\
+       _db.column_exists('tournaments', 'matches'):
+        _migrateMembershipLists()
+    else:
+        _createTables()
+
+def _createTables():
+    """
+    Creates any missing tournament tables and indexes.
+    """
     # Make tournaments table
     if not _db.table_exists('tournaments'):
         fieldNames = [
             'id',
             'name',
             'shortName',
-            'matches',
-            'teams',
-            'players',
             'admins',
             'root',
             'startTime',
@@ -554,29 +1073,29 @@ def _initDB():
             'TEXT',
             'TEXT',
             'UUIDLIST',
-            'UUIDLIST',
-            'UUIDLIST',
-            'UUIDLIST',
             'UUID',
             'TEXT',
             'TEXT',
             'TEXT',
             'TEXT'
         ]
-        _db.create_table('tournaments', fieldNames, fieldTypes, 'id')
+        _db.create_table('tournaments', fieldNames, fieldTypes, 'id',
+                         indexes = ['shortName'])
+    else:
+        # Tables made before indexes existed need them added
+        _db.create_indexes('tournaments', ['shortName'])
     
     # Make matches table
     if not _db.table_exists('matches'):
         fieldNames = [
             'id',
+            'tournamentId',
             'nextMatch',
             'nextMatchSide',
             'round',
             'number',
-            'prereqMatches',
             'chat',
             'score',
-            'teams',
             'realmBans',
             'startTime',
             'roomNumber',
@@ -587,15 +1106,14 @@ def _initDB():
             'state'
         ]
         fieldTypes = [
+            'UUID',
             'UUID',
             'UUID',
             'INTEGER',
             'INTEGER',
             'INTEGER',
-            'UUIDLIST',
             'UUID',
             'TEXT',
-            'UUIDLIST',
             'TEXT',
             'TEXT',
             'INTEGER',
@@ -605,12 +1123,48 @@ def _initDB():
             'INTEGER',
             'TEXT'
         ]
-        _db.create_table('matches', fieldNames, fieldTypes, 'id')
+        _db.create_table('matches', fieldNames, fieldTypes, 'id',
+                         indexes = ['tournamentId'])
+    
+    # Make match to team links table
+    if not _db.table_exists('match_teams'):
+        fieldNames = [
+            'matchId',
+            'side',
+            'tournamentId',
+            'teamId'
+        ]
+        fieldTypes = [
+            'UUID',
+            'INTEGER',
+            'UUID',
+            'UUID'
+        ]
+        _db.create_table('match_teams', fieldNames, fieldTypes,
+                         'matchId, side', indexes = ['tournamentId'])
+    
+    # Make match to prerequisite match links table
+    if not _db.table_exists('match_prereqs'):
+        fieldNames = [
+            'matchId',
+            'side',
+            'tournamentId',
+            'prereqId'
+        ]
+        fieldTypes = [
+            'UUID',
+            'INTEGER',
+            'UUID',
+            'UUID'
+        ]
+        _db.create_table('match_prereqs', fieldNames, fieldTypes,
+                         'matchId, side', indexes = ['tournamentId'])
     
     # Make teams table
     if not _db.table_exists('teams'):
         fieldNames = [
             'id',
+            'tournamentId',
             'seed',
             'name',
             'players',
@@ -618,6 +1172,7 @@ def _initDB():
             'checkedIn'
         ]
         fieldTypes = [
+            'UUID',
             'UUID',
             'INTEGER',
             'TEXT',
@@ -625,21 +1180,85 @@ def _initDB():
             'BOOLEAN',
             'BOOLEAN'
         ]
-        _db.create_table('teams', fieldNames, fieldTypes, 'id')
+        _db.create_table('teams', fieldNames, fieldTypes, 'id',
+                         indexes = ['tournamentId'])
         
     # Make players table
     if not _db.table_exists('players'):
         fieldNames = [
             'id',
+            'tournamentId',
             'user',
             'currentLegend',
             'adminChat'
         ]
         fieldTypes = [
+            'UUID',
             'UUID',
             'UUID',
             'TEXT',
             'UUID'
         ]
-        _db.create_table('players', fieldNames, fieldTypes, 'id')
+        _db.create_table('players', fieldNames, fieldTypes, 'id',
+                         indexes = ['tournamentId'])
+
+def _migrateMembershipLists():
+    """
+    Migrates a database where tournaments listed their matches, teams and
+    players in UUIDLIST columns (and matches listed their teams and prereqs)
+    to one where children point at their tournament and match links live in
+    the match_teams and match_prereqs tables.
     
+    Rows that no tournament listed are left behind; they're leftovers from
+    matches removed while generating brackets.
+    """
+    print('----MIGRATING TOURNAMENT MEMBERSHIP----')
+    with _db.transaction():
+        tournamentRows = _db.select_values('tournaments', ['*'], None)
+        matchRows = _db.select_values('matches', ['*'], None)
+        teamRows = _db.select_values('teams', ['*'], None)
+        playerRows = _db.select_values('players', ['*'], None)
+        
+        # Old layout: id, name, shortName, matches, teams, players, admins,
+        # root, startTime, checkInTime, description, style
+        owners = {}
+        for t in tournamentRows:
+            for childId in t[3] + t[4] + t[5]:
+                owners[childId] = t[0]
+        newTournamentRows = [t[:3] + (_db.dump_uuid_list(t[6]),) + t[7:]
+                             for t in tournamentRows]
+        
+        # Old layout: id, nextMatch, nextMatchSide, round, number,
+        # prereqMatches, chat, score, teams, realmBans, startTime, roomNumber,
+        # currentRealm, banRule, winner, bestOf, state
+        newMatchRows = []
+        matchTeamRows = []
+        matchPrereqRows = []
+        for m in matchRows:
+            tournamentId = owners.get(m[0])
+            if tournamentId is None:
+                continue
+            
+            newMatchRows.append((m[0], tournamentId) + m[1:5] + m[6:8] + m[9:])
+            matchTeamRows.extend((m[0], side, tournamentId, teamId)
+                                 for side, teamId in enumerate(m[8]))
+            matchPrereqRows.extend((m[0], side, tournamentId, prereqId)
+                                   for side, prereqId in enumerate(m[5]))
+        
+        # Teams and players just gain their tournament id after their own
+        newTeamRows = [(t[0], owners[t[0]]) + t[1:3] +
+                       (_db.dump_uuid_list(t[3]),) + t[4:]
+                       for t in teamRows if t[0] in owners]
+        newPlayerRows = [(p[0], owners[p[0]]) + p[1:]
+                         for p in playerRows if p[0] in owners]
+        
+        for table in ['tournaments', 'matches', 'teams', 'players']:
+            _db.drop_table(table)
+        _createTables()
+        
+        _db.insert_many('tournaments', newTournamentRows)
+        _db.insert_many('matches', newMatchRows)
+        _db.insert_many('match_teams', matchTeamRows)
+        _db.insert_many('match_prereqs', matchPrereqRows)
+        _db.insert_many('teams', newTeamRows)
+        _db.insert_many('players', newPlayerRows)
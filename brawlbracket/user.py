@@ -6,6 +6,8 @@ class User:
     A BrawlBracket user. This User persists globally across tournaments and is
     linked to a User's steam account.
     """
+    __slots__ = ('id', 'steamId', 'username', 'avatar', 'ownedLegends',
+                 'preferredServer')
     
     def __init__(self, steamId, username, avatar, **kwargs):
         """
@@ -19,7 +21,8 @@ class User:
          ownedLegends: list of legends ids (string id)
          preferredServer: server id (string id)
         """
-        self.id = kwargs.get('uuid', uuid.uuid1())
+        id = kwargs.get('uuid')
+        self.id = id if id is not None else uuid.uuid1()
         self.steamId = steamId
         self.username = username
         self.avatar = avatar
@@ -6,9 +6,9 @@ import requests
 
 from brawlbracket import user
 from brawlbracket import db_wrapper
-from brawlbracket import util
 
-_users = []
+# Loaded users, {id: User}
+_users = {}
 
 _db = None
 
@@ -21,7 +21,7 @@ def createUser(steamId):
     Returns None if the steam request fails for some reason.
     Returns the created User on success
     """
-    for u in _users:
+    for u in _users.values():
         if u.steamId == steamId:
             raise ValueError('User already exists with steamId! {}'.format(u))
     
@@ -36,7 +36,7 @@ def createUser(steamId):
     
     _writeUserToDB(newUser)
     
-    _users.append(newUser)
+    _users[newUser.id] = newUser
     
     return newUser
 
@@ -50,11 +50,45 @@ def getUserById(id):
     if id is None:
         return None
     
-    for u in _users:
-        if u.id == id:
-            return u
+    u = _users.get(id, None)
+    if u is not None:
+        return u
+    
+    u = _getUserFromDBById(id)
+    if u is not None:
+        _users[u.id] = u
+        return u
     
     return None
+
+def getUsersByIds(ids):
+    """
+    Gets many users by uuid at once. Users that aren't loaded yet are read
+    from the database together instead of one at a time.
+    
+    Returns a dict of {id: User} of the users found, ids that aren't
+    associated with a user are left out.
+    """
+    users = {}
+    missing = set()
+    for id in ids:
+        if id is None:
+            continue
+        
+        u = _users.get(id, None)
+        if u is not None:
+            users[id] = u
+        else:
+            missing.add(id)
+    
+    if missing:
+        if _db is None:
+            _initDB()
+        
+        users.update(_cacheUsers(
+            _db.select_in('users', _userColumns, 'id', missing)))
+    
+    return users
     
 def getUserBySteamId(steamId):
     """
@@ -67,14 +101,14 @@ def getUserBySteamId(steamId):
         return None
     
     # Check cache first
-    for u in _users:
+    for u in _users.values():
         if u.steamId == steamId:
             return u
     
     # Check DB last'
     u = _getUserFromDBBySteamId(steamId)
     if u is not None:
-        _users.append(u)
+        _users[u.id] = u
         return u
     
     return None
@@ -113,8 +147,21 @@ def _getSteamInfo(steamId):
 
 def _getUserFromDBById(id):
     """
+    Gets a user from the database by id.
+    
+    Returns user if user was in database
+    Returns None otherwise
     """
-    raise NotImplementedError('Can\'t getUserFromDBById')
+    if _db is None:
+        _initDB()
+    
+    rows = _db.select_values('users', _userColumns, ['id = ?'],
+                             params = [id])
+    
+    if rows:
+        return _buildUser(rows[0])
+    else:
+        return None
 
 def _getUserFromDBBySteamId(steamId):
     """
@@ -126,28 +173,55 @@ def _getUserFromDBBySteamId(steamId):
     if _db is None:
         _initDB()
     
-    rows = _db.select_values('users', ['*'], ['steamId = {}'.format(steamId)])
+    rows = _db.select_values('users', _userColumns, ['steamId = ?'],
+                             params = [steamId])
     
     if rows:
-        userData = rows[0]
-        #print('Making user from: ', userData)
-        id = userData[0]
-        steamId = userData[1]
-        username = userData[2]
-        avatar = userData[3]
-        ownedLegends = json.loads(userData[4])
-        preferredServer = userData[5]
-        
-        u = user.User(steamId, username, avatar, uuid=id)
-        
-        # Don't use setSettings because we don't want validation and we
-        # don't want to be renotified that we've updated
-        u.preferredServer = preferredServer
-        u.ownedLegends = ownedLegends
-        
-        return u
+        return _buildUser(rows[0])
     else:
         return None
+
+# Columns of the users table read by _buildUser
+_userColumns = ['id', 'steamId', 'username', 'avatar', 'ownedLegends',
+                'preferredServer']
+
+def _cacheUsers(rows):
+    """
+    Builds users from database user data and adds them to the cache. Users
+    that are already loaded are kept as they are.
+    
+    Returns a dict of {id: User} for every row.
+    """
+    users = {}
+    for userData in rows:
+        u = _users.get(userData[0], None)
+        if u is None:
+            u = _buildUser(userData)
+            _users[u.id] = u
+        users[u.id] = u
+    
+    return users
+
+def _buildUser(userData):
+    """
+    Builds a user from database user data.
+    """
+    #print('Making user from: ', userData)
+    id = userData[0]
+    steamId = userData[1]
+    username = userData[2]
+    avatar = userData[3]
+    ownedLegends = json.loads(userData[4])
+    preferredServer = userData[5]
+    
+    u = user.User(steamId, username, avatar, uuid=id)
+    
+    # Don't use setSettings because we don't want validation and we
+    # don't want to be renotified that we've updated
+    u.preferredServer = preferredServer
+    u.ownedLegends = ownedLegends
+    
+    return u
         
 def _writeUserToDB(u):
     """
@@ -165,13 +239,13 @@ def _writeUserToDB(u):
         u.preferredServer
         )
     print('Writing user with: ', userData)
-    _db.insert_values('users', [userData])
+    _db.insert_deferred('users', [userData])
         
 def _initDB():
     print('----INIT USER DATABASE----')
     # Need to global because _db is not local to this context
     global _db
-    _db = db_wrapper.DBWrapper(util.dbName, filepath=util.dbPath)
+    _db = db_wrapper.app_db()
     
     # Make user table
     if not _db.table_exists('users'):
@@ -192,7 +266,11 @@ def _initDB():
             'TEXT'
             ]
             
-        _db.create_table('users', fieldNames, fieldTypes, 'id')
+        _db.create_table('users', fieldNames, fieldTypes, 'id',
+                         indexes = ['steamId'])
+    else:
+        # Tables made before indexes existed need them added
+        _db.create_indexes('users', ['steamId'])
 
 if __name__ == '__main__':
     steamIds = [76561198042414835, 76561198078549692, 76561197993702532,
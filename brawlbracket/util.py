@@ -7,7 +7,72 @@ import os
 
 # Name and path of data base
 dbName = 'brawlbracketdata'
-dbPath = './data'
+dbPath = os.environ.get('BB_DB_PATH', './data')
+
+# Where the data base is kept, 'sqlite' (a file in dbPath) or 'memory' (gone
+# on exit, for tests and benchmarks), see db_wrapper.backends
+dbBackend = os.environ.get('BB_DB_BACKEND', 'sqlite')
+
+# Storage profile of data base, see db_wrapper.profiles
+dbProfile = os.environ.get('BB_DB_PROFILE', 'durable')
+
+# How the data base stores UUIDs, 'text' or 'blob'. Convert existing data
+# bases with migrate_db.py before changing this.
+dbUuidFormat = os.environ.get('BB_DB_UUID_FORMAT', 'text')
+
+# Write model changes from a background writer instead of while handling
+# requests, see db_wrapper.WriteBehindQueue. Queued changes are written every
+# dbWriteBehindInterval ms or as soon as dbWriteBehindRows are waiting.
+dbWriteBehind = os.environ.get('BB_DB_WRITE_BEHIND', '0') == '1'
+dbWriteBehindInterval = int(os.environ.get('BB_DB_WRITE_BEHIND_MS', '50'))
+dbWriteBehindRows = int(os.environ.get('BB_DB_WRITE_BEHIND_ROWS', '200'))
+
+# Steam ids of the users that can manage the whole app (e.g. start database
+# backups), as a comma separated list
+appAdmins = {int(steamId)
+             for steamId in os.environ.get('BB_APP_ADMINS', '').split(',')
+             if steamId.strip()}
+
+# Data base statements slower than this (in ms) are logged
+dbSlowQueryMs = float(os.environ.get('BB_DB_SLOW_MS', '100'))
+
+# Online backups of the data base, see backup. Backups are taken every
+# dbBackupEvery minutes (0 for never) and the newest dbBackupKeep are kept.
+# dbBackupPages pages are copied at a time with a dbBackupPauseMs pause in
+# between so lobby writes aren't held up.
+dbBackupPath = os.environ.get('BB_DB_BACKUP_PATH',
+                              os.path.join(dbPath, 'backups'))
+dbBackupEvery = float(os.environ.get('BB_DB_BACKUP_EVERY_MIN', '0'))
+dbBackupKeep = int(os.environ.get('BB_DB_BACKUP_KEEP', '5'))
+dbBackupPages = int(os.environ.get('BB_DB_BACKUP_PAGES', '100'))
+dbBackupPauseMs = float(os.environ.get('BB_DB_BACKUP_PAUSE_MS', '10'))
+
+# Most tournaments kept loaded, and most matches, teams and players kept
+# loaded between them. The least recently used ones are unloaded first, ones
+# with players online never are.
+tournamentCacheSize = int(os.environ.get('BB_TOURNAMENT_CACHE_SIZE', '32'))
+tournamentCacheObjects = int(os.environ.get('BB_TOURNAMENT_CACHE_OBJECTS',
+                                            '50000'))
+
+# Tournament names that aren't in use are remembered for
+# tournamentMissingTTL seconds so bad links don't hit the data base every
+# time. Only the last tournamentMissingCacheSize names are remembered.
+tournamentMissingTTL = float(os.environ.get('BB_TOURNAMENT_MISSING_TTL', '30'))
+tournamentMissingCacheSize = int(
+    os.environ.get('BB_TOURNAMENT_MISSING_CACHE_SIZE', '1024'))
+
+# Number of threads loading tournaments that are still being played before
+# the server starts, 0 to start without loading them. See
+# tournamentmanager.warmUp.
+warmUpWorkers = int(os.environ.get('BB_WARM_UP_WORKERS', '1'))
+
+# Snapshot of the loaded tournaments used to start back up quickly, written
+# every snapshotEvery minutes (0 for only on shutdown), see snapshot.
+# Snapshots aren't written or loaded at all unless snapshotEnabled is set.
+snapshotEnabled = os.environ.get('BB_SNAPSHOT', '1') == '1'
+snapshotPath = os.environ.get('BB_SNAPSHOT_PATH',
+                              os.path.join(dbPath, dbName + '.snapshot'))
+snapshotEvery = float(os.environ.get('BB_SNAPSHOT_EVERY_MIN', '5'))
 
 # Mapping from legend internal name to full name
 legendData = {
@@ -7,6 +7,7 @@ from flask import abort
 
 from brawlbracket.app import app
 from brawlbracket import usermanager as um
+from brawlbracket import util
 
 def tourney_admin_only(f):
     """
@@ -19,4 +20,18 @@ def tourney_admin_only(f):
             
         return f(*args, **kwargs)
         
+    return decorated_function
+
+def app_admin_only(f):
+    """
+    Abort with a 403 error if the g.user is not an admin of the whole app,
+    see util.appAdmins.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.user or g.user.steamId not in util.appAdmins:
+            abort(403)
+            
+        return f(*args, **kwargs)
+        
     return decorated_function
\ No newline at end of file
@@ -0,0 +1,148 @@
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+# Batch state of each thread (green thread under eventlet)
+_local = threading.local()
+
+# Callback calls and the writes they ended up as, see stats()
+_calls = 0
+_writes = 0
+
+def coalesced(callback):
+    """
+    Decorator for model database callbacks.
+    
+    Models call the decorated callback as callback(obj, field) with the name
+    of the attribute that changed, or callback(obj) if everything should be
+    written. The callback itself gets callback(obj, fields) with a set of
+    changed attribute names, or None for everything.
+    
+    Outside of a batch the callback runs as normal. Inside one the object is
+    only marked dirty and the callback runs once for it when the batch ends
+    with every field that changed, no matter how many were set.
+    """
+    @wraps(callback)
+    def decorated_function(obj, field = None):
+        global _calls
+        _calls += 1
+        
+        dirty = getattr(_local, 'dirty', None)
+        if dirty is None:
+            _write(callback, obj, {field} if field is not None else None)
+            return
+        
+        # Keep the object itself so its id can't be reused
+        key = (callback, id(obj))
+        entry = dirty.get(key)
+        if entry is None:
+            dirty[key] = (obj, {field} if field is not None else None)
+        elif entry[1] is not None:
+            if field is None:
+                dirty[key] = (obj, None)
+            else:
+                entry[1].add(field)
+    
+    return decorated_function
+
+def begin():
+    """
+    Starts a batch. Batches can be nested, only the outermost one writes.
+    """
+    depth = getattr(_local, 'depth', 0)
+    if depth == 0:
+        _local.dirty = {}
+    _local.depth = depth + 1
+
+def end(write = True):
+    """
+    Ends a batch started with begin(), writing every dirty object if it's
+    the outermost one. If write is False they're dropped instead, e.g.
+    because the request that changed them failed partway.
+    """
+    # Not in a batch, e.g. begin() was skipped because a request was aborted
+    if getattr(_local, 'depth', 0) == 0:
+        return
+    
+    _local.depth -= 1
+    if _local.depth == 0:
+        if write:
+            flush()
+        _local.dirty = None
+
+@contextmanager
+def batch():
+    """
+    Returns a context manager that batches writes made inside it.
+    """
+    begin()
+    try:
+        yield
+    finally:
+        end()
+
+def flush():
+    """
+    Writes every dirty object now, without ending the batch.
+    
+    Call this before writes that have to land after everything done so far
+    (e.g. a full tournament write that deletes stale rows).
+    """
+    dirty = getattr(_local, 'dirty', None)
+    if not dirty:
+        return
+    
+    # Callbacks made while writing go straight through
+    _local.dirty = None
+    try:
+        for (callback, _), (obj, fields) in dirty.items():
+            _write(callback, obj, fields)
+    finally:
+        _local.dirty = {} if _local.depth > 0 else None
+
+def flushWhere(test):
+    """
+    Writes the dirty objects test(obj) is true for now, the rest are left
+    for the end of the batch.
+    """
+    dirty = getattr(_local, 'dirty', None)
+    if not dirty:
+        return
+    
+    matching = [(key, entry) for key, entry in dirty.items()
+                if test(entry[0])]
+    for key, _ in matching:
+        del dirty[key]
+    
+    # Callbacks made while writing go straight through
+    _local.dirty = None
+    try:
+        for (callback, _), (obj, fields) in matching:
+            _write(callback, obj, fields)
+    finally:
+        _local.dirty = dirty
+
+def isDirty():
+    """
+    Returns if the current batch has objects waiting to be written.
+    """
+    return bool(getattr(_local, 'dirty', None))
+
+def stats():
+    """
+    Returns a dict with the number of callback calls, the number of writes
+    they were coalesced into and the number of writes saved.
+    """
+    return {
+        'calls': _calls,
+        'writes': _writes,
+        'saved': _calls - _writes
+    }
+
+def _write(callback, obj, fields):
+    """
+    Runs a callback and counts the write.
+    """
+    global _writes
+    _writes += 1
+    callback(obj, fields)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import time
+
+from brawlbracket import db_wrapper
+from brawlbracket import util
+
+parser = argparse.ArgumentParser(
+    description='Convert how the BrawlBracket database stores UUIDs.')
+parser.add_argument('format', choices=sorted(db_wrapper.uuid_adapters),
+                   help='UUID storage format to convert to')
+parser.add_argument('-p', '--path', dest='path', default=util.dbPath,
+                   help='directory holding the database')
+parser.add_argument('-n', '--name', dest='name', default=util.dbName,
+                   help='database name, without .db')
+args = parser.parse_args()
+
+dbFile = os.path.join(args.path, args.name + '.db')
+if not os.path.exists(dbFile):
+    parser.error('{} doesn\'t exist'.format(dbFile))
+
+db = db_wrapper.open_db(args.name, filepath=args.path)
+
+before = os.path.getsize(dbFile)
+start = time.perf_counter()
+db.convert_uuid_format(args.format)
+
+# Give the freed pages back
+with db.pool.connection() as conn:
+    conn.execute('VACUUM')
+db.exit()
+
+print('Converted {} to {} UUIDs in {:.2f}s ({} -> {} bytes).'
+    .format(dbFile, args.format, time.perf_counter() - start, before,
+            os.path.getsize(dbFile)))
+print('Set BB_DB_UUID_FORMAT={} before starting the server.'
+    .format(args.format))
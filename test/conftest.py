@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+import bidict
+import pytest
+
+from brawlbracket import util
+from brawlbracket import db_wrapper
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import usermanager as um
+from brawlbracket import chatmanager as cm
+from brawlbracket import matchlog
+
+@pytest.fixture
+def freshDB(request, monkeypatch):
+    """
+    Give a test its own in memory database, with no tournaments, users or
+    chats left over from other tests.
+    """
+    monkeypatch.setattr(util, 'dbBackend', 'memory')
+    monkeypatch.setattr(util, 'dbName', 'test-' + request.node.name)
+    for manager in [tm, um, cm, matchlog]:
+        monkeypatch.setattr(manager, '_db', None)
+    monkeypatch.setattr(tm, '_tournaments', OrderedDict())
+    monkeypatch.setattr(tm, '_tournamentsByName', bidict.bidict())
+    monkeypatch.setattr(tm, '_missingNames', OrderedDict())
+    monkeypatch.setattr(um, '_users', {})
+    monkeypatch.setattr(cm, '_chats', {})
+    monkeypatch.setattr(matchlog, '_lastSeqs', {})
+    
+    db = db_wrapper.app_db()
+    yield db
+    
+    db.exit()
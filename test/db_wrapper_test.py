@@ -0,0 +1,529 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from brawlbracket import db_wrapper
+from brawlbracket.db_wrapper import DBWrapper
+
+def makeDB(tmpdir):
+    """
+    Make a database with a simple table in a temporary directory.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir))
+    if not db.table_exists('things'):
+        db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    return db
+
+def test_insertSelect(tmpdir):
+    """
+    Test that inserted rows can be selected back.
+    """
+    db = makeDB(tmpdir)
+    db.insert_values('things', [(1, 'a'), (2, 'b')])
+    
+    assert sorted(db.select_values('things', ['*'], None)) == \
+        [(1, 'a'), (2, 'b')]
+    assert db.select_values('things', ['value'], ['id = 2']) == [('b',)]
+    
+    db.insert_values('things', [(3, 'b')])
+    assert sorted(db.select_values('things', ['value'], None,
+                                   distinct = True)) == [('a',), ('b',)]
+    
+    db.delete_values('things', ['id IN (1, 3)'])
+    assert db.select_values('things', ['id'], None) == [(2,)]
+
+def test_rowExists(tmpdir):
+    """
+    Test that row_exists finds matching rows.
+    """
+    db = makeDB(tmpdir)
+    assert not db.row_exists('things', None)
+    
+    db.insert_values('things', [(1, 'a')])
+    assert db.row_exists('things', None)
+    assert db.row_exists('things', ['value = ?'], params=['a'])
+    assert not db.row_exists('things', ['value = ?'], params=['b'])
+
+def test_selectIn(tmpdir):
+    """
+    Test that select_in finds every row asked for, however the values are
+    split into chunks.
+    """
+    db = makeDB(tmpdir)
+    db.insert_many('things', [(i, str(i)) for i in range(10)])
+    
+    assert db.select_in('things', ['id'], 'id', []) == []
+    for chunkSize in [1, 3, 4, 100]:
+        rows = db.select_in('things', ['id', 'value'], 'id', [1, 2, 5, 9, 42],
+                            chunk_size=chunkSize)
+        assert sorted(rows) == [(1, '1'), (2, '2'), (5, '5'), (9, '9')]
+        
+        rows = db.iter_in('things', ['id', 'value'], 'id', [1, 2, 5, 9, 42],
+                          chunk_size=chunkSize, arraysize=2)
+        assert sorted(rows) == [(1, '1'), (2, '2'), (5, '5'), (9, '9')]
+
+def test_changes(tmpdir):
+    """
+    Test that the change counter only goes up when something was written.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   track_changes=True)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    
+    start = db.changes()
+    db.insert_values('things', [(1, 'a')])
+    assert db.changes() == start + 1
+    
+    # Reads don't count
+    db.select_values('things', ['*'], None)
+    with db.transaction():
+        db.select_values('things', ['*'], None)
+    assert db.changes() == start + 1
+    
+    # A transaction counts once
+    with db.transaction():
+        db.insert_values('things', [(2, 'b')])
+        db.delete_values('things', ['id = 1'])
+    assert db.changes() == start + 2
+    
+    try:
+        makeDB(tmpdir.mkdir('untracked')).changes()
+        assert False
+    except ValueError:
+        pass
+
+def test_poolReusesConnections(tmpdir):
+    """
+    Test that the pool hands the same connection back to sequential users and
+    separate connections to concurrent threads.
+    """
+    db = makeDB(tmpdir)
+    
+    with db.pool.connection() as first:
+        # Nested use on the same thread shares the connection
+        with db.pool.connection() as nested:
+            assert nested is first
+        
+        # Another thread can't share it
+        other = []
+        def worker():
+            with db.pool.connection() as conn:
+                other.append(conn)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert other[0] is not first
+    
+    with db.pool.connection() as second:
+        assert second in (first, other[0])
+
+def test_poolClose(tmpdir):
+    """
+    Test that exit closes the pool.
+    """
+    db = makeDB(tmpdir)
+    db.table_exists('things')
+    db.exit()
+    
+    assert db.pool.closed
+    assert db.pool._idle.empty()
+
+def test_storageProfile(tmpdir):
+    """
+    Test that the storage profile is applied to connections.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   profile='balanced')
+    
+    with db.pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        # NORMAL
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+def test_statementCache(tmpdir):
+    """
+    Test that queries with bound params reuse their compiled statement.
+    """
+    db = makeDB(tmpdir)
+    db.insert_values('things', [(1, 'a')])
+    db.insert_values('things', [(2, 'b')])
+    
+    before = db_wrapper._select_stmt.cache_info()
+    assert db.select_values('things', ['value'], ['id = ?'],
+                            params = [1]) == [('a',)]
+    assert db.select_values('things', ['value'], ['id = ?'],
+                            params = [2]) == [('b',)]
+    after = db_wrapper._select_stmt.cache_info()
+    
+    assert after.hits - before.hits >= 1
+    assert after.misses - before.misses <= 1
+
+def test_insertMany(tmpdir):
+    """
+    Test that bulk inserts write every chunk of a generator.
+    """
+    db = makeDB(tmpdir)
+    db.insert_many('things', ((i, str(i)) for i in range(10)), chunk_size=3)
+    
+    assert len(db.select_values('things', ['*'], None)) == 10
+
+def test_transaction(tmpdir):
+    """
+    Test that transactions commit once and roll back as a whole.
+    """
+    db = makeDB(tmpdir)
+    
+    with db.transaction():
+        db.insert_values('things', [(1, 'a')])
+        
+        # Nested failure only rolls back the nested part
+        try:
+            with db.transaction():
+                db.insert_values('things', [(2, 'b')])
+                raise ValueError()
+        except ValueError:
+            pass
+        
+        assert db.in_transaction()
+    
+    assert not db.in_transaction()
+    assert db.select_values('things', ['id'], None) == [(1,)]
+    
+    try:
+        with db.transaction():
+            db.insert_values('things', [(3, 'c')])
+            db.delete_values('things', ['id = ?'], params = [1])
+            raise ValueError()
+    except ValueError:
+        pass
+    
+    assert db.select_values('things', ['id'], None) == [(1,)]
+
+def test_createIndexes(tmpdir):
+    """
+    Test that indexes are created once and used by lookups.
+    """
+    db = makeDB(tmpdir)
+    db.create_indexes('things', ['value'])
+    db.create_indexes('things', ['value'])
+    
+    with db.pool.connection() as conn:
+        plan = conn.execute('EXPLAIN QUERY PLAN '
+                            'SELECT id FROM things WHERE value = ?',
+                            ('a',)).fetchall()
+    assert 'things_value_idx' in str(plan)
+
+def test_tableColumns(tmpdir):
+    """
+    Test column introspection and dropping tables.
+    """
+    db = makeDB(tmpdir)
+    
+    assert db.table_columns('things') == ['id', 'value']
+    assert db.column_exists('things', 'value')
+    assert not db.column_exists('things', 'nope')
+    
+    db.drop_table('things')
+    assert not db.table_exists('things')
+
+def test_packUUIDs():
+    """
+    Test that packed UUID lists round trip, including Nones.
+    """
+    ids = [uuid.uuid1(), None, uuid.uuid4()]
+    
+    assert db_wrapper.unpack_uuids(db_wrapper.pack_uuids(ids)) == ids
+    assert db_wrapper.unpack_uuids(db_wrapper.pack_uuids([])) == []
+
+def test_convertUUIDFormat(tmpdir):
+    """
+    Test that a database can be converted between UUID formats.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir))
+    db.create_table('refs', ['id', 'others'], ['UUID', 'UUIDLIST'], 'id')
+    
+    id = uuid.uuid1()
+    others = [uuid.uuid1(), None]
+    db.insert_values('refs', [(id, db.dump_uuid_list(others))])
+    
+    try:
+        db.convert_uuid_format('blob')
+        with db.pool.connection() as conn:
+            assert conn.execute('SELECT typeof(id) FROM refs')\
+                .fetchone()[0] == 'blob'
+        assert db.select_values('refs', ['*'], ['id = ?'],
+                                params = [id]) == [(id, others)]
+        
+        db.convert_uuid_format('text')
+        with db.pool.connection() as conn:
+            assert conn.execute('SELECT typeof(id) FROM refs')\
+                .fetchone()[0] == 'text'
+        assert db.select_values('refs', ['*'], ['id = ?'],
+                                params = [id]) == [(id, others)]
+    finally:
+        # Adapters are global, don't leak blob UUIDs into other tests
+        db.convert_uuid_format('text')
+
+def test_migrateDB(tmpdir):
+    """
+    Test that migrate_db.py converts the database at the path it's given,
+    without touching the app's.
+    """
+    path = tmpdir.mkdir('custom')
+    db = db_wrapper.open_db('brawlbracketdata', filepath=str(path))
+    db.create_table('refs', ['id'], ['UUID'], 'id')
+    db.insert_values('refs', [(uuid.uuid1(),)])
+    db.exit()
+    
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call(
+        [sys.executable, os.path.join(root, 'migrate_db.py'), 'blob',
+         '-p', str(path)],
+        cwd = str(tmpdir),
+        env = dict(os.environ, PYTHONPATH = root))
+    
+    conn = sqlite3.connect(str(path.join('brawlbracketdata.db')))
+    assert conn.execute('SELECT typeof(id) FROM refs').fetchone()[0] == \
+        'blob'
+    conn.close()
+    assert not tmpdir.join('data').exists()
+
+def test_writeBehind(tmpdir):
+    """
+    Test that deferred rows are coalesced, seen by reads and written out on
+    exit.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   write_behind=True, write_behind_interval=60)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    
+    db.insert_deferred('things', [(1, 'a'), (2, 'b')])
+    db.insert_deferred('things', [(1, 'c')])
+    assert db.write_queue.depth == 2
+    assert db.write_queue.stats()['coalesced'] == 1
+    
+    # Reads flush first
+    assert sorted(db.select_values('things', ['*'], None)) == \
+        [(1, 'c'), (2, 'b')]
+    assert db.write_queue.depth == 0
+    
+    db.insert_deferred('things', [(3, 'd')])
+    db.exit()
+    
+    with db._connect() as conn:
+        assert conn.execute('SELECT value FROM things WHERE id = 3')\
+            .fetchone() == ('d',)
+
+def test_writeBehindBadRow(tmpdir):
+    """
+    Test that a row that can't be written is moved aside after a few tries
+    instead of holding up the rest of the queue.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   write_behind=True, write_behind_interval=0.01,
+                   write_behind_retries=2)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    queue = db.write_queue
+    
+    # Too many values for the table
+    db.insert_deferred('things', [(1, 'a'), (2, 'b', 'extra'), (3, 'c')])
+    
+    deadline = time.monotonic() + 5
+    while queue.depth and time.monotonic() < deadline:
+        time.sleep(0.01)
+    
+    assert queue.depth == 0
+    assert list(queue.dead_rows) == [('things', (2,))]
+    assert queue.stats()['failed_flushes'] == 2
+    assert sorted(db.select_values('things', ['*'], None)) == \
+        [(1, 'a'), (3, 'c')]
+    db.exit()
+
+def test_writeBehindTransaction(tmpdir):
+    """
+    Test that rows deferred in a transaction are only queued if it commits.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   write_behind=True, write_behind_interval=60)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    
+    try:
+        with db.transaction():
+            db.insert_deferred('things', [(1, 'a')])
+            raise ValueError()
+    except ValueError:
+        pass
+    assert db.write_queue.depth == 0
+    
+    with db.transaction():
+        db.insert_deferred('things', [(2, 'b')])
+        assert db.write_queue.depth == 0
+    assert db.write_queue.depth == 1
+    
+    # Queued rows written by a transaction that rolls back are queued again
+    try:
+        with db.transaction():
+            assert db.select_values('things', ['id'], None) == [(2,)]
+            raise ValueError()
+    except ValueError:
+        pass
+    assert db.write_queue.depth == 1
+    
+    assert db.select_values('things', ['id'], None) == [(2,)]
+    db.exit()
+
+def test_writeBehindFlushDuringTransaction(tmpdir):
+    """
+    Test that a transaction can take queued rows while a flush is waiting for
+    it to commit.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   write_behind=True, write_behind_interval=60)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    
+    def queueAndFlush():
+        db.insert_deferred('things', [(1, 'a')])
+        db.write_queue.flush()
+    
+    flusher = threading.Thread(target=queueAndFlush)
+    with db.transaction():
+        db.insert_values('things', [(2, 'b')])
+        
+        # Waits for the write lock this transaction holds
+        flusher.start()
+        time.sleep(0.1)
+        
+        start = time.perf_counter()
+        assert sorted(db.select_values('things', ['*'], None)) == \
+            [(1, 'a'), (2, 'b')]
+        assert time.perf_counter() - start < 1
+    
+    flusher.join()
+    assert db.write_queue.stats()['failed_flushes'] == 0
+    assert sorted(db.select_values('things', ['*'], None)) == \
+        [(1, 'a'), (2, 'b')]
+    db.exit()
+
+def test_updateColumns(tmpdir):
+    """
+    Test that column updates only touch their columns, deferred or not.
+    """
+    db = DBWrapper(str(tmpdir.basename), filepath=str(tmpdir),
+                   write_behind=True, write_behind_interval=60)
+    db.create_table('things', ['id', 'value', 'other'],
+                    ['INTEGER', 'TEXT', 'TEXT'], 'id')
+    db.insert_values('things', [(1, 'a', 'x'), (2, 'b', 'y')])
+    
+    assert db.update_columns('things', {'id': 1}, {'value': 'c'}) == 1
+    assert db.update_columns('things', {'id': 3}, {'value': 'c'}) == 0
+    
+    # Updates merge into a deferred row and into each other
+    db.insert_deferred('things', [(3, 'd', 'z')])
+    db.update_deferred('things', {'id': 3}, {'other': 'w'})
+    db.update_deferred('things', {'id': 2}, {'value': 'e'})
+    db.update_deferred('things', {'id': 2}, {'other': 'v'})
+    assert db.write_queue.depth == 2
+    
+    assert sorted(db.select_values('things', ['*'], None)) == \
+        [(1, 'c', 'x'), (2, 'e', 'v'), (3, 'd', 'w')]
+    db.exit()
+
+def test_iterValues(tmpdir):
+    """
+    Test that iter_values streams the same rows select_values returns.
+    """
+    db = makeDB(tmpdir)
+    db.insert_many('things', ((i, str(i)) for i in range(1000)))
+    
+    rows = db.iter_values('things', ['value'], ['id >= ?'], params = [10],
+                          arraysize = 7)
+    assert next(rows) == ('10',)
+    assert [('10',)] + list(rows) == \
+        db.select_values('things', ['value'], ['id >= ?'], params = [10])
+    
+    # The connection goes back to the pool once iteration stops
+    rows = db.iter_values('things', ['id'], None)
+    next(rows)
+    rows.close()
+    assert db.pool._idle.qsize() == 1
+
+def test_queryStats(tmpdir, capsys):
+    """
+    Test that statements are counted by table and operation and slow ones
+    are logged.
+    """
+    db = makeDB(tmpdir)
+    db.query_stats.reset()
+    db.query_stats.slow_ms = 0
+    
+    db.insert_values('things', [(1, 'a'), (2, 'b')])
+    db.select_values('things', ['*'], ['id = ?'], params = [1])
+    list(db.iter_values('things', ['*'], None))
+    
+    stats = db.query_stats.snapshot()['tables']['things']
+    assert stats['insert']['count'] == 1
+    assert stats['select']['count'] == 2
+    assert sum(stats['select']['histogram'].values()) == 2
+    
+    # Only the statement shape is logged, never values
+    out = capsys.readouterr().out
+    assert 'WHERE id = ?' in out
+    assert '4 params' in out
+    assert "'a'" not in out
+
+def test_memoryBackend(tmpdir):
+    """
+    Test that the memory backend shares one database between connections
+    and never touches the disk.
+    """
+    path = tmpdir.join('memory')
+    db = DBWrapper(str(tmpdir.basename), filepath=str(path),
+                   backend='memory')
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    db.insert_values('things', [(1, 'a')])
+    
+    # Another thread gets its own connection to the same database
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(db.select_values('things', ['value'],
+                                                       None)))
+    thread.start()
+    thread.join()
+    
+    assert results == [[('a',)]]
+    assert not path.check()
+    db.exit()
+    
+    # The writer would run into table locks
+    try:
+        DBWrapper('memorywritebehind', backend='memory', write_behind=True)
+        assert False
+    except ValueError:
+        pass
+
+def test_backup(tmpdir):
+    """
+    Test that backups are a full copy, including deferred rows, taken a few
+    pages at a time.
+    """
+    db = DBWrapper('backuptest', filepath=str(tmpdir), write_behind=True,
+                   write_behind_interval=60)
+    db.create_table('things', ['id', 'value'], ['INTEGER', 'TEXT'], 'id')
+    db.insert_many('things', [(i, 'x' * 500) for i in range(200)])
+    db.insert_deferred('things', [(200, 'deferred')])
+    
+    dest = str(tmpdir.join('copy.db'))
+    pages, _ = db.backup(dest, pages=5, pause=0)
+    assert pages > 5
+    
+    copy = DBWrapper('copy', filepath=str(tmpdir))
+    assert copy.select_values('things', ['COUNT(*)'], None) == [(201,)]
+    assert copy.select_values('things', ['value'], ['id = 200']) == \
+        [('deferred',)]
+    
+    copy.exit()
+    db.exit()
@@ -0,0 +1,48 @@
+import pickle
+import uuid
+from types import SimpleNamespace
+
+from brawlbracket.bracket.match import Match
+from brawlbracket.bracket.player import Player
+
+def test_tracked():
+    """
+    Test that setting tracked fields calls back with their names, and that
+    other fields don't call back.
+    """
+    called = []
+    match = Match(chat = SimpleNamespace(id = uuid.uuid1()))
+    match._dbCallback = lambda obj, field: called.append((obj, field))
+    
+    match.roomNumber = 1234
+    match.oldScore = [1, 0]
+    match.incrementScore(0)
+    assert match.roomNumber == 1234
+    assert called == [(match, 'roomNumber'), (match, 'score')]
+    
+    called.clear()
+    player = Player(None)
+    player._dbCallback = lambda obj, field: called.append((obj, field))
+    player.online += 1
+    player.currentLegend = 'bodvar'
+    assert called == [(player, 'currentLegend')]
+    
+    # No attributes that aren't declared
+    try:
+        player.nickname = 'Bob'
+        assert False
+    except AttributeError:
+        pass
+
+def test_pickle():
+    """
+    Test that tracked fields survive pickling.
+    """
+    player = Player(None, tournamentId = uuid.uuid1())
+    player.currentLegend = 'bodvar'
+    player._dbCallback = None
+    
+    copy = pickle.loads(pickle.dumps(player))
+    assert copy.id == player.id
+    assert copy.tournamentId == player.tournamentId
+    assert copy.currentLegend == 'bodvar'
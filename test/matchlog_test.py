@@ -0,0 +1,62 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from brawlbracket import util
+from brawlbracket import db_wrapper
+from brawlbracket import matchlog
+from brawlbracket.bracket.match import Match
+from brawlbracket.bracket.team import Team
+from brawlbracket.bracket.player import Player
+
+@pytest.fixture(autouse = True)
+def logDB(monkeypatch):
+    """
+    Keep the log in its own in memory database, with nothing cached from
+    other tests.
+    """
+    monkeypatch.setattr(util, 'dbName', 'matchlogtest')
+    monkeypatch.setattr(util, 'dbBackend', 'memory')
+    monkeypatch.setattr(matchlog, '_db', None)
+    monkeypatch.setattr(matchlog, '_lastSeqs', {})
+    
+    db = db_wrapper.app_db()
+    yield db
+    
+    if db.table_exists('match_events'):
+        db.drop_table('match_events')
+
+def makeTournament():
+    """
+    Make a tournament with one match between two one player teams.
+    """
+    teams = []
+    for seed in [1, 2]:
+        player = Player(SimpleNamespace(id = uuid.uuid1()))
+        teams.append(Team(seed, players = [player]))
+    
+    match = Match(teams = teams, chat = SimpleNamespace(id = uuid.uuid1()))
+    tournament = SimpleNamespace(id = uuid.uuid1(), matches = {match})
+    return tournament, match
+
+def test_events():
+    """
+    Test that events are numbered in order and read back.
+    """
+    tournament, match = makeTournament()
+    
+    assert matchlog.logEvent(tournament, match, 'pick legend', None,
+                             {'legendId': 'bodvar'}) == 1
+    assert matchlog.logEvent(tournament, match, 'set room', None,
+                             {'roomNumber': 1234}) == 2
+    
+    events = matchlog.getEvents(tournament.id)
+    assert [e['action'] for e in events] == ['pick legend', 'set room']
+    assert events[1]['matchId'] == match.id
+    assert events[1]['data'] == {'roomNumber': 1234}
+    assert matchlog.getEvents(tournament.id, 1) == events[1:]
+    
+    # Numbering carries on from the database
+    matchlog._lastSeqs.clear()
+    assert matchlog.logEvent(tournament, match, 'report win') == 3
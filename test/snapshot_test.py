@@ -0,0 +1,73 @@
+import pytest
+
+from brawlbracket import util
+from brawlbracket import snapshot
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import usermanager as um
+from brawlbracket import chatmanager as cm
+from brawlbracket.user import User
+
+pytestmark = pytest.mark.usefixtures('freshDB')
+
+def test_snapshot(tmpdir, monkeypatch):
+    """
+    Test that a snapshot brings back the tournaments in it and isn't used
+    once the database has changed.
+    """
+    monkeypatch.setattr(util, 'snapshotPath', str(tmpdir.join('snapshot')))
+    assert snapshot.loadSnapshot() is None
+    
+    tournament = tm.createTournament('snaptest')
+    for seed in range(1, 5):
+        user = User(300 + seed, 'Snap', '')
+        um._writeUserToDB(user)
+        team = tournament.createTeam(seed)
+        player = tournament.createPlayer(user)
+        player.online = 1
+        team.addPlayer(player)
+    tournament.generateMatches()
+    
+    assert snapshot.writeSnapshot() == 1
+    
+    for id in list(tm._tournaments):
+        tm._unregisterTournament(id)
+    um._users.clear()
+    cm._chats.clear()
+    
+    assert snapshot.loadSnapshot() == 1
+    loaded = tm._tournaments[tournament.id]
+    assert loaded is not tournament
+    assert tm.getTournamentByName('snaptest') is loaded
+    assert loaded.root.id == tournament.root.id
+    assert sorted(m.id for m in loaded.matches) == \
+        sorted(m.id for m in tournament.matches)
+    
+    # Users and chats are shared with the managers, nobody is online
+    for player in loaded.players:
+        assert um.getUserById(player.user.id) is player.user
+        assert player.online == 0
+    for match in loaded.matches:
+        assert cm.getChat(match.chat.id) is match.chat
+    
+    # Stale once something is written
+    loaded.name = 'Renamed'
+    assert snapshot.loadSnapshot() is None
+
+def test_snapshotVersion(tmpdir, monkeypatch):
+    """
+    Test that a snapshot isn't used by code with different models, or if
+    other users can write to it.
+    """
+    monkeypatch.setattr(util, 'snapshotPath', str(tmpdir.join('snapshot')))
+    tournament = tm.createTournament('versiontest')
+    assert snapshot.writeSnapshot() == 1
+    tm._unregisterTournament(tournament.id)
+    
+    schemaVersion = snapshot._schemaVersion
+    monkeypatch.setattr(snapshot, '_schemaVersion', lambda: 0)
+    assert snapshot.loadSnapshot() is None
+    monkeypatch.setattr(snapshot, '_schemaVersion', schemaVersion)
+    assert snapshot.loadSnapshot() == 1
+    
+    tmpdir.join('snapshot').chmod(0o666)
+    assert snapshot.loadSnapshot() is None
@@ -0,0 +1,355 @@
+import json
+import uuid
+
+import pytest
+
+from brawlbracket import util
+from brawlbracket import tournamentmanager as tm
+from brawlbracket import usermanager as um
+from brawlbracket import chatmanager as cm
+from brawlbracket import writebatch
+from brawlbracket.user import User
+
+pytestmark = pytest.mark.usefixtures('freshDB')
+
+def test_registry():
+    """
+    Test that loaded tournaments are found by id and name, and loaded again
+    from the database once they've been removed.
+    """
+    tournament = tm.createTournament('registrytest', name = 'Registry Test')
+    
+    assert tm.createTournament('registrytest') is None
+    assert tm.getTournamentById(tournament.id) is tournament
+    assert tm.getTournamentByName('registrytest') is tournament
+    
+    assert tm._unregisterTournament(tournament.id) is tournament
+    assert tournament.id not in tm._tournaments
+    assert 'registrytest' not in tm._tournamentsByName
+    
+    loaded = tm.getTournamentByName('registrytest')
+    assert loaded is not tournament
+    assert loaded.id == tournament.id
+    assert loaded.name == 'Registry Test'
+    assert tm.getTournamentById(tournament.id) is loaded
+    
+    # A second copy loaded at the same time is thrown away
+    assert tm._registerTournament(tm._getTournamentFromDBById(loaded.id)) \
+        is loaded
+
+def test_transactionInBatch():
+    """
+    Test that changes made in a transaction are written before it commits,
+    even inside a batch that's still open.
+    """
+    tournament = tm.createTournament('batchtest')
+    team = tournament.createTeam(1, name = 'Before')
+    
+    def teamName():
+        return tm._db.select_values('teams', ['name'], ['id = ?'],
+                                    params = [team.id])[0][0]
+    
+    with writebatch.batch():
+        with tm.transaction():
+            team.name = 'After'
+        assert teamName() == 'After'
+        
+        # Not in a transaction, so it waits for the batch
+        team.name = 'Later'
+        assert teamName() == 'After'
+    
+    assert teamName() == 'Later'
+
+def test_eviction(monkeypatch):
+    """
+    Test that the least recently used tournaments are unloaded once too many
+    are loaded, unless they're in use.
+    """
+    monkeypatch.setattr(util, 'tournamentCacheSize', 2)
+    
+    first = tm.createTournament('evictfirst')
+    second = tm.createTournament('evictsecond')
+    user = User(1, 'Player', '')
+    um._writeUserToDB(user)
+    player = second.createPlayer(user)
+    player.online = 1
+    
+    # Using the first one again makes the second the least recently used,
+    # but it's pinned
+    tm.getTournamentById(first.id)
+    third = tm.createTournament('evictthird')
+    assert list(tm._tournaments) == [second.id, third.id]
+    
+    # Unloaded tournaments come back with changes made before they were
+    # unloaded
+    first.name = 'Changed'
+    player.online = 0
+    assert tm.getTournamentById(first.id).name == 'Changed'
+    assert second.id not in tm._tournaments
+    
+    # So do connected admins and spectators
+    third.connections += 1
+    fourth = tm.createTournament('evictfourth')
+    assert third.id in tm._tournaments
+    third.connections -= 1
+    
+    # Only the evicted tournament's changes are written early, the rest wait
+    # for the batch
+    def name(tournament):
+        return tm._db.select_values('tournaments', ['name'], ['id = ?'],
+                                    params = [tournament.id])[0][0]
+    
+    with writebatch.batch():
+        third.name = 'Evicted'
+        fourth.name = 'Kept'
+        tm.getTournamentById(first.id)
+        assert third.id not in tm._tournaments
+        assert name(third) == 'Evicted'
+        assert name(fourth) != 'Kept'
+    assert name(fourth) == 'Kept'
+
+def test_nameExists(monkeypatch):
+    """
+    Test that names are checked without loading tournaments, and that names
+    not in use are remembered until they're created or expire.
+    """
+    tournament = tm.createTournament('existstest')
+    tm._unregisterTournament(tournament.id)
+    
+    assert tm.tournamentNameExists('existstest')
+    assert tournament.id not in tm._tournaments
+    
+    # Missing names don't go to the database again
+    assert not tm.tournamentNameExists('missingtest')
+    getTournament = tm._getTournamentFromDBByName
+    monkeypatch.setattr(tm, '_getTournamentFromDBByName', None)
+    assert tm.getTournamentByName('missingtest') is None
+    monkeypatch.setattr(tm, '_getTournamentFromDBByName', getTournament)
+    
+    assert tm.createTournament('missingtest') is not None
+    assert tm.tournamentNameExists('missingtest')
+    
+    # Expired names are looked up again
+    monkeypatch.setattr(util, 'tournamentMissingTTL', 0)
+    assert not tm.tournamentNameExists('expiredtest')
+    assert 'expiredtest' in tm._missingNames
+    assert not tm._nameMissing('expiredtest')
+    assert 'expiredtest' not in tm._missingNames
+
+def test_lazyLoad():
+    """
+    Test that loaded tournaments only load their matches, teams and players
+    once they're used.
+    """
+    user = User(2, 'Lazy', '')
+    um._writeUserToDB(user)
+    um._users[user.id] = user
+    
+    tournament = tm.createTournament('lazytest', name = 'Lazy Test')
+    tournament.addAdmins(user)
+    team = tournament.createTeam(1, name = 'Lazy Team')
+    team.addPlayer(tournament.createPlayer(user))
+    tm._unregisterTournament(tournament.id)
+    
+    loaded = tm.getTournamentByName('lazytest')
+    assert not loaded.loaded
+    assert loaded.name == 'Lazy Test'
+    assert loaded.isAdmin(user)
+    assert not loaded.loaded
+    
+    assert [t.name for t in loaded.teams] == ['Lazy Team']
+    assert loaded.loaded
+    assert [p.user for p in loaded.players] == [user]
+    assert loaded.matches == set()
+    assert loaded.root is None
+
+def test_bulkLoad():
+    """
+    Test that users and chats are read in bulk when a tournament is loaded,
+    not one query each.
+    """
+    tournament = tm.createTournament('bulktest')
+    for seed in range(1, 9):
+        user = User(100 + seed, 'Bulk {}'.format(seed), '')
+        um._writeUserToDB(user)
+        team = tournament.createTeam(seed)
+        team.addPlayer(tournament.createPlayer(user))
+    tournament.generateMatches()
+    
+    tm._unregisterTournament(tournament.id)
+    um._users.clear()
+    cm._chats.clear()
+    
+    stats = tm._db.query_stats
+    stats.reset()
+    loaded = tm.getTournamentById(tournament.id)
+    assert len(loaded.players) == 8
+    assert all(p.user.username.startswith('Bulk') for p in loaded.players)
+    assert all(m.chat is not None for m in loaded.matches)
+    
+    tables = stats.snapshot()['tables']
+    assert tables['users']['select']['count'] == 1
+    assert tables['chats']['select']['count'] == 1
+
+def test_warmUp():
+    """
+    Test that warming up loads tournaments that are still being played, with
+    one query per table for all of them.
+    """
+    tournaments = []
+    for i in range(3):
+        tournament = tm.createTournament('warmtest{}'.format(i))
+        for seed in range(1, 5):
+            user = User(200 + i * 10 + seed, 'Warm', '')
+            um._writeUserToDB(user)
+            team = tournament.createTeam(seed)
+            team.addPlayer(tournament.createPlayer(user))
+        if i < 2:
+            tournament.generateMatches()
+        tournaments.append(tournament)
+    
+    for id in list(tm._tournaments):
+        tm._unregisterTournament(id)
+    um._users.clear()
+    cm._chats.clear()
+    
+    stats = tm._db.query_stats
+    stats.reset()
+    assert tm.warmUp(workers = 2) == 2
+    
+    # The one without matches isn't loaded
+    assert tournaments[2].id not in tm._tournaments
+    for tournament in tournaments[:2]:
+        loaded = tm._tournaments[tournament.id]
+        assert loaded.loaded
+        assert len(loaded.matches) == 3
+        assert loaded.root.id == tournament.root.id
+    
+    # One query per table for each worker
+    tables = stats.snapshot()['tables']
+    assert tables['players']['select']['count'] == 2
+    assert tables['users']['select']['count'] == 2
+
+def test_warmUpCacheSize(monkeypatch):
+    """
+    Test that warming up doesn't load more tournaments than fit in the cache
+    next to the ones already loaded.
+    """
+    monkeypatch.setattr(util, 'tournamentCacheSize', 2)
+    
+    tournaments = []
+    for i in range(3):
+        tournament = tm.createTournament('warmcache{}'.format(i))
+        for seed in range(1, 3):
+            user = User(250 + i * 10 + seed, 'Warm', '')
+            um._writeUserToDB(user)
+            team = tournament.createTeam(seed)
+            team.addPlayer(tournament.createPlayer(user))
+        tournament.generateMatches()
+        tournaments.append(tournament)
+    
+    for tournament in tournaments:
+        tm._unregisterTournament(tournament.id)
+    tm.getTournamentById(tournaments[0].id)
+    evictions = tm._evictions
+    
+    assert tm.warmUp() == 1
+    assert len(tm._tournaments) == 2
+    assert tournaments[0].id in tm._tournaments
+    assert tm._evictions == evictions
+
+def test_migrateMembershipLists(freshDB):
+    """
+    Test that a database where tournaments and matches listed their children
+    in JSON columns keeps every tournament's membership, prereqs and winners
+    once it's migrated.
+    """
+    db = freshDB
+    db.create_table('tournaments',
+                    ['id', 'name', 'shortName', 'matches', 'teams', 'players',
+                     'admins', 'root', 'startTime', 'checkInTime',
+                     'description', 'style'],
+                    ['UUID', 'TEXT', 'TEXT', 'UUIDLIST', 'UUIDLIST',
+                     'UUIDLIST', 'UUIDLIST', 'UUID', 'TEXT', 'TEXT', 'TEXT',
+                     'TEXT'],
+                    'id')
+    db.create_table('matches',
+                    ['id', 'nextMatch', 'nextMatchSide', 'round', 'number',
+                     'prereqMatches', 'chat', 'score', 'teams', 'realmBans',
+                     'startTime', 'roomNumber', 'currentRealm', 'banRule',
+                     'winner', 'bestOf', 'state'],
+                    ['UUID', 'UUID', 'INTEGER', 'INTEGER', 'INTEGER',
+                     'UUIDLIST', 'UUID', 'TEXT', 'UUIDLIST', 'TEXT', 'TEXT',
+                     'INTEGER', 'TEXT', 'TEXT', 'UUID', 'INTEGER', 'TEXT'],
+                    'id')
+    db.create_table('teams',
+                    ['id', 'seed', 'name', 'players', 'eliminated',
+                     'checkedIn'],
+                    ['UUID', 'INTEGER', 'TEXT', 'UUIDLIST', 'BOOLEAN',
+                     'BOOLEAN'],
+                    'id')
+    db.create_table('players',
+                    ['id', 'user', 'currentLegend', 'adminChat'],
+                    ['UUID', 'UUID', 'TEXT', 'UUID'],
+                    'id')
+    
+    def ids(*ids):
+        return json.dumps([str(id) if id is not None else None
+                           for id in ids])
+    
+    # Two tournaments with a team each, the first has a final with one
+    # decided semi final
+    tournamentIds = [uuid.uuid1(), uuid.uuid1()]
+    teamIds = [uuid.uuid1(), uuid.uuid1()]
+    playerIds = [uuid.uuid1(), uuid.uuid1()]
+    final, semi, leftover = uuid.uuid1(), uuid.uuid1(), uuid.uuid1()
+    
+    users = [User(400 + i, 'Migrated', '') for i in range(2)]
+    for i in range(2):
+        um._writeUserToDB(users[i])
+        um._users[users[i].id] = users[i]
+        db.insert_values('tournaments', [(
+            tournamentIds[i], 'Old {}'.format(i), 'oldtest{}'.format(i),
+            ids(final, semi) if i == 0 else ids(), ids(teamIds[i]),
+            ids(playerIds[i]), ids(users[i].id), final if i == 0 else None,
+            None, None, '', 'Single Elimination')])
+        db.insert_values('teams', [(teamIds[i], i + 1, 'Team {}'.format(i),
+                                    ids(playerIds[i]), False, False)])
+        db.insert_values('players', [(playerIds[i], users[i].id, None,
+                                      None)])
+    
+    def matchRow(id, nextMatch, prereqs, teams, winner):
+        return (id, nextMatch, 0 if nextMatch else None, 1, 1,
+                ids(*prereqs), None, json.dumps([0, 0]), ids(*teams),
+                json.dumps([]), None, None, None, 'basic', winner, 3,
+                json.dumps({}))
+    
+    db.insert_values('matches', [
+        matchRow(final, None, [semi, None], [teamIds[0], None], None),
+        matchRow(semi, final, [None, None], [teamIds[0], None], teamIds[0]),
+        # Not listed by any tournament
+        matchRow(leftover, None, [None, None], [None, None], None)])
+    
+    tm._initDB()
+    assert not db.column_exists('tournaments', 'matches')
+    assert db.select_values('matches', ['id'], ['id = ?'],
+                            params = [leftover]) == []
+    
+    tournament = tm.getTournamentById(tournamentIds[0])
+    assert tournament.isAdmin(users[0])
+    assert {m.id for m in tournament.matches} == {final, semi}
+    assert [t.id for t in tournament.teams] == [teamIds[0]]
+    assert [p.user for p in tournament.players] == [users[0]]
+    
+    root = tournament.root
+    assert root.id == final
+    assert root.prereqMatches[0].id == semi
+    assert root.prereqMatches[0].nextMatch is root
+    assert root.prereqMatches[0].winner.id == teamIds[0]
+    assert root.teams[0].id == teamIds[0]
+    assert root.winner is None
+    
+    other = tm.getTournamentById(tournamentIds[1])
+    assert other.matches == set()
+    assert [t.id for t in other.teams] == [teamIds[1]]
+    assert [p.id for p in other.players] == [playerIds[1]]
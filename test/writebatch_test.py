@@ -0,0 +1,124 @@
+from brawlbracket import writebatch
+
+class Thing:
+    pass
+
+def makeCallback(written):
+    """
+    Make a coalesced callback that records what it writes.
+    """
+    @writebatch.coalesced
+    def callback(obj, fields):
+        written.append((obj, fields))
+    return callback
+
+def test_noBatch():
+    """
+    Test that callbacks outside of a batch write straight away.
+    """
+    written = []
+    callback = makeCallback(written)
+    thing = Thing()
+    
+    callback(thing)
+    callback(thing, 'name')
+    assert written == [(thing, None), (thing, {'name'})]
+
+def test_batch():
+    """
+    Test that a batch writes each dirty object once when it ends.
+    """
+    written = []
+    callback = makeCallback(written)
+    a = Thing()
+    b = Thing()
+    
+    before = writebatch.stats()
+    with writebatch.batch():
+        callback(a, 'name')
+        callback(b, 'name')
+        
+        # Nested batches are part of the outer one
+        with writebatch.batch():
+            callback(a, 'seed')
+        callback(b)
+        assert written == []
+    
+    assert written == [(a, {'name', 'seed'}), (b, None)]
+    
+    after = writebatch.stats()
+    assert after['calls'] - before['calls'] == 4
+    assert after['saved'] - before['saved'] == 2
+
+def test_flush():
+    """
+    Test that flushing writes dirty objects without ending the batch.
+    """
+    written = []
+    callback = makeCallback(written)
+    thing = Thing()
+    
+    with writebatch.batch():
+        callback(thing)
+        writebatch.flush()
+        assert written == [(thing, None)]
+        
+        callback(thing, 'name')
+        assert written == [(thing, None)]
+    
+    assert written == [(thing, None), (thing, {'name'})]
+    
+    # Ending a batch that was never started does nothing
+    writebatch.end()
+
+def test_endWithoutWriting():
+    """
+    Test that ending a batch without writing drops the dirty objects.
+    """
+    written = []
+    callback = makeCallback(written)
+    thing = Thing()
+    
+    writebatch.begin()
+    callback(thing, 'name')
+    writebatch.end(write = False)
+    assert written == []
+    
+    # Later writes aren't affected
+    callback(thing, 'name')
+    assert written == [(thing, {'name'})]
+
+def test_isDirty():
+    """
+    Test that a batch is only dirty once something changed in it.
+    """
+    written = []
+    callback = makeCallback(written)
+    
+    assert not writebatch.isDirty()
+    with writebatch.batch():
+        assert not writebatch.isDirty()
+        callback(Thing(), 'name')
+        assert writebatch.isDirty()
+        
+        writebatch.flush()
+        assert not writebatch.isDirty()
+    assert not writebatch.isDirty()
+
+def test_flushWhere():
+    """
+    Test that only the matching dirty objects are written early.
+    """
+    written = []
+    callback = makeCallback(written)
+    first = Thing()
+    second = Thing()
+    
+    with writebatch.batch():
+        callback(first, 'name')
+        callback(second, 'name')
+        
+        writebatch.flushWhere(lambda obj: obj is first)
+        assert written == [(first, {'name'})]
+    
+    assert written == [(first, {'name'}), (second, {'name'})]